@@ -0,0 +1,203 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# Bits of the anomaly flags, several can be set for the same hour
+GAP_FILLED = 1   # no reading at the end of this hour, the consumption was spread over the gap
+UNFILLED_GAP = 2 # gap longer than max_gap_hours, left empty
+RESET = 4        # the register went back to a lower value, the consumption of the interval is counted as zero
+ROLLOVER = 8     # the register wrapped around its capacity, the consumption was corrected
+SPIKE = 16       # consumption far above the usual level of the building
+DROPPED = 32     # reading below an earlier one which the register came back to later, ignored
+FLAG_NAMES = {GAP_FILLED: "gap_filled", UNFILLED_GAP: "unfilled_gap", RESET: "reset",
+              ROLLOVER: "rollover", SPIKE: "spike", DROPPED: "dropped"}
+
+
+def to_hourly_grid(readings: pd.DataFrame) -> pd.DataFrame:
+    """Cumulative readings (one column per building, eg. get_all_buildings_data_df) on a regular hourly
+    index. Readings are assigned to the hour they fall in, the last reading wins for duplicate hours and
+    missing hours are NaN."""
+
+    readings = readings.sort_index(kind="stable")
+    hours = readings.index.floor("h")
+    readings = readings.groupby(hours).last()
+    full_index = pd.date_range(readings.index.min(), readings.index.max(), freq="h", name=readings.index.name)
+
+    return readings.reindex(full_index)
+
+
+def _register_capacity(values: np.ndarray) -> np.ndarray:
+    """Smallest power of ten above the largest reading of each column, the assumed register size"""
+
+    largest = np.nanmax(np.where(np.isnan(values), 0, np.abs(values)), axis=0)
+
+    return 10.0 ** np.ceil(np.log10(largest + 1))
+
+
+def _neighbour_values(values: np.ndarray,
+                      valid: np.ndarray,
+                      positions: np.ndarray,
+                      columns: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Previous and next valid reading of every hour, NaN at the ends"""
+
+    n_hours = len(values)
+    previous = np.maximum.accumulate(np.where(valid, positions, -1), axis=0)
+    following = np.minimum.accumulate(np.where(valid, positions, n_hours)[::-1], axis=0)[::-1]
+    previous = np.vstack([np.full((1, values.shape[1]), -1), previous[:-1]])
+    following = np.vstack([following[1:], np.full((1, values.shape[1]), n_hours)])
+    previous_value = np.where(previous >= 0, values[np.clip(previous, 0, n_hours - 1), columns], np.nan)
+    next_value = np.where(following < n_hours, values[np.clip(following, 0, n_hours - 1), columns], np.nan)
+
+    return previous_value, next_value
+
+
+def _run_length(in_run: np.ndarray,
+                breaks: np.ndarray,
+                positions: np.ndarray) -> np.ndarray:
+    """Number of in_run hours between the surrounding breaks, for every hour of each column. Hours which
+    are neither (eg. missing readings) don't end a run."""
+
+    n_hours = len(in_run)
+    counts = np.vstack([np.zeros((1, in_run.shape[1]), dtype=np.int64), np.cumsum(in_run, axis=0)])
+    columns = np.broadcast_to(np.arange(in_run.shape[1]), in_run.shape)
+    previous_break = np.maximum.accumulate(np.where(breaks, positions, -1), axis=0)
+    next_break = np.minimum.accumulate(np.where(breaks, positions, n_hours)[::-1], axis=0)[::-1]
+
+    return counts[next_break, columns] - counts[previous_break + 1, columns]
+
+
+def derive_hourly_consumption(readings: pd.DataFrame,
+                              max_gap_hours: int = 168,
+                              max_dip_readings: int = 3,
+                              rollover_tolerance: float = 0.01,
+                              spike_threshold: float = 10) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Hourly consumption of all buildings from their cumulative register readings, computed on the whole
+    (hours x buildings) array at once.
+
+    The consumption between two consecutive readings is spread evenly over the hours in between, so gaps
+    in the data are filled proportionally. Single readings above both neighbours and runs of at most
+    max_dip_readings readings below an earlier reading which the register reaches again later (provider
+    corrections, readings that drop to zero for a while) are ignored. Of the remaining
+    decreases, a rollover is one where the previous reading was within rollover_tolerance of the register
+    capacity and the new one as close to zero, and it is corrected by the capacity. The capacity is only
+    guessed from the largest reading, so any other decrease is a reset (eg. a meter exchange) and the
+    consumption of the interval is counted as zero. Hours more than spike_threshold robust deviations above the
+    median of the non-zero hourly consumption of the building are flagged.
+
+    Args:
+        readings (pd.DataFrame): cumulative readings, one column per building
+        max_gap_hours (int, optional): longer gaps are not filled. Defaults to 168.
+        max_dip_readings (int, optional): longest run of readings below an earlier reading which is ignored,
+            longer drops are resets. Defaults to 3.
+        rollover_tolerance (float, optional): fraction of the capacity by which the previous reading may be
+            below the capacity, and the new reading above zero, for a rollover. Defaults to 0.01.
+        spike_threshold (float, optional): number of median absolute deviations above the median. Defaults to 10.
+
+    Returns:
+        tuple (pd.DataFrame, pd.DataFrame): consumption per hour ending at the index, and the anomaly flags
+        as a combination of the bits GAP_FILLED, UNFILLED_GAP, RESET, ROLLOVER, SPIKE and DROPPED
+    """
+
+    grid = to_hourly_grid(readings)
+    values = grid.to_numpy(dtype=np.float64)
+    n_hours = len(values)
+    positions = np.arange(n_hours)[:, None]
+
+    columns = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+    valid = ~np.isnan(values)
+
+    # Single readings above both neighbours, which the provider corrected with the next reading
+    previous_value, next_value = _neighbour_values(values, valid, positions, columns)
+    is_dropped = valid & (values > next_value) & (previous_value <= next_value)
+    valid &= ~is_dropped
+
+    # Readings below the highest earlier reading, if the register gets back to it later
+    filled = np.where(valid, values, -np.inf)
+    max_before = np.vstack([np.full((1, values.shape[1]), -np.inf), np.maximum.accumulate(filled, axis=0)[:-1]])
+    max_after = np.vstack([np.maximum.accumulate(filled[::-1], axis=0)[::-1][1:], np.full((1, values.shape[1]), -np.inf)])
+    is_dip = valid & (values < max_before) & (max_after >= max_before)
+    # Only short dips are corrections, a long run below the old reading is a new register (eg. a meter
+    # exchange) which happens to climb past the old value later and is left to the reset detection below
+    is_dip &= _run_length(is_dip, valid & ~is_dip, positions) <= max_dip_readings
+    is_dropped |= is_dip
+    valid &= ~is_dip
+
+    # Position of the last reading at or before and of the first reading at or after every hour
+    previous = np.maximum.accumulate(np.where(valid, positions, -1), axis=0)
+    following = np.minimum.accumulate(np.where(valid, positions, n_hours)[::-1], axis=0)[::-1]
+
+    # The hour ending at h belongs to the interval from the last reading before h to the first reading from h on
+    start = np.vstack([np.full((1, values.shape[1]), -1), previous[:-1]])
+    end = following
+    has_interval = (start >= 0) & (end < n_hours)
+    start_value = np.where(has_interval, values[np.clip(start, 0, n_hours - 1), columns], np.nan)
+    end_value = np.where(has_interval, values[np.clip(end, 0, n_hours - 1), columns], np.nan)
+    length = np.where(has_interval, end - start, 1)
+
+    delta = end_value - start_value
+    capacity = _register_capacity(values)
+    is_rollover = ((delta < 0) & (start_value >= (1 - rollover_tolerance) * capacity)
+                   & (end_value <= rollover_tolerance * capacity))
+    is_reset = (delta < 0) & ~is_rollover
+    delta = np.where(is_rollover, delta + capacity, delta)
+    delta = np.where(is_reset, 0, delta)
+
+    is_long_gap = has_interval & (length > max_gap_hours)
+    consumption = np.where(is_long_gap, np.nan, delta / length)
+
+    flags = np.zeros(values.shape, dtype=np.int8)
+    flags |= np.where(has_interval & (length > 1) & ~is_long_gap & ~valid, GAP_FILLED, 0).astype(np.int8)
+    flags |= np.where(is_long_gap, UNFILLED_GAP, 0).astype(np.int8)
+    flags |= np.where(is_reset, RESET, 0).astype(np.int8)
+    flags |= np.where(is_rollover, ROLLOVER, 0).astype(np.int8)
+    flags |= np.where(is_dropped, DROPPED, 0).astype(np.int8)
+
+    # Many hours without consumption (eg. heating in summer) would make every use a spike
+    positive = np.where(consumption > 0, consumption, np.nan)
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        median = np.nanmedian(positive, axis=0)
+        deviation = 1.4826 * np.nanmedian(np.abs(positive - median), axis=0)
+        # Readings are rounded, so the deviation can be zero for buildings with a steady consumption
+        is_spike = consumption > median + spike_threshold * np.maximum(deviation, median)
+    flags |= np.where(is_spike, SPIKE, 0).astype(np.int8)
+
+    consumption = pd.DataFrame(consumption, index=grid.index, columns=grid.columns)
+    flags = pd.DataFrame(flags, index=grid.index, columns=grid.columns)
+
+    return consumption, flags
+
+
+def aggregate_consumption(consumption: pd.DataFrame,
+                          flags: pd.DataFrame,
+                          freq: str = "D") -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Sum hourly consumption to days ("D"), months ("MS") or any other frequency. A period is NaN only if
+    all its hours are, and its flags are the union of the flags of its hours. Convert the index with
+    tz_convert first to aggregate in local time."""
+
+    aggregated = consumption.resample(freq).sum(min_count=1)
+    aggregated_flags = pd.DataFrame(0, index=aggregated.index, columns=flags.columns, dtype=np.int8)
+    for bit in FLAG_NAMES:
+        aggregated_flags |= ((flags & bit) > 0).resample(freq).max().astype(np.int8) * np.int8(bit)
+
+    return aggregated, aggregated_flags
+
+
+def derive_consumption(readings: pd.DataFrame,
+                       freq: str = "h",
+                       **kwargs) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Hourly ("h"), daily ("D") or monthly ("MS") consumption of all buildings from cumulative readings.
+    See derive_hourly_consumption for the arguments."""
+
+    consumption, flags = derive_hourly_consumption(readings, **kwargs)
+    if freq == "h":
+        return consumption, flags
+
+    return aggregate_consumption(consumption, flags, freq)
+
+
+def describe_flags(flags: pd.DataFrame) -> pd.DataFrame:
+    """Number of flagged periods per building and anomaly type"""
+
+    return pd.DataFrame({name: ((flags & bit) > 0).sum() for bit, name in FLAG_NAMES.items()})
@@ -1,11 +1,22 @@
 
 import os
+import json
 from pathlib import Path
 from typing import List
+from concurrent.futures import ProcessPoolExecutor
 
 from tqdm import tqdm
+import numpy as np
+import orjson
 import pandas as pd
 
+# Parsed buildings are cached outside of the raw data folder, so that they are not listed as buildings
+CACHE_FOLDER = Path(__file__).resolve().parents[1].joinpath("data", "interim", "building_cache")
+CATEGORY_COLUMNS = ["addr", "meter", "type", "var"]
+METADATA_FILE = "Potential objects.xlsx"
+
+_metadata_memo = {}
+
 
 def get_building_name_list(data_folder: Path):
     
@@ -14,17 +25,75 @@ def get_building_name_list(data_folder: Path):
     return building_name_list
 
 
+def _meter_tokens(meter: str):
+    
+    # "/10.7.1/PF1" or "10.10/PF1" -> the building id "10.7.1", which building names start with
+    if pd.isna(meter):
+        return []
+    parts = [p for p in str(meter).strip().strip("/").split("/") if p != ""]
+    
+    return parts[:1]
+
+
+def load_building_metadata(data_folder: Path,
+                           cache_folder: Path = CACHE_FOLDER):
+    """The sheet of "Potential objects.xlsx" and an exact-match index from the building ids and names in
+    its Měřidlo column to row positions. Both are pickled in cache_folder and kept in memory, the workbook
+    is only parsed again when it changes.
+
+    Returns:
+        tuple (pd.DataFrame, pd.DataFrame): the metadata and the index with the columns token and row
+    """
+    
+    xlsx_file = Path(data_folder).joinpath(METADATA_FILE)
+    mtime_ns = xlsx_file.stat().st_mtime_ns
+    
+    cached = _metadata_memo.get(str(xlsx_file))
+    if (cached is None) or (cached["mtime_ns"] != mtime_ns):
+        pickle_file = Path(cache_folder).joinpath("metadata", f"{xlsx_file.stem}.pkl")
+        cached = pd.read_pickle(pickle_file) if pickle_file.exists() else None
+        if (cached is None) or (cached["source"] != str(xlsx_file)) or (cached["mtime_ns"] != mtime_ns):
+            df = pd.read_excel(xlsx_file)
+            tokens = [(token, row) for row, meter in enumerate(df["Měřidlo"]) for token in _meter_tokens(meter)]
+            cached = {"source": str(xlsx_file), "mtime_ns": mtime_ns, "metadata": df,
+                      "tokens": pd.DataFrame(tokens, columns=["token", "row"])}
+            os.makedirs(pickle_file.parent, exist_ok=True)
+            tmp_file = pickle_file.with_suffix(f".{os.getpid()}.tmp")
+            pd.to_pickle(cached, tmp_file)
+            os.replace(tmp_file, pickle_file)
+        _metadata_memo[str(xlsx_file)] = cached
+    
+    return cached["metadata"], cached["tokens"]
+
+
 def get_building_metadata_df(data_folder: Path,
                              building_list: List[str] = None):
     
-    df = pd.read_excel(data_folder.joinpath("Potential objects.xlsx"))
+    df, tokens = load_building_metadata(data_folder)
     
     if building_list is not None:
-        building_ids = [b.split("-")[0] for b in building_list]
-        pat = '|'.join(r"\b{}\b".format(x) for x in building_ids)
+        building_ids = pd.Series([b.split("-")[0] for b in building_list], name="token").drop_duplicates()
+        rows = tokens.merge(building_ids, on="token")["row"].unique()
         
-        df = df.loc[df["Měřidlo"].str.contains(pat), :]
-        df
+        df = df.iloc[np.sort(rows)]
+    
+    # The memoized frame is shared by all calls
+    return df.copy()
+
+
+def read_building_json(file: Path) -> pd.DataFrame:
+    """Parse one response_*.json with orjson. The string values become float64 and the repeated
+    addr/meter/type/var strings categoricals while the records are converted."""
+    
+    records = orjson.loads(Path(file).read_bytes())
+    
+    df = pd.DataFrame({
+        "time": pd.to_datetime([r["time"] for r in records], utc=True, format="ISO8601"),
+        "value": np.array([r["value"] for r in records], dtype=np.float64),
+    })
+    for col in CATEGORY_COLUMNS:
+        df[col] = pd.Categorical([r.get(col) for r in records])
+    df.set_index("time", inplace=True)
     
     return df
 
@@ -32,39 +101,259 @@ def get_building_metadata_df(data_folder: Path,
 def get_building_data_raw_files(data_folder: Path,
                                 building_name: str):
     
-    json_files = data_folder.joinpath(building_name).glob("*.json")
+    json_files = sorted(data_folder.joinpath(building_name).glob("*.json"))
     
-    dfs = []
-    for file in json_files:
-        temp_df = pd.read_json(file,
-                               convert_dates=["time"])
-        temp_df.set_index("time", inplace=True)
-        
-        dfs.append(temp_df)
+    dfs = [read_building_json(file) for file in json_files]
         
     return dfs
 
 
+def _union_categoricals(df: pd.DataFrame):
+    
+    # Concatenating frames with different categories falls back to object columns
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    
+    return df
+
+
+def _write_parquet(df: pd.DataFrame,
+                   path: Path):
+    
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    df.to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _load_manifest(store_folder: Path):
+    
+    manifest_file = store_folder.joinpath("manifest.json")
+    if not manifest_file.exists():
+        return {"files": {}, "parts": []}
+    
+    return json.loads(manifest_file.read_text())
+
+
+def _save_manifest(store_folder: Path,
+                   manifest: dict):
+    
+    tmp_file = store_folder.joinpath(f"manifest.{os.getpid()}.tmp")
+    tmp_file.write_text(json.dumps(manifest, indent=1))
+    os.replace(tmp_file, store_folder.joinpath("manifest.json"))
+
+
+def _read_parts(store_folder: Path,
+                parts: List[dict]):
+    
+    if len(parts) == 0:
+        # The columns of read_building_json, so that callers don't need to handle buildings without readings
+        df = pd.DataFrame({"value": np.array([], dtype=np.float64)},
+                          index=pd.DatetimeIndex([], tz="UTC", name="time"))
+        for col in CATEGORY_COLUMNS:
+            df[col] = pd.Categorical([])
+        return df
+    
+    return _union_categoricals(pd.concat([pd.read_parquet(store_folder.joinpath(p["name"])) for p in parts]))
+
+
+def _take_over_legacy_cache(cache_folder: Path,
+                            building_name: str,
+                            stats: dict):
+    """The former cache kept a whole building in cache_folder/{building_name}.parquet, with the name, size and
+    mtime of its json files in {building_name}.json. If the json files are unchanged the parquet file becomes
+    the first part of the store, otherwise it is removed.
+
+    Returns:
+        dict: the manifest of the store, without files and parts if nothing was taken over
+    """
+    
+    legacy_file = Path(cache_folder).joinpath(f"{building_name}.parquet")
+    signature_file = Path(cache_folder).joinpath(f"{building_name}.json")
+    manifest = {"files": {}, "parts": []}
+    if not legacy_file.exists():
+        signature_file.unlink(missing_ok=True)
+        return manifest
+    
+    signature = json.loads(signature_file.read_text()) if signature_file.exists() else None
+    if signature == [[name, stat.st_size, stat.st_mtime_ns] for name, stat in stats.items()]:
+        store_folder = Path(cache_folder).joinpath(building_name)
+        df = pd.read_parquet(legacy_file)
+        # The time range and rows of the single files are not known any more
+        manifest["files"] = {name: {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "start": None, "end": None,
+                                    "rows": None} for name, stat in stats.items()}
+        if len(df) > 0:
+            part = {"name": "part-00000-legacy.parquet",
+                    "start": df.index.min().isoformat(), "end": df.index.max().isoformat(), "rows": len(df)}
+            os.replace(legacy_file, store_folder.joinpath(part["name"]))
+            manifest["parts"].append(part)
+        _save_manifest(store_folder, manifest)
+    
+    legacy_file.unlink(missing_ok=True)
+    signature_file.unlink(missing_ok=True)
+    
+    return manifest
+
+
+def ingest_building(data_folder: Path,
+                    building_name: str,
+                    cache_folder: Path = CACHE_FOLDER,
+                    max_parts: int = 64):
+    """Bring the store of a building up to date with its json files. The store is a manifest of the
+    ingested files (name, size, mtime and time range) plus append-only parquet parts sorted by time. Only
+    files that are not in the manifest yet are parsed; their readings are deduplicated against the stored
+    ones, sorted and appended as a new part. The store is rebuilt if an ingested file changed or
+    disappeared, and compacted into one part if new readings overlap stored ones or max_parts is reached.
+    A whole-building parquet file of the former cache is taken over as the first part of a new store.
+
+    Returns:
+        int: number of new readings
+    """
+    
+    store_folder = Path(cache_folder).joinpath(building_name)
+    os.makedirs(store_folder, exist_ok=True)
+    
+    json_files = {f.name: f for f in sorted(data_folder.joinpath(building_name).glob("*.json"))}
+    stats = {name: f.stat() for name, f in json_files.items()}
+    manifest = _load_manifest(store_folder)
+    if len(manifest["files"]) == 0:
+        manifest = _take_over_legacy_cache(cache_folder, building_name, stats)
+    changed = [name for name, entry in manifest["files"].items()
+               if (name not in stats) or (entry["size"], entry["mtime_ns"]) != (stats[name].st_size, stats[name].st_mtime_ns)]
+    if changed:
+        for part in manifest["parts"]:
+            store_folder.joinpath(part["name"]).unlink(missing_ok=True)
+        manifest = {"files": {}, "parts": []}
+    
+    new_files = [name for name in json_files if name not in manifest["files"]]
+    if len(new_files) == 0:
+        return 0
+    
+    dfs = [read_building_json(json_files[name]) for name in new_files]
+    new_df = _union_categoricals(pd.concat(dfs))
+    new_df = new_df[~new_df.index.duplicated()]
+    
+    # Readings which are already stored win, like the first file wins in get_building_data_raw_files
+    new_start, new_end = new_df.index.min(), new_df.index.max()
+    overlapping = [p for p in manifest["parts"]
+                   if pd.Timestamp(p["start"]) <= new_end and pd.Timestamp(p["end"]) >= new_start]
+    if overlapping:
+        stored_index = _read_parts(store_folder, overlapping).index
+        new_df = new_df[~new_df.index.isin(stored_index)]
+    new_df = new_df.sort_index()
+    
+    for name, df in zip(new_files, dfs):
+        # Files without readings have no time range
+        manifest["files"][name] = {"size": stats[name].st_size, "mtime_ns": stats[name].st_mtime_ns,
+                                   "start": df.index.min().isoformat() if len(df) > 0 else None,
+                                   "end": df.index.max().isoformat() if len(df) > 0 else None,
+                                   "rows": len(df)}
+    
+    if len(new_df) > 0:
+        stored_end = max([pd.Timestamp(p["end"]) for p in manifest["parts"]], default=None)
+        if (stored_end is not None and new_df.index.min() <= stored_end) or (len(manifest["parts"]) >= max_parts):
+            # Late readings: merge everything into one sorted part
+            merged = _union_categoricals(pd.concat([_read_parts(store_folder, manifest["parts"]), new_df]))
+            merged = merged.sort_index(kind="stable")
+            old_parts = manifest["parts"]
+            part = {"name": f"part-{len(manifest['files']):05d}-compacted.parquet"}
+            _write_parquet(merged, store_folder.joinpath(part["name"]))
+            part.update(start=merged.index.min().isoformat(), end=merged.index.max().isoformat(), rows=len(merged))
+            manifest["parts"] = [part]
+            _save_manifest(store_folder, manifest)
+            for old_part in old_parts:
+                if old_part["name"] != part["name"]:
+                    store_folder.joinpath(old_part["name"]).unlink(missing_ok=True)
+            return len(new_df)
+        
+        part = {"name": f"part-{len(manifest['files']):05d}.parquet",
+                "start": new_df.index.min().isoformat(), "end": new_df.index.max().isoformat(), "rows": len(new_df)}
+        _write_parquet(new_df, store_folder.joinpath(part["name"]))
+        manifest["parts"].append(part)
+    
+    _save_manifest(store_folder, manifest)
+    
+    return len(new_df)
+
+
 def get_building_data_df(data_folder: Path,
-                         building_name: str):
+                         building_name: str,
+                         use_cache: bool = True,
+                         cache_folder: Path = CACHE_FOLDER):
+    """All readings of a building, deduplicated and sorted by time. With use_cache only json files which
+    were not ingested before are parsed (see ingest_building) and the stored parts are read."""
+    
+    if use_cache:
+        ingest_building(data_folder, building_name, cache_folder=cache_folder)
+        store_folder = Path(cache_folder).joinpath(building_name)
+        
+        # The parts are sorted and don't overlap, so they don't need to be sorted again
+        return _read_parts(store_folder, _load_manifest(store_folder)["parts"])
     
     dfs = get_building_data_raw_files(data_folder,
                                       building_name)
         
-    df = pd.concat(dfs)
+    df = _union_categoricals(pd.concat(dfs))
     df = df[~df.index.duplicated()]
     df.sort_index(inplace=True)
     
     return df
 
 
-def get_all_buildings_data_df(data_folder: Path):
+def _load_building_values(data_folder: Path,
+                          building_name: str,
+                          use_cache: bool = True):
+    
+    # Only the index and the values travel back from the worker process
+    df = get_building_data_df(data_folder, building_name, use_cache=use_cache)
+    
+    index = df.index.values.astype("datetime64[ns]").view(np.int64)
+    
+    return building_name, index, df["value"].to_numpy(dtype=np.float64)
+
+
+def get_all_buildings_data_df(data_folder: Path,
+                              n_workers: int = None,
+                              long_format: bool = False,
+                              use_cache: bool = True):
+    """Values of all buildings, loaded in parallel worker processes. The wide result has one column per
+    building on the union of all timestamps, allocated once. With long_format the result has the columns
+    time, building (categorical) and value instead, without the NaN padding.
+
+    Args:
+        data_folder (Path): folder with one subfolder of json files per building
+        n_workers (int, optional): number of processes, 1 loads in this process. Defaults to the number of cpus.
+        long_format (bool, optional): return the long instead of the wide table. Defaults to False.
+        use_cache (bool, optional): use the parquet store of get_building_data_df. Defaults to True.
+    """
     
     building_names = get_building_name_list(data_folder)
+    args = ([data_folder] * len(building_names), building_names, [use_cache] * len(building_names))
 
-    df = pd.DataFrame()
-    for building_name in tqdm(building_names, desc="Loading single building data"):
-        temp_df = get_building_data_df(data_folder, building_name)
-        df[building_name] = temp_df["value"]
+    if n_workers == 1:
+        loaded = list(tqdm(map(_load_building_values, *args),
+                           total=len(building_names), desc="Loading single building data"))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            loaded = list(tqdm(pool.map(_load_building_values, *args),
+                               total=len(building_names), desc="Loading single building data"))
+    
+    if long_format:
+        lengths = [len(values) for _, _, values in loaded]
+        return pd.DataFrame({
+            "time": pd.to_datetime(np.concatenate([index for _, index, _ in loaded] or [[]]).astype(np.int64), utc=True),
+            "building": pd.Categorical(np.repeat(building_names, lengths), categories=building_names),
+            "value": np.concatenate([values for _, _, values in loaded] or [[]]),
+        })
+    
+    # Union of all timestamps, the columns are filled by position instead of aligning one by one
+    union = np.unique(np.concatenate([index for _, index, _ in loaded] or [[]]).astype(np.int64))
+    values = np.full((len(union), len(loaded)), np.nan)
+    for i, (_, index, building_values) in enumerate(loaded):
+        values[np.searchsorted(union, index), i] = building_values
+    
+    df = pd.DataFrame(values,
+                      index=pd.DatetimeIndex(pd.to_datetime(union, utc=True), name="time"),
+                      columns=building_names)
         
     return df
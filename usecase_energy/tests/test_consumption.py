@@ -0,0 +1,68 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.append(SRC_PATH)
+import consumption
+from consumption import DROPPED, GAP_FILLED, RESET, ROLLOVER
+
+
+def hourly_readings(**columns: list) -> pd.DataFrame:
+    length = max(len(v) for v in columns.values())
+    index = pd.date_range("2024-01-01", periods=length, freq="h", tz="UTC")
+    return pd.DataFrame({k: np.array(v, dtype=np.float64) for k, v in columns.items()}, index=index)
+
+
+def test_meter_exchange_is_a_reset_not_a_dip():
+    # Old meter up to 310, the new one starts at 0 and later climbs past the old reading
+    readings = hourly_readings(building=list(range(100, 340, 30)) + list(range(0, 360, 30)))
+
+    hourly, flags = consumption.derive_hourly_consumption(readings)
+
+    exchange = readings.index[8]
+    assert flags.loc[exchange, "building"] & RESET
+    assert hourly.loc[exchange, "building"] == 0
+    assert not (flags["building"] & DROPPED).any()
+    assert (hourly["building"].drop([readings.index[0], exchange]) == 30).all()
+
+
+def test_short_dip_is_dropped_and_spread():
+    readings = hourly_readings(building=[100, 110, 120, 0, 0, 150, 160])
+
+    hourly, flags = consumption.derive_hourly_consumption(readings)
+
+    assert (flags["building"].iloc[3:5] & DROPPED).all()
+    assert not (flags["building"] & RESET).any()
+    np.testing.assert_allclose(hourly["building"].iloc[3:6], [10, 10, 10])
+
+
+def test_rollover_is_corrected():
+    readings = hourly_readings(building=[980, 990, 5, 15])
+
+    hourly, flags = consumption.derive_hourly_consumption(readings)
+
+    assert flags["building"].iloc[2] & ROLLOVER
+    np.testing.assert_allclose(hourly["building"].iloc[1:], [10, 15, 10])
+
+
+def test_reset_below_the_capacity_is_no_rollover():
+    # The capacity is guessed as 10000, a reset from 9500 to 200 must not add 700 units
+    readings = hourly_readings(building=[9400, 9500, 200, 300])
+
+    hourly, flags = consumption.derive_hourly_consumption(readings)
+
+    assert flags["building"].iloc[2] & RESET
+    assert not (flags["building"] & ROLLOVER).any()
+    np.testing.assert_allclose(hourly["building"].iloc[1:], [100, 0, 100])
+
+
+def test_gap_is_filled_proportionally():
+    readings = hourly_readings(building=[0, 10, np.nan, np.nan, 40])
+
+    hourly, flags = consumption.derive_hourly_consumption(readings)
+
+    np.testing.assert_allclose(hourly["building"].iloc[1:], [10, 10, 10, 10])
+    assert (flags["building"].iloc[2:4] & GAP_FILLED).all()
@@ -0,0 +1,53 @@
+import os
+import sys
+import json
+
+import pandas as pd
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.append(SRC_PATH)
+import data_loading
+
+
+def write_responses(building_folder, *responses: list):
+    os.makedirs(building_folder, exist_ok=True)
+    for i, records in enumerate(responses):
+        building_folder.joinpath(f"response_{i}.json").write_text(json.dumps(records))
+
+
+def reading(time: str, value: str) -> dict:
+    return {"time": time, "value": value, "addr": "a", "meter": "/10.7.1/PF1", "type": "t", "var": "v"}
+
+
+def test_building_without_readings(tmp_path):
+    write_responses(tmp_path.joinpath("data", "10.7.1-PF1"), [])
+    cache_folder = tmp_path.joinpath("cache")
+
+    df = data_loading.get_building_data_df(tmp_path.joinpath("data"), "10.7.1-PF1", cache_folder=cache_folder)
+    manifest = json.loads(cache_folder.joinpath("10.7.1-PF1", "manifest.json").read_text())
+
+    assert len(df["value"]) == 0
+    assert isinstance(df.index, pd.DatetimeIndex)
+    assert manifest["files"]["response_0.json"]["start"] is None
+    assert manifest["parts"] == []
+
+
+def test_legacy_cache_is_taken_over(tmp_path):
+    data_folder = tmp_path.joinpath("data")
+    cache_folder = tmp_path.joinpath("cache")
+    write_responses(data_folder.joinpath("10.8-PF1"),
+                    [reading("2024-01-01T00:00:00Z", "1.5"), reading("2024-01-01T01:00:00Z", "2.5")])
+    expected = data_loading.get_building_data_df(data_folder, "10.8-PF1", use_cache=False)
+    # The whole-building cache written before the store
+    os.makedirs(cache_folder)
+    expected.to_parquet(cache_folder.joinpath("10.8-PF1.parquet"))
+    stat = data_folder.joinpath("10.8-PF1", "response_0.json").stat()
+    cache_folder.joinpath("10.8-PF1.json").write_text(json.dumps([["response_0.json", stat.st_size, stat.st_mtime_ns]]))
+
+    new_rows = data_loading.ingest_building(data_folder, "10.8-PF1", cache_folder=cache_folder)
+
+    assert new_rows == 0
+    assert not cache_folder.joinpath("10.8-PF1.parquet").exists()
+    assert not cache_folder.joinpath("10.8-PF1.json").exists()
+    pd.testing.assert_frame_equal(data_loading.get_building_data_df(data_folder, "10.8-PF1", cache_folder=cache_folder),
+                                  expected)
@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.append(SRC_PATH)
+import analyse_heatwaves as hw_functions
+import plots as plot_lib
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "reports", "benchmarks")
+
+
+def synthetic_daily(station:int, start_year:int, end_year:int, seed:int=0) -> pd.DataFrame:
+    """Deterministic daily weather with the columns of Daily(...).fetch(): a seasonal cycle plus noise,
+    with a few missing days so that gaps are exercised too"""
+    rng = np.random.default_rng([seed, station])
+    index = pd.date_range(datetime(start_year, 1, 1), datetime(end_year, 12, 31), freq="D", name="time")
+    season = np.sin((index.dayofyear.to_numpy() - 105) / 365.25 * 2 * np.pi)
+    tavg = 10 + 11 * season + rng.normal(0, 3, len(index))
+    daily = pd.DataFrame({
+        "tavg": tavg,
+        "tmin": tavg - rng.uniform(4, 9, len(index)),
+        "tmax": tavg + rng.uniform(4, 9, len(index)),
+        "prcp": rng.exponential(1.5, len(index)),
+        "snow": np.nan,
+        "wdir": rng.uniform(0, 360, len(index)),
+        "wspd": rng.gamma(2, 5, len(index)),
+        "wpgt": np.nan,
+        "pres": rng.normal(1015, 8, len(index)),
+        "tsun": np.nan,
+    }, index=index).round(1)
+    daily.iloc[rng.choice(len(daily), size=len(daily) // 100, replace=False)] = np.nan
+    return daily
+
+def synthetic_hourly(station:int, start_year:int, end_year:int, seed:int=0) -> pd.DataFrame:
+    """Deterministic hourly weather with the main columns of Hourly(...).fetch(), a daily and a seasonal cycle"""
+    rng = np.random.default_rng([seed, station, 1])
+    index = pd.date_range(datetime(start_year, 1, 1), datetime(end_year, 12, 31, 23), freq="h", name="time")
+    season = np.sin((index.dayofyear.to_numpy() - 105) / 365.25 * 2 * np.pi)
+    day = np.sin((index.hour.to_numpy() - 9) / 24 * 2 * np.pi)
+    temp = 10 + 11 * season + 5 * day + rng.normal(0, 1.5, len(index))
+    return pd.DataFrame({
+        "temp": temp,
+        "dwpt": temp - rng.uniform(2, 10, len(index)),
+        "rhum": rng.uniform(30, 100, len(index)),
+        "prcp": rng.exponential(0.1, len(index)),
+        "wspd": rng.gamma(2, 5, len(index)),
+        "pres": rng.normal(1015, 8, len(index)),
+        "coco": rng.integers(1, 10, len(index)).astype(float),
+    }, index=index).round(1)
+
+def measure(func, repeat:int=3) -> dict:
+    """Best wall time out of repeat runs and the peak memory allocated during one run"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"wall_time_s": min(times), "peak_memory_mb": round(peak / 1024**2, 2)}
+
+def run_benchmarks(n_stations:int=20, n_years:int=22, repeat:int=3, seed:int=0, stages:list[str]=None) -> dict:
+    """Times each stage of the heatwave analytics on n_stations synthetic stations over n_years.
+    Meteostat is never contacted: get_daily_station and get_hourly_station are fed the synthetic series
+    through the fetch functions they import from meteo_cache.
+
+    Args:
+        n_stations (int, optional): number of synthetic stations. Defaults to 20.
+        n_years (int, optional): number of years per station. Defaults to 22.
+        repeat (int, optional): runs per stage, the fastest one is reported. Defaults to 3.
+        seed (int, optional): seed of the synthetic data. Defaults to 0.
+        stages (list[str], optional): only run these stages. Defaults to all.
+
+    Returns:
+        dict: wall time, peak memory and rows per second for every stage
+    """
+    end_year = 2024
+    start_year = end_year - n_years + 1
+    raw_daily = {f"S{s:05d}": synthetic_daily(s, start_year, end_year, seed) for s in range(n_stations)}
+    raw_hourly = {f"S{s:05d}": synthetic_hourly(s, end_year, end_year, seed) for s in range(n_stations)}
+
+    def fake_fetch(data):
+        return lambda station_id, start, end: data[station_id].loc[start:end]
+
+    hw_functions.fetch_daily = fake_fetch(raw_daily)
+    hw_functions.fetch_hourly = fake_fetch(raw_hourly)
+
+    # Inputs of the later stages, computed once outside of the timings
+    daily = {s: hw_functions.get_daily_station(s, start_year=start_year, end_year=end_year) for s in raw_daily}
+    heatwaves = {s: hw_functions.group_heatwaves_station(d) for s, d in daily.items()}
+    hot_days = {s: hw_functions.compute_hot_days_per_year(d) for s, d in daily.items()}
+    stations = pd.DataFrame({"station_id": list(raw_daily), "station_name": list(raw_daily)})
+    first = list(daily)[0]
+
+    n_daily_rows = sum(len(d) for d in daily.values())
+    n_hourly_rows = sum(len(d.loc[f"{end_year}-07-01":f"{end_year}-08-31"]) for d in raw_hourly.values())
+    all_stages = {
+        "get_daily_station": (lambda: [hw_functions.get_daily_station(s, start_year=start_year, end_year=end_year)
+                                       for s in raw_daily], n_daily_rows),
+        "get_hourly_station": (lambda: [hw_functions.get_hourly_station(s, year=end_year, start_month=7, end_month=8)
+                                        for s in raw_hourly], n_hourly_rows),
+        "group_heatwaves_station": (lambda: [hw_functions.group_heatwaves_station(d) for d in daily.values()],
+                                    n_daily_rows),
+        "compute_hot_days_per_year": (lambda: [hw_functions.compute_hot_days_per_year(d) for d in daily.values()],
+                                      n_daily_rows),
+        "compute_heat_stats": (lambda: [hw_functions.compute_heat_stats(daily[s], {"station_id": s}, hot_days=hot_days[s])
+                                        for s in daily], n_daily_rows),
+        "compute_station_pipeline": (lambda: hw_functions.compute_station_pipeline(stations, start=start_year, end=end_year),
+                                     n_daily_rows),
+        "compute_longer_heatwaves": (lambda: [hw_functions.compute_longer_heatwaves(h, 5) for h in heatwaves.values()],
+                                     sum(len(h) for h in heatwaves.values())),
+        # plot_daily adds columns to its input, so it gets a fresh copy of a single station
+        "plot_daily": (lambda: plot_lib.plot_daily(daily[first].copy(), title="benchmark", plot_value="tmax",
+                                                   highlight_column="tmax>30"), len(daily[first])),
+    }
+
+    results = {}
+    for name, (func, n_rows) in all_stages.items():
+        if stages and (name not in stages):
+            continue
+        print(f"Running {name}")
+        result = measure(func, repeat=repeat)
+        result["rows"] = n_rows
+        result["rows_per_s"] = round(n_rows / result["wall_time_s"]) if result["wall_time_s"] > 0 else None
+        results[name] = result
+    return results
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return "unknown"
+
+def compare(current:dict, baseline_path:str):
+    """Print the ratio of the current wall times to a previous result file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"Compared to {baseline['commit']} ({baseline['created_at']}):")
+    for name, result in current["results"].items():
+        if name in baseline["results"]:
+            ratio = result["wall_time_s"] / baseline["results"][name]["wall_time_s"]
+            print(f"  {name:<28} {result['wall_time_s']:>9.4f}s  x{ratio:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the heatwave analytics on synthetic station data")
+    parser.add_argument("--stations", type=int, default=20, help="number of synthetic stations")
+    parser.add_argument("--years", type=int, default=22, help="number of years per station")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stage", action="append", help="only run this stage, can be repeated")
+    parser.add_argument("--output", default=RESULTS_PATH, help="folder to write the json results to")
+    parser.add_argument("--compare", help="json result of a previous run to compare against")
+    args = parser.parse_args()
+
+    report = {
+        "commit": _git_commit(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "parameters": {"stations": args.stations, "years": args.years, "repeat": args.repeat, "seed": args.seed},
+        "environment": {"python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+                        "machine": platform.machine(), "cpus": os.cpu_count()},
+        "results": run_benchmarks(args.stations, args.years, args.repeat, args.seed, args.stage),
+    }
+
+    for name, result in report["results"].items():
+        print(f"{name:<28} {result['wall_time_s']:>9.4f}s {result['peak_memory_mb']:>9.2f}MB {result['rows_per_s']:>12} rows/s")
+
+    os.makedirs(args.output, exist_ok=True)
+    output_file = os.path.join(args.output, f"{datetime.now():%Y%m%d_%H%M%S}_{report['commit']}.json")
+    with open(output_file, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output_file}")
+
+    if args.compare:
+        compare(report, args.compare)
@@ -11,6 +11,8 @@ sys.path.append("./src/heat_waves")
 import analyse_heatwaves as hw_functions
 import plots as plot_lib
 import maps as map_lib
+import dashboard_cache as cache_lib
+import scene_jobs as scene_lib
 from landsat_pipeline import LandsatLoader
 
 st.set_page_config(layout="wide")
@@ -19,16 +21,29 @@ divider_color = 'red'
 def celcius_to_farenheit(celsius:float):
         return round((celsius * 1.8) + 32, 1)
 
+@st.fragment
+def show_landsat_scenes(scene_jobs, scene_key:str, hourly_data:pd.DataFrame):
+    """Scenes of the background search, the refresh button only reruns this block"""
+    scene_job = scene_jobs.poll(scene_key)
+    if scene_job["status"] == "failed":
+        st.markdown("Ran into trouble fetching landsat scene for this location")
+    elif scene_job["status"] != "done":
+        st.markdown("Searching Landsat scenes for this heatwave...")
+        st.button("Refresh", key="refresh_landsat_scenes")
+
+    fig_temp_ls = plot_lib.plot_temperature_and_landsat(hourly_data, scene_job["result"], unit=st.session_state.t_unit)
+    st.plotly_chart(fig_temp_ls, use_container_width=True)
+
 # Data
 DATA_DIR = "./data"
-german_cities_data_path = os.path.join(DATA_DIR, "interim", "heatwave_stats_de_10year.csv")
-try:
-    st.session_state.german_cities = pd.read_csv(german_cities_data_path)
-except:
-    st.session_state.german_cities = hw_functions.get_heat_stats_german_cities(save_path=german_cities_data_path, additional_cities=["Lindau"])
-
-drop_cols = [c for c in st.session_state.german_cities if "Unnamed" in c]
-st.session_state.german_cities.drop(drop_cols, inplace=True, axis=1) 
+# Built offline with: python src/city_cube.py --out data/processed/german_cities_cube
+# or from the existing csv: python src/city_cube.py --from-csv data/interim/heatwave_stats_de_10year.csv
+german_cities_cube_dir = os.path.join(DATA_DIR, "processed", "german_cities_cube")
+st.session_state.german_cities = cache_lib.load_german_cities(german_cities_cube_dir)
+if st.session_state.german_cities is None:
+    st.warning("The German cities statistics have not been built yet, run src/city_cube.py "
+               "(--from-csv data/interim/heatwave_stats_de_10year.csv to import the existing csv)")
+    st.session_state.german_cities = pd.DataFrame()
 
 ## Title
 IMG_DIR = "./pages/images"
@@ -73,25 +88,25 @@ st.text_input(label="Search for any City",
                 value="Prague",
                 key="location")
 
-st.session_state.stations, _ = hw_functions.get_stations_from_location(location=st.session_state.location, 
-                                                                       max_distance=30000,)
+if st.sidebar.button("Refresh data"):
+    cache_lib.clear_caches()
 
-st.session_state.stations_hw = hw_functions.compute_heat_stats_stations(st.session_state.stations,
-                                                                        start=2003,
-                                                                        end=2024) 
-st.session_state.station_comparison_location = hw_functions.compare_parameter_stations(
-    st.session_state.stations,
-    start=2003,
-    end=2024) #displayed as a carpet plot in col2
+# Stations, their heat stats and the station comparison are cached per location, radius and period
+(st.session_state.stations, 
+ st.session_state.stations_hw, 
+ st.session_state.station_comparison_location) = cache_lib.load_station_results(st.session_state.location, 
+                                                                               max_distance=30000,
+                                                                               start_year=2003,
+                                                                               end_year=2024)
 
-st.session_state.lst_gdf = gpd.read_feather("data/processed/Prague_districts_lst.feather")
+st.session_state.lst_gdf = cache_lib.load_districts_lst("data/processed/Prague_districts_lst.feather")
 st.dataframe(st.session_state.lst_gdf)
 
 col1, col2 = st.columns([1,1])
 with col1:
     st.subheader("Number of heatwave days logged by each weather station")
     m = map_lib.map_stations_with_stats(st.session_state.stations_hw, start_zoom=10)
-    city_data = st_folium(m, use_container_width=True, returned_objects=["last_object_clicked_popup"], height=400)
+    city_data = st_folium(m, use_container_width=True, returned_objects=["last_active_drawing"], height=400)
 
 with col2:
     st.subheader(f"Heatwave statistics for different stations around {st.session_state.location}")
@@ -103,14 +118,15 @@ with col2:
 
     
 ##### Station Scale     
-if city_data["last_object_clicked_popup"] is not None:
-    station_id = city_data["last_object_clicked_popup"].split(
-        "Station ID: ")[1].split("Distance")[0].replace(" ", "").replace("\n","")
-    station_name = city_data["last_object_clicked_popup"].split("Station ID: ")[0].replace("\n", "")
+# The clicked station feature, the boundary of the city has no station properties
+clicked_station = (city_data.get("last_active_drawing") or {}).get("properties") or {}
+if clicked_station.get("station_id") is not None:
+    station_id = str(clicked_station["station_id"])
+    station_name = clicked_station["station_name"]
     
-    st.session_state.daily_data = hw_functions.get_daily_station(station_id, start_year=2003, end_year=2024)
-    st.session_state.heatwaves = hw_functions.group_heatwaves_station(st.session_state.daily_data)
-    st.session_state.long_heatwaves = hw_functions.compute_longer_heatwaves(st.session_state.heatwaves, 5)
+    (st.session_state.daily_data, 
+     st.session_state.heatwaves, 
+     st.session_state.long_heatwaves) = cache_lib.load_station_daily(station_id, start_year=2003, end_year=2024, min_length=5)
     
     left, right = st.columns([6,1])
     with left:
@@ -129,7 +145,7 @@ if city_data["last_object_clicked_popup"] is not None:
     col1, col2 = st.columns([1, 1])
     with col1: 
             st.plotly_chart(
-                plot_lib.plot_daily(
+                plot_lib.plot_daily_heatmap(
                     st.session_state.daily_data,
                     title= title,
                     plot_value="tmax", 
@@ -155,7 +171,7 @@ if city_data["last_object_clicked_popup"] is not None:
     while (i<5) and (len(hourly_data)==0):
         try:
             hourly_year, hourly_start_month, hourly_end_month = st.session_state.long_heatwaves.index[0]
-            hourly_data = hw_functions.get_hourly_station(station_id, 
+            hourly_data = cache_lib.load_station_hourly(station_id, 
                                                         year=hourly_year, 
                                                         start_month=hourly_start_month, 
                                                         end_month=hourly_end_month)
@@ -169,22 +185,17 @@ if city_data["last_object_clicked_popup"] is not None:
         hourly_data["temp"] = hourly_data["temp"].apply(lambda x: celcius_to_farenheit(x))
 
     # Load Landsat
-    # this takes a while, might add a switch
-    ll = LandsatLoader(data_path=DATA_DIR)
-    try:
-        landsat_scenes = ll.get_scenes_l1(location=st.session_state.location, 
-                                        start_month=hourly_start_month, 
-                                        end_month=hourly_end_month, 
-                                        year=hourly_year)
-    except:
-        landsat_scenes = None
-        st.markdown("Ran into trouble fetching landsat scene for this location")
-    
-    fig_temp_ls = plot_lib.plot_temperature_and_landsat(hourly_data, landsat_scenes, unit=st.session_state.t_unit)
-    st.plotly_chart(fig_temp_ls, use_container_width=True)
+    # The scene search runs in the background, only the scene block is refreshed while it runs
+    scene_jobs = scene_lib.get_scene_jobs(lambda: LandsatLoader(data_path=DATA_DIR))
+    scene_jobs.submit_heatwaves(st.session_state.location, st.session_state.long_heatwaves.head(3))
+    scene_key = scene_jobs.submit(st.session_state.location,
+                                  year=hourly_year,
+                                  start_month=hourly_start_month,
+                                  end_month=hourly_end_month)
+    show_landsat_scenes(scene_jobs, scene_key, hourly_data)
 
 st.subheader("", divider=divider_color)
 
 st.write("""
 © 2024 DKSR GmbH
-""")
\ No newline at end of file
+""")
@@ -2,15 +2,19 @@ import os
 import pandas as pd
 import geopandas as gpd
 import numpy as np
-import osmnx as ox
 from tqdm import tqdm
 
 # Import Meteostat library and dependencies
 from datetime import datetime
 from shapely import wkt
-from meteostat import Point, Daily, Hourly, Stations
+from meteostat import Point
 import folium
 import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from meteo_cache import fetch_daily, fetch_hourly
+from geocode import geocode
+from station_index import get_station_index
+from result_builder import ResultAccumulator
 
 
 def get_geometry(name:str):
@@ -23,42 +27,41 @@ def get_geometry(name:str):
         a shapely geometry object (point or polygon)
     """
     try:
-        gdf = ox.geocode_to_gdf(name).to_crs("epsg:3857")
+        gdf = geocode(name).to_crs("epsg:3857")
         return gdf["geometry"]
     except:
         return None
 
 def get_stations_from_location(location: str, 
                         max_distance: int=20000, 
-                        return_map: bool=False)->tuple:
+                        return_map: bool=False,
+                        start_year: int=None,
+                        end_year: int=None)->tuple:
     """Get the stations around a location
 
     Args:
         location (str): Name of a location
         max_distance (int, optional): Search radius. Defaults to 20000.
         return_map (bool, optional): If true, this will return a folium map showing the stations. Defaults to True.
+        start_year (int, optional): skip stations without daily data after the start of this year. Defaults to None.
+        end_year (int, optional): skip stations without daily data before the end of this year. Defaults to None.
 
     Returns:
         tuple (gpd.GeoDataFrame, folium.map): Returns a geodataframe of weather stations within the search radius and a map showing them
     """
-    # Geocode the location to get a GeoDataFrame
-    location_gdf = ox.geocode_to_gdf(location)
+    # Geocode the location to get a GeoDataFrame (cached)
+    location_gdf = geocode(location)
     
     # Get latitude and longitude from the GeoDataFrame
     lat = location_gdf.loc[0, "lat"]
     lon = location_gdf.loc[0, "lon"]
         
-    # Get nearby stations
-    stations = Stations()
-    nearby_stations = stations.nearby(lat, lon).fetch(20)
+    # Get all stations within the search radius from the local station index, closest first
+    nearby_stations = get_station_index().radius(lat, lon, max_distance, start_year=start_year, end_year=end_year)
     columns_to_drop = [c for c in nearby_stations if ("start" in c) or (
         "end" in c) or any([a in c for a in ["timezone", "wmo", "icao"]])]
     nearby_stations.drop(columns_to_drop, axis=1, inplace=True)
     nearby_stations["location"] = location
-    nearby_stations.reset_index(inplace=True)
-    nearby_stations.rename(columns={"name":"station_name", "id":"station_id"}, inplace=True)
-    # Filter stations by distance and plot them
-    nearby_stations = nearby_stations.loc[nearby_stations["distance"] < max_distance, :]
 
     if not return_map:
         return nearby_stations, None
@@ -79,18 +82,134 @@ def get_stations_from_location(location: str,
         # Return the map instead of DataFrame
         return nearby_stations, m
 
+def _find_runs(mask:np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Locate every run of consecutive True values in a boolean array.
+
+    Args:
+        mask (np.ndarray): 1d boolean array
+
+    Returns:
+        tuple (np.ndarray, np.ndarray): start positions (inclusive) and end positions (exclusive) of each run
+    """
+    padded = np.concatenate(([False], mask, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return edges[::2], edges[1::2]
+
+def _events_from_runs(dates:pd.DatetimeIndex, tmax:np.ndarray, starts:np.ndarray, ends:np.ndarray) -> tuple[np.ndarray, np.ndarray, pd.DataFrame]:
+    """Turn run boundaries into per-day heatwave flags, per-day event ids and an event table.
+
+    Args:
+        dates (pd.DatetimeIndex): daily dates, one per element of tmax
+        tmax (np.ndarray): maximum daily temperature
+        starts (np.ndarray): first day of each event (inclusive)
+        ends (np.ndarray): last day of each event (exclusive)
+
+    Returns:
+        tuple (np.ndarray, np.ndarray, pd.DataFrame): heatwave day flags, event id per day (-1 outside of events)
+        and one row per event with year, annual_index, duration, tmax, start_date and end_date
+    """
+    n_days = len(tmax)
+    durations = ends - starts
+
+    # +1 at every event start and -1 after every event end, the running sum marks the days in between
+    delta = np.zeros(n_days + 1, dtype=np.int64)
+    delta[starts] = 1
+    delta[ends] -= 1
+    heatwave_day = np.cumsum(delta[:-1]) > 0
+
+    event_id = np.full(n_days, -1, dtype=np.int64)
+    event_id[heatwave_day] = np.repeat(np.arange(len(starts)), durations)
+
+    if len(starts) > 0:
+        offsets = np.concatenate(([0], np.cumsum(durations)[:-1]))
+        peak = np.maximum.reduceat(tmax[heatwave_day], offsets)
+    else:
+        peak = np.array([], dtype=float)
+
+    # Number the events within each year, starting at 1
+    years = np.asarray(dates.year[starts], dtype=np.int64)
+    year_changes = np.flatnonzero(np.diff(years)) + 1
+    year_starts = np.concatenate(([0], year_changes)) if len(years) > 0 else np.array([], dtype=np.int64)
+    year_lengths = np.diff(np.concatenate((year_starts, [len(years)])))
+    annual_number = np.arange(len(years)) - np.repeat(year_starts, year_lengths) + 1
+
+    events = pd.DataFrame({
+        "year": years,
+        "annual_index": pd.Series(years).astype(str) + "_" + pd.Series(annual_number).astype(str),
+        "duration": durations,
+        "tmax": peak,
+        "start_date": dates[starts],
+        "end_date": dates[ends - 1],
+    })
+    return heatwave_day, event_id, events
+
+def compute_heatwave_events(dates, 
+                            tmax, 
+                            tmin=None, 
+                            heatwave_threshold:float=28, 
+                            min_duration:int=3, 
+                            hot_day_threshold:float=30, 
+                            hot_night_threshold:float=20) -> tuple[dict, pd.DataFrame]:
+    """Run-length engine behind the heat indicators. Finds every run of days with tmax above the heatwave
+    threshold in a single pass over the arrays. Following the DWD, a day only counts as a heatwave day once it is 
+    at least the third (min_duration) consecutive day above 28°C, so an event starts on the third day of a run.
+    Missing temperatures never count as hot.
+
+    Args:
+        dates (array-like): daily datetime index
+        tmax (array-like): maximum daily temperature
+        tmin (array-like, optional): minimum daily temperature. Defaults to None.
+        heatwave_threshold (float, optional): tmax threshold for a heatwave. Defaults to 28.
+        min_duration (int, optional): consecutive days above the threshold before a day counts. Defaults to 3.
+        hot_day_threshold (float, optional): tmax threshold for a hot day. Defaults to 30.
+        hot_night_threshold (float, optional): tmin threshold for a hot night. Defaults to 20.
+
+    Returns:
+        tuple (dict, pd.DataFrame): a dictionary of per-day arrays ("tmax>30", "tmin>20", "rolling_28_3", 
+        "dwd_heatwave_day", "event_id") and a dataframe with one row per heatwave event
+    """
+    dates = pd.DatetimeIndex(dates)
+    tmax = np.asarray(tmax, dtype=float)
+    with np.errstate(invalid="ignore"):
+        above = tmax > heatwave_threshold
+
+    starts, ends = _find_runs(above)
+    keep = (ends - starts) >= min_duration
+    starts = starts[keep] + (min_duration - 1)
+    ends = ends[keep]
+    heatwave_day, event_id, events = _events_from_runs(dates, tmax, starts, ends)
+
+    # Equivalent of rolling(min_duration).sum().fillna(0) on the threshold flags
+    rolling = np.convolve(above, np.ones(min_duration))[:len(above)]
+    rolling[:min_duration - 1] = 0
+
+    with np.errstate(invalid="ignore"):
+        flags = {
+            f"tmax>{hot_day_threshold}": tmax > hot_day_threshold,
+            f"tmin>{hot_night_threshold}": (np.asarray(tmin, dtype=float) > hot_night_threshold) if tmin is not None else np.zeros(len(tmax), dtype=bool),
+            f"rolling_{heatwave_threshold}_{min_duration}": rolling,
+            "dwd_heatwave_day": heatwave_day,
+            "event_id": event_id,
+        }
+    return flags, events
+
 def compute_dwd_heatwave(data:pd.DataFrame):
     """ Calculate heatwave days according to the DWD
     Der Deutsche Wetterdienst (DWD) spricht von 
-    einer Hitzewelle, sobald die Temperatur an 
+    einer Hitzewelle, sobald die Temperatur an 
     mindestens drei aufeinanderfolgenden Tagen über 28°C liegt.
+    Each heatwave event also gets an "annual_index" (year_n) which is NaN outside of heatwaves.
     
-    Args: data (pd.DataFrame): a weather dataframe returned by 
+    Args: data (pd.DataFrame): a weather dataframe returned by Daily(...).fetch()
     """
-    data["tmax>28"] = data["tmax"].apply(lambda x: 1 if x > 28 else 0)
-    data["rolling_28_3"] = data["tmax>28"].rolling(3).sum().fillna(0)
-    data["dwd_heatwave_day"] = data["rolling_28_3"] >= 3    
-    data.drop(["tmax>28"], axis=1, inplace=True)
+    flags, events = compute_heatwave_events(data.index, data["tmax"])
+    data["rolling_28_3"] = flags["rolling_28_3"]
+    data["dwd_heatwave_day"] = flags["dwd_heatwave_day"]
+
+    annual_index = np.full(len(data), np.nan, dtype=object)
+    in_event = flags["event_id"] >= 0
+    annual_index[in_event] = events["annual_index"].to_numpy()[flags["event_id"][in_event]]
+    data["annual_index"] = annual_index
     return data
  
 def compute_simple_stats(df):
@@ -98,8 +217,9 @@ def compute_simple_stats(df):
     hot_days["year"] = hot_days.index.year
     hot_days['month_of_year'] = hot_days.index.month
     hot_days['day_of_year'] = hot_days.index.dayofyear
-    hot_days[f'tmax>30'] = hot_days["tmax"].apply(lambda x: True if x > 30 else False)
-    hot_days[f'tmin>20'] = hot_days["tmin"].apply(lambda x: True if x > 20 else False)
+    with np.errstate(invalid="ignore"):
+        hot_days['tmax>30'] = hot_days["tmax"].to_numpy(dtype=float) > 30
+        hot_days['tmin>20'] = hot_days["tmin"].to_numpy(dtype=float) > 20
     return hot_days
 
 def get_daily_station(station_id:str,  
@@ -125,30 +245,22 @@ def get_daily_station(station_id:str,
     start = datetime(start_year, 1, 1)
     end = datetime(end_year, 12, 31)
 
-    # Get daily data for 2018
-    data = Daily(station_id, start, end)
-    data = data.fetch()
+    # Get daily data, served from the local cache where possible
+    data = fetch_daily(station_id, start, end)
 
-    # Create a DataFrame with a datetime index from start to end
+    # Reindex to every day from start to end
     date_range = pd.date_range(start, end, freq='D')
-    all_days = pd.DataFrame(index=date_range)
 
     if len(data) > 0:
-        data = all_days.merge(data, how='left', left_index=True, right_index=True)
+        data = data.reindex(date_range)
         hot_days = compute_simple_stats(data)
         
         if (parameter != "") and (threshold != 100):
             print(parameter, threshold)
-            hot_days[f'{parameter}>{threshold}'] = hot_days[parameter].apply(lambda x: 1 if x > threshold else 0)
+            hot_days[f'{parameter}>{threshold}'] = (hot_days[parameter] > threshold).astype(int)
 
         if heatwave_definition == "dwd":
             hot_days = compute_dwd_heatwave(hot_days)
-            # Assign a unique id to each heatwave event
-            heatwaves = pd.DataFrame(hot_days.loc[hot_days["dwd_heatwave_day"]==True, "day_of_year"].diff().fillna(hot_days["day_of_year"])).rename(columns={"day_of_year":"days_elapsed"})
-            heatwaves["year"] = heatwaves.index.year
-            heatwaves["annual_index"] = heatwaves["year"].astype(str) + '_' + heatwaves.groupby('year')['days_elapsed'].apply(lambda x: (x > 1).cumsum()).values.astype(str)
-            heatwaves.drop("year", inplace=True, axis=1)
-            hot_days = pd.merge(hot_days, heatwaves, how='outer', left_index=True, right_index=True)
 
         return hot_days
     else:
@@ -174,9 +286,8 @@ def get_hourly_station(station_id:str,
     start = datetime(year, start_month, 1)
     end = datetime(year, end_month, 31)
 
-    # Get daily data for 2018
-    data = Hourly(station_id, start, end)
-    data = data.fetch()
+    # Get hourly data, served from the local cache where possible
+    data = fetch_hourly(station_id, start, end)
 
     # Create a DataFrame with a datetime index from start to end
     date_range = pd.date_range(start, end, freq='H')
@@ -214,38 +325,26 @@ def get_daily_temperature_location(location:str,
     Returns:
         pd.DataFrame: _description_
     """
-    nearby_stations, _ = get_stations_from_location(location, return_map=False)
-    
-    # Set time period
-    start = datetime(start_year, 1, 1)
-    end = datetime(end_year, 12, 31)
+    # Only consider stations whose inventory covers the requested years
+    nearby_stations, _ = get_stations_from_location(location, return_map=False, 
+                                                    start_year=start_year, end_year=end_year)
 
     # Loop through nearby_stations until some data is found
-    data = pd.DataFrame()
-    i = 0
-    while (len(data) == 0) and (i<10) and (i<len(nearby_stations)):
-        if i>0:
-            print(f"No results for {location}")
-
-        metadata = nearby_stations.reset_index().iloc[i, :]
-        location_name = metadata["station_name"]
-        print(f"Fetching daily weather for {location_name}")
-        data = Daily(metadata["station_id"], start, end)
-        data = data.fetch()
-
+    daily_df = pd.DataFrame()
+    for i in range(min(10, len(nearby_stations))):
+        metadata = nearby_stations.iloc[i, :]
+        print(f"Fetching daily weather for {metadata['station_name']}")
         daily_df = get_daily_station(station_id = metadata["station_id"],  
                               start_year=start_year, 
                               end_year=end_year,
                               heatwave_definition=heatwave_definition, 
                               parameter=parameter, 
                               threshold=threshold)
-        
-        i += 1
+        if len(daily_df) > 0:
+            break
+        print(f"No results for {location}")
 
-    if len(data) > 0:
-        return daily_df
-    else:
-        return pd.DataFrame()
+    return daily_df
     
 def group_heatwaves_station(station_daily_data:pd.DataFrame)->pd.DataFrame:
     """The DWD definition returns a boolean for whether a single day is a heatwave day. This function 
@@ -258,16 +357,19 @@ def group_heatwaves_station(station_daily_data:pd.DataFrame)->pd.DataFrame:
     Returns:
         pd.DataFrame: a dataframe where each row is an individual heatwave event for the weather station
     """
-    heatwaves = station_daily_data.copy().reset_index().rename(columns={"index":"start_date"})
-    heatwaves["end_date"] = heatwaves["start_date"]
-    heatwaves = heatwaves.loc[:, ["year", "annual_index", "tavg", "tmax", "start_date", "end_date"]].groupby(["year", "annual_index"]).agg({"tavg":"count", "tmax":"max", "start_date":"min", "end_date":"max"}).rename(columns={"tavg":"duration"})
-    heatwaves.reset_index(inplace=True)
+    tmax = station_daily_data["tmax"].to_numpy(dtype=float)
+    if "dwd_heatwave_day" in station_daily_data.columns:
+        heatwave_day = station_daily_data["dwd_heatwave_day"].to_numpy(dtype=bool, na_value=False)
+        starts, ends = _find_runs(heatwave_day)
+        _, _, heatwaves = _events_from_runs(pd.DatetimeIndex(station_daily_data.index), tmax, starts, ends)
+    else:
+        _, heatwaves = compute_heatwave_events(station_daily_data.index, tmax)
     return heatwaves
 
 def compute_hot_days_per_year(daily_df:pd.DataFrame) -> pd.DataFrame:
     """A wrapper around group_heatwaves_station which returns a dataframe where every row is a year.
     This is useful to show the number of heatwaves per year, longest heatwave, total number of heatwave days,
-    hot days (T>30°C) and hot nights (T>20°C)
+    hot days (T>30°C) and hot nights (T>20°C). Years without a heatwave have 0 heatwaves of length 0.
 
     Args:
         daily_df (pd.DataFrame): the output of get_station_daily
@@ -278,13 +380,12 @@ def compute_hot_days_per_year(daily_df:pd.DataFrame) -> pd.DataFrame:
     annual_hot_days = daily_df.loc[:, ["year", "tmax>30", "tmin>20", "dwd_heatwave_day"]].groupby("year").sum()
     
     heatwaves = group_heatwaves_station(daily_df)
-    longest_heatwave_per_year = heatwaves.loc[:, ["year", "duration"]].groupby("year").agg("max").rename(columns={"duration":"longest_heatwave"})
-    n_heatwaves_per_year = heatwaves.loc[:, ["year", "duration"]].groupby("year").agg("count").rename(columns={"duration":"n_heatwaves"})
-
-    heatwaves_per_year = pd.concat([annual_hot_days, longest_heatwave_per_year, n_heatwaves_per_year], axis=1)
-    return heatwaves_per_year
+    per_year = heatwaves.groupby("year")["duration"].agg(["max", "count"]).reindex(annual_hot_days.index, fill_value=0)
+    annual_hot_days["longest_heatwave"] = per_year["max"].to_numpy()
+    annual_hot_days["n_heatwaves"] = per_year["count"].to_numpy()
+    return annual_hot_days
 
-def compute_heat_stats(daily_df:pd.DataFrame, metadata:dict, additional_columns:list[str]=[])->dict:
+def compute_heat_stats(daily_df:pd.DataFrame, metadata:dict, additional_columns:list[str]=[], hot_days:pd.DataFrame=None)->dict:
     """Returns a dictionary representing a single weather station. The dictionary can be used to populate 
     a geodataframe and show heatwave trends on a map. The trends are assumed to be linear and calculated on 
     the output of compute_hot_days_per_year
@@ -293,12 +394,14 @@ def compute_heat_stats(daily_df:pd.DataFrame, metadata:dict, additional_columns:
         daily_df (pd.DataFrame): the output of get_daily_station
         metadata (dict): a single row of the dataframe created by compute_heat_stats_stations 
         additional_columns (list[str], optional): _description_. Defaults to [].
+        hot_days (pd.DataFrame, optional): the output of compute_hot_days_per_year, if already computed. Defaults to None.
 
     Returns:
         dict: 24 key value pairs with heat indicator trends for each station
     """
     # Sum and trend of hot days, hot nights, and DWD heatwave days
-    hot_days = compute_hot_days_per_year(daily_df)
+    if hot_days is None:
+        hot_days = compute_hot_days_per_year(daily_df)
     totals_dict = hot_days.sum().to_dict()
     totals_dict = ({f"{k}_total":v for k, v in totals_dict.items()})
 
@@ -312,9 +415,81 @@ def compute_heat_stats(daily_df:pd.DataFrame, metadata:dict, additional_columns:
     
     return {**metadata, **{"n_years":len(hot_days)}, **totals_dict, **trends_dict}
 
+STATION_OUTPUTS = ("stats", "comparison", "annual")
+
+def _summarise_station_stats(records:ResultAccumulator) -> pd.DataFrame:
+    """Builds the per-station stats table from the dictionaries returned by compute_heat_stats"""
+    if len(records) == 0:
+        return None
+    stations_heat_stats = records.to_frame()
+    for metric in ["tmax>30", "tmin>20", "dwd_heatwave_day", "n_heatwaves"]:
+        stations_heat_stats[f"{metric}_mean"] = round(stations_heat_stats[f"{metric}_total"] / stations_heat_stats["n_years"], 1)
+    return stations_heat_stats
+
+def _compare_parameters(dict_of_dfs:dict) -> dict:
+    """Builds one station x year matrix per column of compute_hot_days_per_year"""
+    parameter_dicts = {}
+    if len(dict_of_dfs) == 0:
+        return parameter_dicts
+    columns = list(dict_of_dfs.values())[0].columns
+    for parameter in columns:
+        param_df = pd.DataFrame({k:v.loc[:, parameter] for k, v in dict_of_dfs.items()}).T
+        param_df["total"] = param_df.sum(axis=1)
+        param_df = param_df.sort_values(by="total", ascending=False)
+        parameter_dicts[parameter] = param_df
+    return parameter_dicts
+
+def compute_station_pipeline(stations:pd.DataFrame, 
+                             start:int=2013, 
+                             end:int=2023, 
+                             outputs:tuple=("stats", "comparison")) -> dict:
+    """Loads the daily data of every station exactly once and derives all requested outputs from it. 
+    compute_heat_stats_stations and compare_parameter_stations are thin wrappers around this function, 
+    call it directly when both are needed for the same stations.
+
+    Args:
+        stations (pd.DataFrame): output of get_stations_from_location
+        start (int, optional): Analysis start year. Defaults to 2013.
+        end (int, optional): Analysis end year. Defaults to 2023.
+        outputs (tuple, optional): any of "stats" (the table of compute_heat_stats_stations), "comparison" 
+        (the dictionary of compare_parameter_stations) and "annual" (compute_hot_days_per_year of every station 
+        in long format). Defaults to ("stats", "comparison").
+
+    Returns:
+        dict: a dictionary with one entry per requested output
+    """
+    unknown = [o for o in outputs if o not in STATION_OUTPUTS]
+    if unknown:
+        raise ValueError(f"Unknown outputs {unknown}, choose from {STATION_OUTPUTS}")
+
+    records = ResultAccumulator(dtypes={"n_years": "int64"})
+    annual = {}
+    for idx in range(0, len(stations)):
+        row = stations.iloc[idx, :].to_dict()
+        daily = get_daily_station(station_id=row["station_id"], start_year=start, end_year=end)
+        if len(daily) == 0:
+            continue
+
+        hot_days = compute_hot_days_per_year(daily)
+        if "stats" in outputs:
+            records.append(compute_heat_stats(daily, row, hot_days=hot_days))
+        annual[(row["station_id"], row["station_name"])] = hot_days
+
+    results = {}
+    if "stats" in outputs:
+        results["stats"] = _summarise_station_stats(records)
+    if "comparison" in outputs:
+        results["comparison"] = _compare_parameters({name:df for (_, name), df in annual.items()})
+    if "annual" in outputs:
+        if annual:
+            results["annual"] = pd.concat(annual, names=["station_id", "station_name"]).reset_index()
+        else:
+            results["annual"] = pd.DataFrame()
+    return results
+
 def compute_heat_stats_stations(stations:pd.DataFrame, save_path:str="", start:int=2013, end:int=2023) -> pd.DataFrame: 
-    """Loops through a dataframe of stations containing a column called "station_id" and runs compute_heat_stats for
-    each station. Once the loop is complete, mean metrics for some heatwave parameters are calculated in this function.
+    """Runs compute_heat_stats for each station of a dataframe of stations containing a column called "station_id". 
+    Once the loop is complete, mean metrics for some heatwave parameters are calculated in this function.
 
     Args:
         stations (pd.DataFrame): output of get_stations_from_location
@@ -325,23 +500,10 @@ def compute_heat_stats_stations(stations:pd.DataFrame, save_path:str="", start:i
     Returns:
         pd.DataFrame: a dataframe where each row represents a weather station
     """
-    stations_heat_stats = None
-    for idx in range(0, len(stations)):
-        row = stations.iloc[idx, :].to_dict()
-        daily = get_daily_station(station_id=row["station_id"], start_year = start, end_year = end)
-        if len(daily) > 0:
-            s_stats = compute_heat_stats(daily, row)
-            if stations_heat_stats is not None:
-                stations_heat_stats = pd.concat([stations_heat_stats, pd.DataFrame(s_stats, index=[0])], ignore_index=True)
-            else:
-                stations_heat_stats = pd.DataFrame(s_stats, index=[0])
-
-    if stations_heat_stats is not None:
-        for metric in ["tmax>30", "tmin>20", "dwd_heatwave_day", "n_heatwaves"]:
-            stations_heat_stats[f"{metric}_mean"] = round(stations_heat_stats[f"{metric}_total"] / stations_heat_stats["n_years"], 1)
-        
-        if save_path != "":
-            stations_heat_stats.to_csv(save_path)
+    stations_heat_stats = compute_station_pipeline(stations, start=start, end=end, outputs=("stats",))["stats"]
+
+    if (stations_heat_stats is not None) and (save_path != ""):
+        stations_heat_stats.to_csv(save_path)
 
     return stations_heat_stats
 
@@ -371,82 +533,139 @@ def compare_parameter_stations(stations:pd.DataFrame, start:int=2013, end:int=20
 
     Args:
         stations (pd.DataFrame): pd.DataFrame
+        start (int, optional): Analysis start year. Defaults to 2013.
+        end (int, optional): Analysis end year. Defaults to 2024.
 
     Returns:
         dict: a dictionary of dataframes corresponding to each column of compute_hot_days_per_year.
     """
-    dict_of_dfs = {}
-    for i, row in stations.iterrows():
-        daily_data = get_daily_station(row["station_id"], start_year=start, end_year=end)
-        if len(daily_data)>0:
-            dict_of_dfs[row["station_name"]] = compute_hot_days_per_year(daily_data)
+    return compute_station_pipeline(stations, start=start, end=end, outputs=("comparison",))["comparison"]
+
+
+# German cities with population > 100,000
+GROSSSTAEDTE = ['Berlin', 'Hamburg', 'Muenchen', 'Koeln', 
+    'Frankfurt am Main', 'Stuttgart', 'Duesseldorf', 'Leipzig', 
+    'Dortmund', 'Essen', 'Bremen', 'Dresden', 'Hannover', 'Nuernberg', 
+    'Duisburg', 'Bochum', 'Wuppertal', 'Bielefeld', 'Bonn', 'Muenster, Deutschland', 
+    'Mannheim', 'Karlsruhe', 'Augsburg', 'Wiesbaden', 'Moenchengladbach', 
+    'Gelsenkirchen', 'Aachen', 'Braunschweig', 'Chemnitz', 'Kiel', 'Halle', 
+    'Magdeburg', 'Freiburg im Breisgau', 'Krefeld', 'Mainz', 'Luebeck', 'Erfurt',
+    'Oberhausen', 'Rostock', 'Kassel', 'Hagen', 'Potsdam', 'Saarbruecken', 
+    'Hamm', 'Ludwigshafen am Rhein', 'Oldenburg', 'Muelheim an der Ruhr', 
+    'Osnabrueck', 'Leverkusen', 'Heidelberg', 'Darmstadt', 'Solingen', 
+    'Regensburg', 'Herne', 'Paderborn', 'Neuss', 'Ingolstadt',
+    'Offenbach am Main', 'Fuerth', 'Ulm', 'Heilbronn', 'Pforzheim', 
+    'Wuerzburg', 'Wolfsburg', 'Goettingen', 'Bottrop', 'Reutlingen', 
+    'Erlangen', 'Bremerhaven', 'Koblenz', 'Bergisch Gladbach', 'Remscheid', 
+    'Trier', 'Recklinghausen', 'Jena', 'Moers', 'Salzgitter', 'Siegen', 
+    'Guetersloh', 'Hildesheim', 'Hanau']
+
+def heat_stats_city(city:str, start:int, end:int, outputs:tuple=None):
+    """Station search and heat statistics for a single city. Used by the workers of get_heat_stats_german_cities
+    and city_cube.build_city_cube
 
-    parameter_dicts = {}
-    columns = list(dict_of_dfs.values())[0].columns
-    for parameter in columns:
-        param_df = pd.DataFrame({k:v.loc[:, parameter] for k, v in dict_of_dfs.items()}).T
-        param_df["total"] = param_df.sum(axis=1)
-        param_df = param_df.sort_values(by="total", ascending=False)
-        parameter_dicts[parameter] = param_df
-    return parameter_dicts
+    Args:
+        city (str): name of the city
+        start (int): Analysis start year
+        end (int): Analysis end year
+        outputs (tuple, optional): outputs of compute_station_pipeline to return as a dictionary. Defaults to
+        None, which returns the table of compute_heat_stats_stations.
+    """
+    stations, _ = get_stations_from_location(city, max_distance=20000, start_year=start, end_year=end)
+
+    # Expand the search if no stations are found within 20km
+    if len(stations)<2:
+        stations, _ = get_stations_from_location(city, max_distance=40000, start_year=start, end_year=end)
 
+    if outputs is None:
+        return compute_heat_stats_stations(stations, start=start, end=end)
+    return compute_station_pipeline(stations, start=start, end=end, outputs=outputs)
 
-def get_heat_stats_german_cities(save_path:str="", additional_cities:list[str]=[], start:int=2013, end:int=2023):
+def map_cities(cities:list[str], city_function, n_workers:int=4):
+    """Runs city_function(city) for every city in a pool of n_workers threads and yields (city, result) in the
+    order the cities finish. A city which raises is reported and yields None as result instead of stopping the run.
+    """
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(city_function, city): city for city in cities}
+        for future in (pbar := tqdm(as_completed(futures), total=len(futures))):
+            city = futures[future]
+            pbar.set_description(f"Fetched data for {city}")
+            try:
+                result = future.result()
+            except Exception as e:
+                warnings.warn(f"Failed to compute heat stats for {city}: {e}")
+                result = None
+            yield city, result
+
+def _append_checkpoint(stats:pd.DataFrame, checkpoint_path:str):
+    """Append the rows of one city to the checkpoint csv, keeping the column order of the existing file"""
+    if os.path.exists(checkpoint_path):
+        columns = pd.read_csv(checkpoint_path, nrows=0).columns
+        stats.reindex(columns=columns).to_csv(checkpoint_path, mode="a", header=False, index=False)
+    else:
+        stats.to_csv(checkpoint_path, index=False)
+
+def get_heat_stats_german_cities(save_path:str="", 
+                                 additional_cities:list[str]=[], 
+                                 start:int=2013, 
+                                 end:int=2023, 
+                                 n_workers:int=4, 
+                                 checkpoint_path:str=""):
     """Loop through a list of cities, identify heatwave indicators and summarize the statistics. 
-    Loops through German cities with population > 1,000,000 by default. Takes a while to run so it is recommended to 
-    save the result
+    Loops through German cities with population > 100,000 by default. Cities are processed concurrently by a 
+    pool of n_workers threads, while requests to Nominatim and Meteostat are rate limited per host (see rate_limit.py).
+    Every finished city is appended to a checkpoint csv, so an interrupted run resumes where it stopped. Cities which 
+    already appear in save_path or the checkpoint are skipped, and a city which fails is reported and left out 
+    instead of stopping the run.
 
     Args:
         save_path (str, optional): Path to save the resulting dataframe as csv. Defaults to "".
         additional_cities (list[str], optional): optional list of cities to add to the dataframe. Defaults to [].
         start (int, optional): year to start the analysis. Defaults to 2013.
         end (int, optional): year to end the analysis. Defaults to 2023.
+        n_workers (int, optional): number of cities processed at the same time. Defaults to 4.
+        checkpoint_path (str, optional): csv the finished cities are appended to. Defaults to save_path with a 
+        "_checkpoint" suffix.
 
     Returns:
-        _type_: _description_
+        pd.DataFrame: a dataframe where each row represents a weather station, the city is in the "location" column
     """
-    GROSSSTAEDTE = ['Berlin', 'Hamburg', 'Muenchen', 'Koeln', 
-        'Frankfurt am Main', 'Stuttgart', 'Duesseldorf', 'Leipzig', 
-        'Dortmund', 'Essen', 'Bremen', 'Dresden', 'Hannover', 'Nuernberg', 
-        'Duisburg', 'Bochum', 'Wuppertal', 'Bielefeld', 'Bonn', 'Muenster, Deutschland', 
-        'Mannheim', 'Karlsruhe', 'Augsburg', 'Wiesbaden', 'Moenchengladbach', 
-        'Gelsenkirchen', 'Aachen', 'Braunschweig', 'Chemnitz', 'Kiel', 'Halle', 
-        'Magdeburg', 'Freiburg im Breisgau', 'Krefeld', 'Mainz', 'Luebeck', 'Erfurt',
-        'Oberhausen', 'Rostock', 'Kassel', 'Hagen', 'Potsdam', 'Saarbruecken', 
-        'Hamm', 'Ludwigshafen am Rhein', 'Oldenburg', 'Muelheim an der Ruhr', 
-        'Osnabrueck', 'Leverkusen', 'Heidelberg', 'Darmstadt', 'Solingen', 
-        'Regensburg', 'Herne', 'Paderborn', 'Neuss', 'Ingolstadt',
-        'Offenbach am Main', 'Fuerth', 'Ulm', 'Heilbronn', 'Pforzheim', 
-        'Wuerzburg', 'Wolfsburg', 'Goettingen', 'Bottrop', 'Reutlingen', 
-        'Erlangen', 'Bremerhaven', 'Koblenz', 'Bergisch Gladbach', 'Remscheid', 
-        'Trier', 'Recklinghausen', 'Jena', 'Moers', 'Salzgitter', 'Siegen', 
-        'Guetersloh', 'Hildesheim', 'Hanau']
-
-    if os.path.exists(save_path):
-        hw_stats_gs = pd.read_csv(save_path)
-    else:
-        hw_stats_gs = None
-
-    for gs in (pbar := tqdm(GROSSSTAEDTE+additional_cities)):
-        pbar.set_description(f"Fetching data for {gs}")
-        
-        if (hw_stats_gs is not None) and (gs in hw_stats_gs.columns):
+    if (checkpoint_path == "") and (save_path != ""):
+        root, ext = os.path.splitext(save_path)
+        checkpoint_path = f"{root}_checkpoint{ext or '.csv'}"
+
+    # Resume from previous results
+    completed = []
+    for path in [save_path, checkpoint_path]:
+        if (path != "") and os.path.exists(path):
+            previous = pd.read_csv(path)
+            completed.append(previous.drop([c for c in previous.columns if "Unnamed" in c], axis=1))
+    done = set(pd.concat(completed)["location"]) if completed else set()
+    cities = [c for c in GROSSSTAEDTE + additional_cities if c not in done]
+
+    results = ResultAccumulator()
+    for previous in completed:
+        results.append_frame(previous)
+    failed = []
+    for city, stats in map_cities(cities, lambda city: heat_stats_city(city, start, end), n_workers=n_workers):
+        if (stats is None) or (len(stats) == 0):
+            warnings.warn(f"No station data found for {city}")
+            failed.append(city)
             continue
-        else:
-            stations, _ = get_stations_from_location(gs, max_distance=20000)
 
-            # Expand the search if no stations are found within 20km
-            if len(stations)<2:
-                stations, _ = get_stations_from_location(gs, max_distance=40000)
+        results.append_frame(stats)
+        if checkpoint_path != "":
+            _append_checkpoint(stats, checkpoint_path)
 
-            stations_stats = compute_heat_stats_stations(stations)
-            if hw_stats_gs is not None:
-                    hw_stats_gs = pd.concat([hw_stats_gs, stations_stats], ignore_index=True)
-            else:
-                hw_stats_gs = stations_stats
+    if failed:
+        print(f"No results for {len(failed)} cities: {failed}")
 
-    if save_path!="":
+    hw_stats_gs = results.to_frame() if len(results) > 0 else None
+
+    if (save_path != "") and (hw_stats_gs is not None):
         hw_stats_gs.to_csv(save_path) # will overwrite existing
+        # Everything in the checkpoint is now part of save_path
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
 
     return hw_stats_gs
-
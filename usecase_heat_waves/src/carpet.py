@@ -0,0 +1,120 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from config import LOCAL_TIMEZONE
+
+CARPET_CACHE_SIZE = 256
+
+_carpets = OrderedDict()
+_carpets_lock = threading.Lock()
+
+
+def _fingerprint(index:pd.DatetimeIndex, values:np.ndarray) -> str:
+    """Hash of the timestamps and values of a column, much cheaper than rebuilding its carpet"""
+    digest = hashlib.blake2b(index.asi8.tobytes(), digest_size=16)
+    digest.update(np.ascontiguousarray(values).tobytes())
+    return digest.hexdigest()
+
+def _wall_time(index, tz:str=LOCAL_TIMEZONE) -> pd.DatetimeIndex:
+    """Timestamps as wall time of tz, so days start at local midnight. Naive timestamps are taken to be
+    wall time already."""
+    index = pd.DatetimeIndex(pd.to_datetime(index))
+    if index.tz is not None:
+        index = index.tz_convert(tz).tz_localize(None)
+    return index
+
+def _wall_timestamp(timestamp, tz:str=LOCAL_TIMEZONE) -> pd.Timestamp:
+    timestamp = pd.Timestamp(timestamp)
+    return timestamp.tz_convert(tz).tz_localize(None) if timestamp.tzinfo is not None else timestamp
+
+def _slots(index:pd.DatetimeIndex, start=None, end=None, freq:str="1h") -> tuple:
+    """Selected rows, their position in the flattened (day, slot) grid, the days and the slots per day"""
+    step = pd.Timedelta(freq)
+    slots_per_day = int(pd.Timedelta("1D") / step)
+    selected = np.ones(len(index), dtype=bool)
+    if start is not None:
+        selected &= index >= start
+    if end is not None:
+        selected &= index <= end
+    times = index[selected]
+    if len(times) == 0:
+        return selected, np.array([], dtype=np.int64), pd.DatetimeIndex([]), slots_per_day
+
+    first_day = times.min().normalize()
+    n_days = (times.max().normalize() - first_day).days + 1
+    positions = np.asarray((times - first_day) // step, dtype=np.int64)
+    days = pd.date_range(first_day, periods=n_days, freq="D")
+    return selected, positions, days, slots_per_day
+
+def carpet_matrices(df:pd.DataFrame, columns:list=None, start=None, end=None, freq:str="1h",
+                    tz:str=LOCAL_TIMEZONE) -> tuple:
+    """Day x time of day matrices of many columns at once, the replacement for a pivot_table per column.
+    The timestamps are binned into slots of freq, so regularly sampled data is simply reshaped to
+    (days, slots); days or slots without data are NaN and several values in one slot are averaged.
+    Results are memoized per column content, range and freq, so flipping back to a column is free.
+
+    Args:
+        df (pd.DataFrame): values indexed by timestamp, eg. the wide frames of MicroclimateFrame or get_measure
+        columns (list, optional): columns to build. Defaults to all columns.
+        start (optional): first timestamp to include. Defaults to None.
+        end (optional): last timestamp to include. Defaults to None.
+        freq (str, optional): length of one slot, has to divide a day. Defaults to "1h".
+        tz (str, optional): time zone of the days, for timezone aware timestamps. Defaults to LOCAL_TIMEZONE.
+
+    Returns:
+        tuple (np.ndarray, pd.DatetimeIndex, np.ndarray): values of shape (len(columns), days, slots), the days
+        and the time of day of the slots in hours
+    """
+    if columns is None:
+        columns = list(df.columns)
+    index = _wall_time(df.index, tz)
+    wall_start = _wall_timestamp(start, tz) if start is not None else None
+    wall_end = _wall_timestamp(end, tz) if end is not None else None
+    selected, positions, days, slots_per_day = _slots(index, wall_start, wall_end, freq)
+    hours = np.arange(slots_per_day) * (pd.Timedelta(freq) / pd.Timedelta("1h"))
+    size = len(days) * slots_per_day
+
+    values = df.loc[:, columns].to_numpy(dtype=np.float64)
+    keys = [(column, str(wall_start), str(wall_end), freq, _fingerprint(index, values[:, i])) for i, column in enumerate(columns)]
+    result = np.empty((len(columns), len(days), slots_per_day))
+    missing = []
+    with _carpets_lock:
+        for i, key in enumerate(keys):
+            if key in _carpets:
+                _carpets.move_to_end(key)
+                result[i] = _carpets[key]
+            else:
+                missing.append(i)
+
+    if len(missing) > 0:
+        # One bincount for all missing columns: column i fills the bins i * size ... (i + 1) * size
+        block = values[selected][:, missing]
+        valid = ~np.isnan(block)
+        bins = (positions[:, None] + np.arange(len(missing)) * size)[valid]
+        sums = np.bincount(bins, weights=block[valid], minlength=len(missing) * size)
+        counts = np.bincount(bins, minlength=len(missing) * size)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            matrices = np.where(counts > 0, sums / counts, np.nan).reshape(len(missing), len(days), slots_per_day)
+
+        with _carpets_lock:
+            for matrix, i in zip(matrices, missing):
+                result[i] = matrix
+                _carpets[keys[i]] = matrix
+            while len(_carpets) > CARPET_CACHE_SIZE:
+                _carpets.popitem(last=False)
+
+    return result, days, hours
+
+def carpet_frame(df:pd.DataFrame, column, start=None, end=None, freq:str="1h", tz:str=LOCAL_TIMEZONE) -> pd.DataFrame:
+    """Carpet of one column as a frame with the time of day in hours as index and the days as columns,
+    the layout of the former pivot_table in plot_hourly_carpet"""
+    matrices, days, hours = carpet_matrices(df, [column], start=start, end=end, freq=freq, tz=tz)
+    return pd.DataFrame(matrices[0].T, index=pd.Index(hours, name="daytime"), columns=pd.Index(days, name="date"))
+
+def clear_carpet_cache():
+    with _carpets_lock:
+        _carpets.clear()
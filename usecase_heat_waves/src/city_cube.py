@@ -0,0 +1,231 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import warnings
+from datetime import datetime, timezone
+
+import pandas as pd
+from filelock import FileLock
+
+import analyse_heatwaves as hw_functions
+
+CITY_CUBE_DIR = os.path.join("data", "processed", "german_cities_cube")
+# Increase when the layout or the columns of the cube change, older cubes are then rejected
+CUBE_FORMAT = 1
+
+# Columns of the station table used by maps.map_scatter_mapbox and maps.map_px_scattermap
+MAP_COLUMNS = ["location", "station_id", "station_name", "latitude", "longitude",
+               "tmax>30_mean", "dwd_heatwave_day_mean", "dwd_heatwave_day_trend"]
+ANNUAL_METRICS = ["tmax>30", "tmin>20", "dwd_heatwave_day", "longest_heatwave", "n_heatwaves"]
+
+
+def _typed_stations(stats:pd.DataFrame) -> pd.DataFrame:
+    stats = stats.drop([c for c in stats.columns if "Unnamed" in c], axis=1)
+    stats["station_id"] = stats["station_id"].astype(str)
+    stats["location"] = stats["location"].astype("category")
+    return stats.sort_values(["location", "station_id"]).reset_index(drop=True)
+
+def _typed_annual(annual:pd.DataFrame) -> pd.DataFrame:
+    annual = annual.astype({"station_id": str, "year": "int16"})
+    annual = annual.astype({c: "int32" for c in ANNUAL_METRICS if c in annual.columns})
+    annual["location"] = annual["location"].astype("category")
+    return annual.sort_values(["location", "year", "station_id"]).reset_index(drop=True)
+
+def _city_years(annual:pd.DataFrame) -> pd.DataFrame:
+    """Mean of every annual metric over the stations of a city, with the number of stations per year"""
+    metrics = [c for c in ANNUAL_METRICS if c in annual.columns]
+    grouped = annual.groupby(["location", "year"], observed=True)
+    city_years = grouped[metrics].mean().round(2).astype("float32")
+    city_years["n_stations"] = grouped["station_id"].nunique().astype("int16")
+    return city_years.reset_index()
+
+def _write_parquet(df:pd.DataFrame, path:str) -> dict:
+    """Write atomically and return the manifest entry of the file"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return {"file": os.path.basename(path), "rows": len(df), "columns": list(df.columns)}
+
+def read_manifest(cube_dir:str=CITY_CUBE_DIR) -> dict:
+    """The manifest of the current cube version, None if no cube was built in cube_dir"""
+    path = os.path.join(cube_dir, "manifest.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != CUBE_FORMAT:
+        warnings.warn(f"City cube in {cube_dir} has format {manifest.get('format')}, expected {CUBE_FORMAT}. Rebuild it.")
+        return None
+    return manifest
+
+def build_city_cube(cube_dir:str=CITY_CUBE_DIR,
+                    additional_cities:list[str]=[],
+                    start:int=2013,
+                    end:int=2023,
+                    n_workers:int=4,
+                    keep_versions:int=2) -> dict:
+    """Compute the heat stats of all German cities (GROSSSTAEDTE and additional_cities) once and store them for
+    the dashboard, which only reads slices of the result:
+        cube_dir/v0003/stations.parquet    one row per station and city, the table of get_heat_stats_german_cities
+        cube_dir/v0003/annual.parquet      hot days per station and year (compute_hot_days_per_year)
+        cube_dir/v0003/city_years.parquet  mean of the annual metrics over the stations of each city and year
+        cube_dir/manifest.json             version, period, station set and files of the current version
+    Every build writes a new version directory and then switches the manifest, so a running dashboard never
+    reads a half written cube. Cities which fail are left out and listed in the manifest.
+
+    Args:
+        cube_dir (str, optional): root of the cube. Defaults to CITY_CUBE_DIR.
+        additional_cities (list[str], optional): cities to add to GROSSSTAEDTE. Defaults to [].
+        start (int, optional): year to start the analysis. Defaults to 2013.
+        end (int, optional): year to end the analysis. Defaults to 2023.
+        n_workers (int, optional): number of cities processed at the same time. Defaults to 4.
+        keep_versions (int, optional): number of versions kept on disk, including the new one. Defaults to 2.
+
+    Returns:
+        dict: the new manifest
+    """
+    cities = list(dict.fromkeys(hw_functions.GROSSSTAEDTE + additional_cities))
+    city_function = lambda city: hw_functions.heat_stats_city(city, start, end, outputs=("stats", "annual"))
+    stats = []
+    annual = []
+    failed = []
+    for city, results in hw_functions.map_cities(cities, city_function, n_workers=n_workers):
+        if (results is None) or (results["stats"] is None) or (len(results["stats"]) == 0):
+            warnings.warn(f"No station data found for {city}")
+            failed.append(city)
+            continue
+        stats.append(results["stats"].assign(location=city))
+        annual.append(results["annual"].assign(location=city))
+
+    if len(stats) == 0:
+        raise RuntimeError("No city could be computed, the current cube is kept")
+
+    stations = _typed_stations(pd.concat(stats, ignore_index=True))
+    annual = _typed_annual(pd.concat(annual, ignore_index=True))
+    tables = {"stations": stations, "annual": annual, "city_years": _city_years(annual)}
+    return _write_version(cube_dir, tables, start, end, failed, keep_versions)
+
+def import_stats_csv(csv_path:str, cube_dir:str=CITY_CUBE_DIR, start:int=2013, end:int=2023, keep_versions:int=2) -> dict:
+    """Store an existing csv of get_heat_stats_german_cities (eg. data/interim/heatwave_stats_de_10year.csv) as a
+    cube version without recomputing anything. Only the stations table is available, the annual tables
+    need a full build_city_cube.
+
+    Args:
+        csv_path (str): the csv
+        cube_dir (str, optional): root of the cube. Defaults to CITY_CUBE_DIR.
+        start (int, optional): first year of the csv. Defaults to 2013.
+        end (int, optional): last year of the csv. Defaults to 2023.
+        keep_versions (int, optional): number of versions kept on disk, including the new one. Defaults to 2.
+
+    Returns:
+        dict: the new manifest
+    """
+    stations = _typed_stations(pd.read_csv(csv_path, dtype={"station_id": str}))
+    return _write_version(cube_dir, {"stations": stations}, start, end, [], keep_versions,
+                          source=os.path.basename(csv_path))
+
+def _write_version(cube_dir:str, tables:dict, start:int, end:int, failed:list, keep_versions:int, source:str="build") -> dict:
+    """Write the tables to a new version directory, then switch the manifest to it and prune old versions.
+    Concurrent builds into the same cube_dir wait for each other, so they don't write the same version."""
+    os.makedirs(cube_dir, exist_ok=True)
+    with FileLock(os.path.join(cube_dir, "manifest.json.lock")):
+        return _write_version_locked(cube_dir, tables, start, end, failed, keep_versions, source)
+
+def _write_version_locked(cube_dir:str, tables:dict, start:int, end:int, failed:list, keep_versions:int, source:str) -> dict:
+    stations = tables["stations"]
+    previous = read_manifest(cube_dir)
+    version = previous["version"] + 1 if previous else 1
+    version_dir = os.path.join(cube_dir, f"v{version:04d}")
+    os.makedirs(version_dir, exist_ok=True)
+    files = {name: _write_parquet(df, os.path.join(version_dir, f"{name}.parquet")) for name, df in tables.items()}
+
+    station_set = {city: sorted(group["station_id"].unique().tolist())
+                   for city, group in stations.groupby("location", observed=True)}
+    manifest = {
+        "format": CUBE_FORMAT,
+        "version": version,
+        "directory": os.path.basename(version_dir),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "source": source,
+        "period": {"start": start, "end": end},
+        "cities": sorted(station_set),
+        "failed_cities": sorted(failed),
+        "station_set": station_set,
+        "station_set_hash": hashlib.sha256(json.dumps(station_set, sort_keys=True).encode()).hexdigest(),
+        "files": files,
+    }
+    fd, tmp_path = tempfile.mkstemp(dir=cube_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, os.path.join(cube_dir, "manifest.json"))
+
+    # Old versions are removed only after the switch
+    versions = sorted(d for d in os.listdir(cube_dir) if d.startswith("v") and os.path.isdir(os.path.join(cube_dir, d)))
+    for old in versions[:-keep_versions]:
+        shutil.rmtree(os.path.join(cube_dir, old), ignore_errors=True)
+
+    print(f"City cube v{version:04d} ({source}): {len(stations)} stations in {len(station_set)} cities, {len(failed)} failed")
+    return manifest
+
+def load_cube_table(table:str,
+                    cube_dir:str=CITY_CUBE_DIR,
+                    cities:list[str]=None,
+                    years:list[int]=None,
+                    columns:list[str]=None,
+                    manifest:dict=None) -> pd.DataFrame:
+    """Read a slice of one table of the current cube, only the requested cities, years and columns are read
+
+    Args:
+        table (str): "stations", "annual" or "city_years"
+        cube_dir (str, optional): root of the cube. Defaults to CITY_CUBE_DIR.
+        cities (list[str], optional): values of the "location" column. Defaults to all cities.
+        years (list[int], optional): years of the annual tables. Defaults to all years.
+        columns (list[str], optional): columns to read. Defaults to all columns.
+        manifest (dict, optional): manifest of the version to read. Defaults to the current one.
+
+    Returns:
+        pd.DataFrame: the slice, None if there is no cube or the cube has no such table
+    """
+    manifest = manifest if manifest is not None else read_manifest(cube_dir)
+    if (manifest is None) or (table not in manifest["files"]):
+        return None
+    filters = []
+    if cities is not None:
+        filters.append(("location", "in", list(cities)))
+    if years is not None:
+        filters.append(("year", "in", [int(y) for y in years]))
+    path = os.path.join(cube_dir, manifest["directory"], manifest["files"][table]["file"])
+    return pd.read_parquet(path, columns=columns, filters=filters or None)
+
+def load_map_data(cube_dir:str=CITY_CUBE_DIR, cities:list[str]=None, parameters:list[str]=[],
+                  manifest:dict=None) -> pd.DataFrame:
+    """The station columns needed by map_scatter_mapbox and map_px_scattermap (MAP_COLUMNS and parameters)"""
+    columns = list(dict.fromkeys(MAP_COLUMNS + list(parameters)))
+    return load_cube_table("stations", cube_dir, cities=cities, columns=columns, manifest=manifest)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the heat stats cube of the German cities for the dashboard")
+    parser.add_argument("--out", default=CITY_CUBE_DIR)
+    parser.add_argument("--start", type=int, default=2013)
+    parser.add_argument("--end", type=int, default=2023)
+    parser.add_argument("--additional", nargs="*", default=["Lindau"], help="cities added to GROSSSTAEDTE")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--from-csv", default="", help="import an existing get_heat_stats_german_cities csv instead")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    if args.from_csv != "":
+        import_stats_csv(args.from_csv, args.out, start=args.start, end=args.end)
+    else:
+        build_city_cube(args.out, additional_cities=args.additional, start=args.start, end=args.end, n_workers=args.workers)
@@ -0,0 +1,10 @@
+import os
+
+# Root of all local caches of the heat wave use case. Can be moved with the HEATWAVE_CACHE_DIR env variable
+CACHE_DIR = os.environ.get("HEATWAVE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "heatwaves"))
+
+# Local copy of the Golemio microclimate measurements, partitioned by measure, point and month
+MICROCLIMATE_STORE_DIR = os.environ.get("MICROCLIMATE_STORE_DIR", os.path.join(CACHE_DIR, "microclimate"))
+
+# Time zone of the dashboard, days of the Golemio data (UTC) start at local midnight of this zone
+LOCAL_TIMEZONE = os.environ.get("HEATWAVE_TIMEZONE", "Europe/Prague")
@@ -0,0 +1,160 @@
+import os
+import copy
+import time
+import threading
+import functools
+from datetime import timedelta
+
+import pandas as pd
+import geopandas as gpd
+
+import analyse_heatwaves as hw_functions
+import city_cube
+
+CACHE_BACKEND = os.environ.get("HEATWAVE_CACHE_BACKEND", "streamlit")
+CACHE_TTLS = {
+    "stations": timedelta(days=1),
+    "station_results": timedelta(hours=6),
+    "station_daily": timedelta(hours=6),
+    "station_hourly": timedelta(hours=6),
+    "districts_lst": timedelta(days=1),
+    "german_cities": timedelta(days=1),
+}
+# Entry points built from other cached entry points, they are cleared together
+CACHE_DEPENDENCIES = {
+    "station_results": ["stations"],
+}
+
+_cached_functions = {}
+
+
+def _memory_cache(ttl:timedelta):
+    """Minimal replacement for st.cache_data: results are kept per arguments for ttl and returned as copies"""
+    def decorator(func):
+        entries = {}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            with lock:
+                entry = entries.get(key)
+            if (entry is None) or (time.monotonic() - entry[0] > ttl.total_seconds()):
+                entry = (time.monotonic(), func(*args, **kwargs))
+                with lock:
+                    entries[key] = entry
+            return copy.deepcopy(entry[1])
+
+        def clear():
+            with lock:
+                entries.clear()
+
+        wrapper.clear = clear
+        return wrapper
+    return decorator
+
+def memoize(name:str):
+    """Cache a data access function under the TTL configured in CACHE_TTLS[name]. Streamlit reruns the whole 
+    page on every widget interaction, so only what actually changed should be recomputed. With the "streamlit" 
+    backend st.cache_data is used, results are shared between sessions and every caller gets its own copy. 
+    Set HEATWAVE_CACHE_BACKEND=memory to use a plain in-process cache instead (eg. in notebooks or scripts).
+
+    Args:
+        name (str): a key of CACHE_TTLS, also used to clear the cache with clear_caches
+    """
+    def decorator(func):
+        if CACHE_BACKEND == "streamlit":
+            # Only imported for this backend, so scripts and notebooks don't need streamlit
+            import streamlit as st
+            cached = st.cache_data(ttl=CACHE_TTLS[name], show_spinner=False)(func)
+        else:
+            cached = _memory_cache(CACHE_TTLS[name])(func)
+        _cached_functions[name] = cached
+        return cached
+    return decorator
+
+def clear_caches(*names:str):
+    """Invalidate the given entry points, or all of them if no name is given. The entry points they are built
+    from and the ones built from them (CACHE_DEPENDENCIES) are invalidated too, so no stale result survives."""
+    names = set(names or _cached_functions.keys())
+    related = {name: set(CACHE_DEPENDENCIES.get(name, [])) for name in _cached_functions}
+    for name, dependencies in CACHE_DEPENDENCIES.items():
+        for dependency in dependencies:
+            related.setdefault(dependency, set()).add(name)
+    pending = list(names)
+    while pending:
+        for other in related.get(pending.pop(), set()) - names:
+            names.add(other)
+            pending.append(other)
+    for name in names:
+        _cached_functions[name].clear()
+
+
+@memoize("stations")
+def load_stations(location:str, max_distance:int, start_year:int, end_year:int) -> pd.DataFrame:
+    """Cached get_stations_from_location without the map"""
+    stations, _ = hw_functions.get_stations_from_location(location=location,
+                                                          max_distance=max_distance,
+                                                          start_year=start_year,
+                                                          end_year=end_year)
+    return stations
+
+@memoize("station_results")
+def load_station_results(location:str, max_distance:int, start_year:int, end_year:int) -> tuple:
+    """Stations around a location with their heat stats and the station comparison matrices
+
+    Args:
+        location (str): name of a location
+        max_distance (int): search radius in meters
+        start_year (int): analysis start year
+        end_year (int): analysis end year
+
+    Returns:
+        tuple (pd.DataFrame, pd.DataFrame, dict): stations, the output of compute_heat_stats_stations
+        and the output of compare_parameter_stations
+    """
+    stations = load_stations(location, max_distance, start_year, end_year)
+    results = hw_functions.compute_station_pipeline(stations,
+                                                    start=start_year,
+                                                    end=end_year,
+                                                    outputs=("stats", "comparison"))
+    return stations, results["stats"], results["comparison"]
+
+@memoize("station_daily")
+def load_station_daily(station_id:str, start_year:int, end_year:int, min_length:int=5) -> tuple:
+    """Daily data of a station with its heatwave events
+
+    Returns:
+        tuple (pd.DataFrame, pd.DataFrame, pd.DataFrame): the outputs of get_daily_station,
+        group_heatwaves_station and compute_longer_heatwaves
+    """
+    daily = hw_functions.get_daily_station(station_id, start_year=start_year, end_year=end_year)
+    heatwaves = hw_functions.group_heatwaves_station(daily)
+    long_heatwaves = hw_functions.compute_longer_heatwaves(heatwaves, min_length)
+    return daily, heatwaves, long_heatwaves
+
+@memoize("station_hourly")
+def load_station_hourly(station_id:str, year:int, start_month:int, end_month:int) -> pd.DataFrame:
+    """Cached get_hourly_station"""
+    return hw_functions.get_hourly_station(station_id, year=year, start_month=start_month, end_month=end_month)
+
+def load_districts_lst(path:str) -> gpd.GeoDataFrame:
+    """Reads the district LST file, the file is read again whenever it changes on disk"""
+    return _load_districts_lst(path, os.path.getmtime(path))
+
+@memoize("districts_lst")
+def _load_districts_lst(path:str, mtime:float) -> gpd.GeoDataFrame:
+    return gpd.read_feather(path)
+
+def load_german_cities(cube_dir:str) -> pd.DataFrame:
+    """Map columns (city_cube.MAP_COLUMNS) of the German cities cube, read again when a new version is built.
+    Returns None if there is no cube yet, the page only reads it: build it with city_cube.py (--from-csv to
+    import an existing csv of get_heat_stats_german_cities)."""
+    manifest = city_cube.read_manifest(cube_dir)
+    if manifest is None:
+        return None
+    return _load_german_cities(cube_dir, manifest["version"])
+
+@memoize("german_cities")
+def _load_german_cities(cube_dir:str, version:int) -> pd.DataFrame:
+    return city_cube.load_map_data(cube_dir)
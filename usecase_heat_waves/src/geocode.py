@@ -0,0 +1,165 @@
+import os
+import re
+import sys
+import argparse
+import tempfile
+import threading
+import warnings
+from contextlib import contextmanager
+
+import pandas as pd
+import geopandas as gpd
+import osmnx as ox
+from tqdm import tqdm
+
+from config import CACHE_DIR
+from rate_limit import get_limiter
+
+GEOCODE_CACHE_DIR = os.path.join(CACHE_DIR, "geocode")
+GAZETTEER_PATH = os.path.join(GEOCODE_CACHE_DIR, "gazetteer.parquet")
+# All osmnx http caching (the json files which used to end up in ./cache next to each notebook) goes to one place
+OSMNX_CACHE_DIR = os.path.join(CACHE_DIR, "osmnx")
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+_osmnx_lock = threading.Lock()
+
+
+def normalize_query(query:str) -> str:
+    """Cache key of a geocoding query: lower case, single spaces and ", " between parts
+
+    Args:
+        query (str): eg. "Muenster,  Deutschland"
+
+    Returns:
+        str: eg. "muenster, deutschland"
+    """
+    query = " ".join(query.lower().split())
+    return re.sub(r"\s*,\s*", ", ", query)
+
+def _load_gazetteer() -> dict:
+    """Reads the gazetteer from disk once per process. Maps normalized queries to single row geodataframes."""
+    global _gazetteer
+    if _gazetteer is None:
+        _gazetteer = {}
+        if os.path.exists(GAZETTEER_PATH):
+            try:
+                gdf = gpd.read_parquet(GAZETTEER_PATH)
+                for query, row in gdf.groupby("query", sort=False):
+                    _gazetteer[query] = row.drop("query", axis=1).reset_index(drop=True)
+            except Exception as e:
+                warnings.warn(f"Ignoring unreadable geocode cache {GAZETTEER_PATH}: {e}")
+    return _gazetteer
+
+def _save_gazetteer():
+    """Writes the whole gazetteer as a single GeoParquet file, atomically"""
+    if len(_gazetteer) == 0:
+        return
+    gdf = pd.concat([row.assign(query=query) for query, row in _gazetteer.items()], ignore_index=True)
+    gdf = gpd.GeoDataFrame(gdf, geometry="geometry", crs="epsg:4326")
+    os.makedirs(GEOCODE_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=GEOCODE_CACHE_DIR, suffix=".tmp")
+    os.close(fd)
+    try:
+        gdf.to_parquet(tmp_path)
+        os.replace(tmp_path, GAZETTEER_PATH)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+@contextmanager
+def _osmnx_cache():
+    """Caches the osmnx requests in OSMNX_CACHE_DIR and restores the global ox.settings afterwards"""
+    with _osmnx_lock:
+        previous = (ox.settings.use_cache, ox.settings.cache_folder)
+        ox.settings.use_cache = True
+        ox.settings.cache_folder = OSMNX_CACHE_DIR
+        try:
+            yield
+        finally:
+            ox.settings.use_cache, ox.settings.cache_folder = previous
+
+def _geocode_remote(query:str) -> gpd.GeoDataFrame:
+    with get_limiter("nominatim"), _osmnx_cache():
+        gdf = ox.geocode_to_gdf(query)
+    return gdf.to_crs("epsg:4326").reset_index(drop=True)
+
+def geocode(query:str, use_cache:bool=True, save:bool=True) -> gpd.GeoDataFrame:
+    """Cached drop-in replacement for ox.geocode_to_gdf. Results are kept in a GeoParquet gazetteer keyed
+    by the normalized query, so every place is only sent to Nominatim once and known places work offline.
+
+    Args:
+        query (str): name of a location (city, street, etc.)
+        use_cache (bool, optional): if False, always ask Nominatim and refresh the cache. Defaults to True.
+        save (bool, optional): write new results to disk straight away. Defaults to True.
+
+    Returns:
+        gpd.GeoDataFrame: the output of ox.geocode_to_gdf (crs epsg:4326)
+    """
+    key = normalize_query(query)
+    with _gazetteer_lock:
+        gazetteer = _load_gazetteer()
+        if use_cache and (key in gazetteer):
+            return gazetteer[key].copy()
+
+    gdf = _geocode_remote(query)
+
+    with _gazetteer_lock:
+        gazetteer[key] = gdf
+        if save:
+            _save_gazetteer()
+    return gdf.copy()
+
+def preload_geocodes(queries:list[str], refresh:bool=False) -> list[str]:
+    """Bulk import a list of places into the gazetteer, eg. GROSSSTAEDTE before a batch run.
+    The gazetteer is written once at the end.
+
+    Args:
+        queries (list[str]): list of location names
+        refresh (bool, optional): geocode places which are already cached again. Defaults to False.
+
+    Returns:
+        list[str]: the queries which could not be geocoded
+    """
+    failed = []
+    for query in (pbar := tqdm(queries)):
+        pbar.set_description(f"Geocoding {query}")
+        try:
+            geocode(query, use_cache=not refresh, save=False)
+        except Exception as e:
+            warnings.warn(f"Failed to geocode {query}: {e}")
+            failed.append(query)
+
+    with _gazetteer_lock:
+        _save_gazetteer()
+    return failed
+
+def clear_geocode_cache():
+    """Forget all cached geocodes"""
+    global _gazetteer
+    with _gazetteer_lock:
+        _gazetteer = None
+        if os.path.exists(GAZETTEER_PATH):
+            os.remove(GAZETTEER_PATH)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preload the geocode cache")
+    parser.add_argument("queries", nargs="*", help="places to geocode")
+    parser.add_argument("--file", help="text file with one place per line")
+    parser.add_argument("--german-cities", action="store_true", help="preload GROSSSTAEDTE from analyse_heatwaves")
+    parser.add_argument("--refresh", action="store_true", help="geocode cached places again")
+    args = parser.parse_args()
+
+    queries = list(args.queries)
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            queries += [line.strip() for line in f if line.strip() != ""]
+    if args.german_cities:
+        from analyse_heatwaves import GROSSSTAEDTE
+        queries += GROSSSTAEDTE
+
+    failed = preload_geocodes(queries, refresh=args.refresh)
+    print(f"Geocoded {len(queries) - len(failed)} of {len(queries)} places into {GAZETTEER_PATH}")
+    sys.exit(1 if failed else 0)
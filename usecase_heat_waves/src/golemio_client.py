@@ -0,0 +1,189 @@
+import os
+import json
+import random
+import warnings
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import numpy as np
+import pandas as pd
+
+GOLEMIO_URL = "https://api.golemio.cz"
+GOLEMIO_KEY = os.environ.get("GOLEMIO_KEY")
+MEASUREMENTS_PATH = "/v2/microclimate/measurements"
+
+PAGE_SIZE = 10000
+MAX_CONCURRENCY = 8
+MAX_RETRIES = 5
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def measurement_params(id:int=None, measure:str="", start_date:str="", end_date:str="") -> dict:
+    """Query parameters of /v2/microclimate/measurements. Ids ending in 0 are locations, all others are points.
+
+    Args:
+        id (int, optional): location or point id. Defaults to None.
+        measure (str, optional): eg. "air_temp". Defaults to "".
+        start_date (str, optional): ISO timestamp. Defaults to "".
+        end_date (str, optional): ISO timestamp. Defaults to "".
+
+    Returns:
+        dict: the query parameters
+    """
+    params = {}
+    if id:
+        params["locationId" if int(id % 10) == 0 else "pointId"] = id
+    if measure != "":
+        params["measure"] = measure
+    if start_date != "":
+        params["from"] = start_date
+    if end_date != "":
+        params["to"] = end_date
+    return params
+
+def records_to_frame(records:list[dict]) -> pd.DataFrame:
+    """Measurement records to a typed dataframe: float values, integer ids, categorical measure/unit and
+    a datetime measured_at column"""
+    df = pd.DataFrame.from_records(records)
+    if "value" in df.columns:
+        df["value"] = pd.to_numeric(df["value"], errors="coerce").astype(np.float64)
+    for col in ["sensor_id", "point_id", "location_id"]:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+    for col in ["measure", "unit"]:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    if "measured_at" in df.columns:
+        df["measured_at"] = pd.to_datetime(df["measured_at"])
+    return df
+
+
+class GolemioClient:
+    """Async client for the Golemio API with a pooled connection, bounded concurrency, automatic limit/offset
+    paging and exponential backoff on 429 and 5xx responses. Use it as an async context manager:
+
+        async with GolemioClient() as client:
+            frames = await client.get_measurements_many([{"pointId": 2, "measure": "air_temp"}, ...])
+
+    Each page is parsed into a typed dataframe as soon as it arrives, so memory is bounded by the page size
+    instead of the size of the whole response.
+    """
+
+    def __init__(self, api_key:str=None, max_concurrency:int=MAX_CONCURRENCY, page_size:int=PAGE_SIZE,
+                 timeout:float=60, max_retries:int=MAX_RETRIES):
+        self.api_key = api_key if api_key is not None else GOLEMIO_KEY
+        self.max_concurrency = max_concurrency
+        self.page_size = page_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._session = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._session = aiohttp.ClientSession(
+            base_url=GOLEMIO_URL,
+            headers={"X-Access-Token": self.api_key or "", "Accept": "application/json"},
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._session.close()
+
+    async def get_json(self, path:str, params:dict=None):
+        """GET a path and decode the json response, retrying with exponential backoff (honouring Retry-After)
+        on rate limits, server errors and connection problems"""
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                async with self._semaphore:
+                    async with self._session.get(path, params=params) as response:
+                        if response.status == 200:
+                            return json.loads(await response.read())
+                        if response.status not in RETRY_STATUS:
+                            raise RuntimeError(f"Failed to retrieve data: {response.status} {await response.text()}")
+                        retry_after = response.headers.get("Retry-After")
+                        error = RuntimeError(f"Failed to retrieve data: {response.status}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+
+            if attempt == self.max_retries:
+                raise error
+            delay = min(2 ** attempt, 60) + random.uniform(0, 1)
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            await asyncio.sleep(delay)
+
+    async def get_paginated(self, path:str, params:dict=None) -> pd.DataFrame:
+        """Follow limit/offset paging until the last page. The server may cap the limit below the page size,
+        so the effective page size is learned from the first page: paging ends with an empty page, or with
+        a later page shorter than the first one.
+
+        Returns:
+            pd.DataFrame: all records of all pages, typed with records_to_frame
+        """
+        params = dict(params or {})
+        frames = []
+        offset = 0
+        effective_size = None
+        while True:
+            page = await self.get_json(path, {**params, "limit": self.page_size, "offset": offset})
+            if len(page) == 0:
+                break
+            frames.append(records_to_frame(page))
+            offset += len(page)
+            if effective_size is None:
+                effective_size = len(page)
+            elif len(page) < effective_size:
+                break
+        if len(frames) == 0:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    async def get_measurements(self, params:dict) -> pd.DataFrame:
+        """All measurements matching the parameters of measurement_params"""
+        return await self.get_paginated(MEASUREMENTS_PATH, params)
+
+    async def get_measurements_many(self, params_list:list[dict], return_exceptions:bool=False) -> list[pd.DataFrame]:
+        """Measurements for many (id, measure) queries at once. Returns one dataframe per query, in order.
+        A query which fails is reported and returns an empty dataframe (or its exception if return_exceptions),
+        the other queries are not affected."""
+        results = await asyncio.gather(*[self.get_measurements(params) for params in params_list],
+                                       return_exceptions=True)
+        frames = []
+        for params, result in zip(params_list, results):
+            if isinstance(result, Exception) and not return_exceptions:
+                warnings.warn(f"Failed to retrieve measurements for {params}: {result}")
+                result = pd.DataFrame()
+            frames.append(result)
+        return frames
+
+
+def run_sync(coro):
+    """Run a coroutine from synchronous code, also inside an already running event loop (jupyter)"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+def fetch_measurements(params_list:list[dict], api_key:str=None, return_exceptions:bool=False,
+                       **client_kwargs) -> list[pd.DataFrame]:
+    """Synchronous wrapper around GolemioClient.get_measurements_many
+
+    Args:
+        params_list (list[dict]): one dictionary of measurement_params per query
+        api_key (str, optional): Golemio API key. Defaults to the GOLEMIO_KEY env variable.
+        return_exceptions (bool, optional): return the exception of a failed query instead of an empty
+            dataframe, to tell failures from queries without data. Defaults to False.
+
+    Returns:
+        list[pd.DataFrame]: one dataframe of typed measurements per query
+    """
+    async def fetch():
+        async with GolemioClient(api_key=api_key, **client_kwargs) as client:
+            return await client.get_measurements_many(params_list, return_exceptions=return_exceptions)
+    return run_sync(fetch())
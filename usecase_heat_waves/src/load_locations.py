@@ -1,7 +1,6 @@
 import os
 import sys
 import streamlit as st
-import requests
 import folium
 import pandas as pd
 import geopandas as gpd
@@ -21,55 +20,57 @@ GOLEMIO_KEY = os.environ.get("GOLEMIO_KEY")
 sys.path.append(os.path.join(SRC_PATH, "heat_waves"))
 import analyse_heatwaves as analyse_heatwaves
 import plots as plot_lib
+from result_builder import ResultAccumulator
+from golemio_client import MEASUREMENTS_PATH, measurement_params, fetch_measurements
+from microclimate_store import MicroclimateStore
+from microclimate_frame import MicroclimateFrame
 
 
 
-def get_golemio(data:str, golemio_key:str) -> dict:
-    url = 'https://api.golemio.cz/' + data
-    headers = {"X-Access-Token": golemio_key,
-            'Accept': 'application/json'}
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        data = response.json()
-        return data
-    else:
-        print(f"Failed to retrieve data: {response.status_code}")
-        return response.text
-
-def get_measurement(id:int=None, measure:str="", start_date:str="", end_date:str=""):
-    if id:
-        if (int(id%10) == 0):
-            id_str = f"locationId={id}"
-        else:
-            id_str = f"pointId={id}"
-    else:
-        id_str = ""
-    if measure != "":
-        measure_str = f"&measure={measure}"
-    else:
-        measure_str = ""
-    if start_date != "":
-        start_str = f"&from={start_date}"
-    else:
-        start_str = ""
-    if end_date != "":
-        end_str = f"&to={end_date}"
-    else:
-        end_str = ""
-
-    query = f'/v2/microclimate/measurements?{id_str}{measure_str}{start_str}{end_str}'
-    print(query)
-    measurements = get_golemio(query, GOLEMIO_KEY)
-    measurements_df = pd.DataFrame.from_dict(measurements)
-
+def _prepare_measurements(measurements_df:pd.DataFrame) -> pd.DataFrame:
     # Set datetime index
     if "measured_at" in measurements_df.columns:
         measurements_df["measured_at"] = pd.to_datetime(measurements_df.measured_at)
         measurements_df["measured_at"] = measurements_df["measured_at"].dt.round(freq="min")
         measurements_df.set_index("measured_at", inplace=True)
-    
     return measurements_df
 
+def get_measurement(id:int=None, measure:str="", start_date:str="", end_date:str=""):
+    params = measurement_params(id=id, measure=measure, start_date=start_date, end_date=end_date)
+    print(f"{MEASUREMENTS_PATH} {params}")
+    # Paged, so large responses are no longer truncated
+    measurements_df = fetch_measurements([params], api_key=GOLEMIO_KEY)[0]
+    return _prepare_measurements(measurements_df)
+
+def get_measurements(queries:list[tuple[int, str]], start_date:str="", end_date:str="",
+                     use_store:bool=True) -> list[pd.DataFrame]:
+    """Fetch several (id, measure) pairs concurrently over one pooled connection
+
+    Args:
+        queries (list[tuple[int, str]]): (point or location id, measure) pairs
+        start_date (str, optional): ISO timestamp. Defaults to "".
+        end_date (str, optional): ISO timestamp. Defaults to "".
+        use_store (bool, optional): only download the parts of the period which are not stored yet into 
+            the local MicroclimateStore and read the period from there. Defaults to True.
+
+    Returns:
+        list[pd.DataFrame]: the output of get_measurement for every pair, in order
+    """
+    if not use_store:
+        params_list = [measurement_params(id=id, measure=m, start_date=start_date, end_date=end_date) for id, m in queries]
+        return [_prepare_measurements(df) for df in fetch_measurements(params_list, api_key=GOLEMIO_KEY)]
+
+    store = MicroclimateStore()
+    store.sync_pairs(queries, start_date=start_date, end_date=end_date, api_key=GOLEMIO_KEY)
+    return [_prepare_measurements(store.read(id, m, start_date=start_date, end_date=end_date)) for id, m in queries]
+
+def get_measurements_frame(queries:list[tuple[int, str]], start_date:str="", end_date:str="",
+                           use_store:bool=True) -> MicroclimateFrame:
+    """Like get_measurements, but returns one tidy MicroclimateFrame with categorical point ids and measures
+    and float32 values instead of a dataframe per pair. See get_measurements for the arguments."""
+    measurements = get_measurements(queries, start_date=start_date, end_date=end_date, use_store=use_store)
+    return MicroclimateFrame.from_measurements(measurements, queries)
+
 def compute_hourly(df):
     df_raw = df.copy()
     metadata = df_raw.iloc[0,:].drop("value")
@@ -86,38 +87,65 @@ def compute_daily(df):
     daily = data.resample("1D").agg(["max", "mean", "min"]).round(1)
     return daily, metadata
 
+def aggregate_measurements(measurements:list[pd.DataFrame], keys:list) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Hourly means and daily max/mean/min of many raw measurement frames in one pass. All values are 
+    stacked into one long frame and grouped once by (key, hour); the daily statistics are combined from 
+    the hourly sums, counts, maxima and minima, so the raw data is never resampled twice. Gives the same
+    values as compute_hourly and compute_daily per frame followed by a join.
+
+    Args:
+        measurements (list[pd.DataFrame]): outputs of get_measurement, indexed by measured_at
+        keys (list): column name of each frame in the result, eg. the measure or the point id
+
+    Returns:
+        tuple (pd.DataFrame, pd.DataFrame, pd.DataFrame): hourly means with one column per key, daily 
+        statistics with the columns {key}_max, {key}_mean and {key}_min, and the metadata of every frame
+    """
+    frames = [(key, df) for key, df in zip(keys, measurements) if ("value" in df.columns) and (len(df) > 0)]
+    for key, df in zip(keys, measurements):
+        if ("value" not in df.columns) or (len(df) == 0):
+            print(f"{key} has length {len(df)}")
+    if len(frames) == 0:
+        return pd.DataFrame(), pd.DataFrame(), pd.DataFrame()
+
+    metadata_records = ResultAccumulator()
+    for _, df in frames:
+        metadata_records.append(df.iloc[0].drop("value").to_dict())
+
+    # Only the values travel into the long frame, the metadata columns are not copied
+    long = pd.concat([pd.DataFrame({"key": np.int32(i), "value": df["value"].to_numpy(dtype=np.float64)}, index=df.index)
+                      for i, (_, df) in enumerate(frames)])
+    hours = long.index.floor("h")
+    hourly_parts = long["value"].groupby([long["key"].to_numpy(), hours]).agg(["sum", "count", "max", "min"])
+    hourly_parts.index.names = ["key", "time"]
+
+    days = hourly_parts.index.get_level_values("time").floor("D")
+    daily_parts = hourly_parts.groupby([hourly_parts.index.get_level_values("key"), days]).agg(
+        {"sum": "sum", "count": "sum", "max": "max", "min": "min"})
+    daily_parts.index.names = ["key", "time"]
+
+    names = [key for key, _ in frames]
+    hourly = (hourly_parts["sum"] / hourly_parts["count"]).unstack("key")
+    hourly = hourly.reindex(pd.date_range(hourly.index.min(), hourly.index.max(), freq="h"))
+    hourly.columns = [names[i] for i in hourly.columns]
+
+    daily_stats = pd.DataFrame({"max": daily_parts["max"],
+                                "mean": daily_parts["sum"] / daily_parts["count"],
+                                "min": daily_parts["min"]}).unstack("key")
+    daily_stats = daily_stats.reindex(pd.date_range(daily_stats.index.min(), daily_stats.index.max(), freq="D"))
+    order = [(stat, i) for i in range(len(names)) for stat in ["max", "mean", "min"]]
+    daily = daily_stats.reindex(columns=pd.MultiIndex.from_tuples(order))
+    daily.columns = [f"{names[i]}_{stat}" for stat, i in order]
+
+    hourly.index.name = daily.index.name = "measured_at"
+    return hourly.round(1), daily.round(1), metadata_records.to_frame()
+
 def get_id_hourly_daily(id:int, measures: List[str], 
                         start_date: str="", 
                         end_date: str="", 
                         save_path:str="") -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-    id_hourly_df = pd.DataFrame()
-    id_daily_df = pd.DataFrame()
-    metadata_df = pd.DataFrame()
-
-    for m in measures:
-        this_measure = get_measurement(id=id, measure=m, start_date=start_date, end_date=end_date)
-        try:
-            this_measure_hourly, metadata = compute_hourly(this_measure)
-            # append metadata
-            if len(metadata_df) == 0:
-                metadata_df = pd.DataFrame(metadata).T
-            else:
-                metadata_df.loc[len(metadata_df)] = metadata
-            # append hourly
-            if len(id_hourly_df) == 0:
-                id_hourly_df = this_measure_hourly
-            else: 
-                id_hourly_df = id_hourly_df.join(this_measure_hourly, how="outer")
-            
-            this_measure_daily, _ = compute_daily(this_measure)
-            # append daily
-            if len(id_daily_df) == 0:
-                id_daily_df = this_measure_daily
-            else: 
-                id_daily_df = id_daily_df.join(this_measure_daily, how="outer")
-            
-        except:
-            print(f"{m} has length {len(this_measure)}")
+    all_measures = get_measurements([(id, m) for m in measures], start_date=start_date, end_date=end_date)
+    id_hourly_df, id_daily_df, metadata_df = aggregate_measurements(all_measures, measures)
     
     # Write to csv
     date_str = ""
@@ -127,8 +155,6 @@ def get_id_hourly_daily(id:int, measures: List[str],
         date_str += f"-{end_date.split('T')[0]}"
     else:
         date_str += f"-{datetime.today().strftime('%Y-%m-%d')}"
-    # Flatten multilayer columns
-    id_daily_df.columns = id_daily_df.columns.map('_'.join)
 
     if save_path != "":
         if not os.path.exists(save_path):
@@ -143,41 +169,8 @@ def get_measure(ids:list[int], measure: str,
                         start_date: str="", 
                         end_date: str="", 
                         save_path:str="") -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-    df_hourly = pd.DataFrame()
-    df_daily = pd.DataFrame()
-    metadata_df = pd.DataFrame()
-
-    for id in ids:
-        this_measure = get_measurement(id=id, measure=measure, start_date=start_date, end_date=end_date)
-        try:
-            this_measure_hourly, metadata = compute_hourly(this_measure)
-            this_measure_hourly.rename(columns={measure:id}, inplace=True)
-            # append metadata
-            if len(metadata_df) == 0:
-                metadata_df = pd.DataFrame(metadata).T
-            else:
-                metadata_df.loc[len(metadata_df)] = metadata
-
-            # append hourly
-            if len(df_hourly) == 0:
-                df_hourly = this_measure_hourly
-            else: 
-                df_hourly = df_hourly.join(this_measure_hourly, how="outer")
-            
-            this_measure_daily, _ = compute_daily(this_measure)
-            this_measure_daily.rename(columns={measure:id}, inplace=True)
-
-            # append daily
-            if len(df_daily) == 0:
-                df_daily = this_measure_daily
-            else: 
-                df_daily = df_daily.join(this_measure_daily, how="outer")
-            
-        except:
-            print(f"{measure} has length {len(this_measure)}")
-    
-    # Flatten multilayer columns
-    df_daily.columns = df_daily.columns.to_series().apply(lambda x: "{0}_{1}".format(*x)).values
+    all_ids = get_measurements([(id, measure) for id in ids], start_date=start_date, end_date=end_date)
+    df_hourly, df_daily, metadata_df = aggregate_measurements(all_ids, ids)
     
     date_str = ""
     if start_date != "":
@@ -1,4 +1,5 @@
 import os
+import re
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
@@ -12,12 +13,86 @@ import matplotlib.colors as mcolors
 
 import sys
 from dotenv import load_dotenv
+from geocode import geocode
+import city_cube
 
 sys.path.append("../data")
 load_dotenv()
 MAPBOX_TOKEN = os.getenv('MAPBOX')
 px.set_mapbox_access_token(MAPBOX_TOKEN)
 
+def points_to_geojson(points:pd.DataFrame, properties:list[str], lat_col:str="latitude", lon_col:str="longitude",
+                      rename:dict={}) -> dict:
+    """Points as one GeoJSON FeatureCollection, with the given columns as feature properties
+
+    Args:
+        points (pd.DataFrame): one row per point
+        properties (list[str]): columns to add to every feature, NaN becomes null
+        lat_col (str, optional): latitude column. Defaults to "latitude".
+        lon_col (str, optional): longitude column. Defaults to "longitude".
+        rename (dict, optional): property names for some columns, eg. to replace characters like ">". Defaults to {}.
+
+    Returns:
+        dict: the FeatureCollection
+    """
+    values = points.loc[:, properties].astype(object)
+    values = values.where(values.notna(), None).rename(columns=rename)
+    records = values.to_dict(orient="records")
+    coordinates = zip(points[lon_col].astype(float).tolist(), points[lat_col].astype(float).tolist())
+    return {
+        "type": "FeatureCollection",
+        "features": [{"type": "Feature",
+                      "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                      "properties": {k: (v.item() if isinstance(v, np.generic) else v) for k, v in record.items()}}
+                     for (lon, lat), record in zip(coordinates, records)],
+    }
+
+def add_points_layer(this_map, points:pd.DataFrame, popup_fields:dict, style:pd.DataFrame,
+                     lat_col:str="latitude", lon_col:str="longitude", marker=None, tooltip_field:str=None,
+                     tooltip_fields:dict={}, name:str="points"):
+    """Add all points as a single GeoJson layer instead of one folium object per point. The popup and the
+    tooltip are rendered in the browser from the feature properties, and the style of every
+    point is read from its properties, so the page only carries the data once.
+
+    Args:
+        this_map (folium.Map): the map
+        points (pd.DataFrame): one row per point
+        popup_fields (dict): {column: label} shown in the popup, no popup if empty
+        style (pd.DataFrame): per point style columns (eg. radius, color, fillColor), same index as points
+        lat_col (str, optional): latitude column. Defaults to "latitude".
+        lon_col (str, optional): longitude column. Defaults to "longitude".
+        marker (optional): folium.Circle or folium.CircleMarker used for the points. Defaults to folium.Circle().
+        tooltip_field (str, optional): column shown on hover without a label. Defaults to None.
+        tooltip_fields (dict, optional): {column: label} shown on hover instead of tooltip_field. Defaults to {}.
+        name (str, optional): layer name. Defaults to "points".
+
+    Returns:
+        folium.GeoJson: the layer
+    """
+    # Property names are used as javascript keys, so characters like ">" are replaced
+    if (len(tooltip_fields) == 0) and tooltip_field:
+        tooltip_fields = {tooltip_field: None}
+    safe = {c: re.sub(r"\W", "_", c.replace(">", "_gt_").replace("<", "_lt_")) for c in list(popup_fields) + list(tooltip_fields)}
+    style_columns = [f"_style_{c}" for c in style.columns]
+    data = pd.concat([points, style.set_axis(style_columns, axis=1)], axis=1)
+    properties = list(dict.fromkeys(list(popup_fields) + list(tooltip_fields) + style_columns))
+    geojson = points_to_geojson(data, properties, lat_col=lat_col, lon_col=lon_col, rename=safe)
+
+    style_keys = list(style.columns)
+    layer = folium.GeoJson(
+        geojson,
+        name=name,
+        marker=marker if marker is not None else folium.Circle(),
+        style_function=lambda feature: {k: feature["properties"][f"_style_{k}"] for k in style_keys},
+        popup=folium.GeoJsonPopup(fields=[safe[c] for c in popup_fields], aliases=list(popup_fields.values()),
+                                  labels=True, max_width=250) if popup_fields else None,
+        tooltip=folium.GeoJsonTooltip(fields=[safe[c] for c in tooltip_fields], 
+                                      aliases=[label or "" for label in tooltip_fields.values()],
+                                      labels=any(tooltip_fields.values()), sticky=False) if tooltip_fields else None,
+    )
+    layer.add_to(this_map)
+    return layer
+
 def map_stations_with_stats(heatwave_stats, start_zoom=10):
     
     # set centerpoint for plot
@@ -25,46 +100,32 @@ def map_stations_with_stats(heatwave_stats, start_zoom=10):
     plot_lon = heatwave_stats["longitude"].mean()
 
     m = folium.Map(location=[plot_lat, plot_lon], zoom_start=start_zoom)
-    place_gdf = ox.geocode_to_gdf(heatwave_stats.loc[0, "location"])   
+    place_gdf = geocode(heatwave_stats.loc[0, "location"])   
 
     # Optionally, plot the boundary of the place if it's an area
     if 'geometry' in place_gdf.columns:
         folium.GeoJson(place_gdf['geometry']).add_to(m)
 
-    # Filter stations by distance and plot them
-    for _, station in heatwave_stats.iterrows():
-        station["display_text"] = '''
-            <b>{station_name}</b> <br>
-            <b>Station ID:</b> {station_id}<br>
-            <b>Distance:</b> {distance} Km<br>
-            <b>Elevation:</b> {elevation}<br>
-            <b>Average Heatwave Days:</b> {dwd_heatwave_day_mean}<br>
-            <b>Average Tmax>30 Days:</b> {tmax_gt_30_mean}<br>
-            <b>Average Tmin>20 Days:</b> {tmin_gt_20_mean}
-        '''.format(
-            station_name=station['station_name'], 
-            station_id=station['station_id'], 
-            distance=round(station['distance'] / 1000, 2), 
-            elevation=station['elevation'], 
-            dwd_heatwave_day_mean=station['dwd_heatwave_day_mean'], 
-            tmax_gt_30_mean=station['tmax>30_mean'], 
-            tmin_gt_20_mean=station['tmin>20_mean']
-        )
-
-        #iframe = folium.IFrame(station["display_text"])
-        #popup = folium.Popup(iframe, min_width=500, max_width=500)
-    
-        # outer circle
-        folium.Circle(
-                location=[station["latitude"], station["longitude"]],
-                radius=np.interp(station["dwd_heatwave_day_mean"],[0,20], [100, 2000]),
-                color='red',
-                fill=False,
-                fill_color='red',
-                fill_opacity=0.5,
-                hover_data=station["station_name"],
-                popup= folium.Popup(station["display_text"], parse_html=False, max_width=200)
-            ).add_to(m)
+    stations = heatwave_stats.assign(distance_km=(heatwave_stats["distance"] / 1000).round(2))
+    style = pd.DataFrame({
+        "radius": np.interp(stations["dwd_heatwave_day_mean"], [0, 20], [100, 2000]),
+        "color": "red",
+        "fill": False,
+        "fillColor": "red",
+        "fillOpacity": 0.5,
+    }, index=stations.index)
+    # Clicking a station returns its feature, with the properties below, as last_active_drawing in st_folium
+    add_points_layer(m, stations, 
+                     popup_fields={"station_name": "Station", 
+                                   "station_id": "Station ID", 
+                                   "distance_km": "Distance (Km)", 
+                                   "elevation": "Elevation", 
+                                   "dwd_heatwave_day_mean": "Average Heatwave Days", 
+                                   "tmax>30_mean": "Average Tmax>30 Days", 
+                                   "tmin>20_mean": "Average Tmin>20 Days"},
+                     style=style,
+                     tooltip_field="station_name",
+                     name="stations")
         
     return m
 
@@ -78,31 +139,28 @@ def map_cities_with_stats(heatwave_stats:pd.DataFrame,
     plot_lon = heatwave_stats["longitude"].mean()
 
     m = folium.Map(location=[plot_lat, plot_lon], zoom_start=start_zoom)
-    place_gdf = ox.geocode_to_gdf(country)   
+    place_gdf = geocode(country)   
 
     # Optionally, plot the boundary of the place if it's an area
     if 'geometry' in place_gdf.columns:
         folium.GeoJson(place_gdf['geometry']).add_to(m)
 
-    # Filter stations by distance and plot them
-    for _, station in heatwave_stats.iterrows():
-        station["display_text"]=f"""{station['location']} \n 
-            Station Name: {station['station_name']} \n
-            Station ID: {station['station_id']} \n
-            Elevation: {station['elevation']}\n 
-            {display_parameter}: {station[display_parameter]}"""
-
-        # outer circle
-        folium.Circle(
-                location=[station["latitude"], station["longitude"]],
-                radius=np.interp(station[display_parameter],[0,20], [100, 20000]),
-                color=color,
-                fill=False,
-                fill_color=color,
-                fill_opacity=0.5,
-                hover_data=station["station_name"],
-                popup= station["display_text"]
-            ).add_to(m)
+    style = pd.DataFrame({
+        "radius": np.interp(heatwave_stats[display_parameter], [0, 20], [100, 20000]),
+        "color": color,
+        "fill": False,
+        "fillColor": color,
+        "fillOpacity": 0.5,
+    }, index=heatwave_stats.index)
+    add_points_layer(m, heatwave_stats,
+                     popup_fields={"location": "Location",
+                                   "station_name": "Station Name",
+                                   "station_id": "Station ID",
+                                   "elevation": "Elevation",
+                                   display_parameter: display_parameter},
+                     style=style,
+                     tooltip_field="station_name",
+                     name="cities")
         
     return m
 
@@ -190,6 +248,33 @@ def map_px_scattermap(data:pd.DataFrame, title:str="Heatwave Metrics (Days per y
     return fig
 
 
+def map_german_cities(cube_dir:str=city_cube.CITY_CUBE_DIR, 
+                      cities:list[str]=None, 
+                      view:str="mapbox", 
+                      size_parameter:str="dwd_heatwave_day_mean", 
+                      color_parameter:str="dwd_heatwave_day_trend", 
+                      **kwargs):
+    """Map of the German cities cube, only the plotted cities and columns are read from it
+
+    Args:
+        cube_dir (str, optional): root of the cube built by city_cube.build_city_cube. Defaults to city_cube.CITY_CUBE_DIR.
+        cities (list[str], optional): cities to show. Defaults to all cities.
+        view (str, optional): "mapbox" for map_scatter_mapbox or "geo" for map_px_scattermap. Defaults to "mapbox".
+        size_parameter (str, optional): see map_scatter_mapbox. Defaults to "dwd_heatwave_day_mean".
+        color_parameter (str, optional): see map_scatter_mapbox. Defaults to "dwd_heatwave_day_trend".
+        **kwargs: passed on to the map function
+
+    Returns:
+        px.fig: the figure, None if there is no cube
+    """
+    data = city_cube.load_map_data(cube_dir, cities=cities, parameters=[size_parameter, color_parameter])
+    if data is None:
+        return None
+    if view == "geo":
+        return map_px_scattermap(data, **kwargs)
+    return map_scatter_mapbox(data, size_parameter=size_parameter, color_parameter=color_parameter, **kwargs)
+
+
 def map_choropleth_age(source_gdf,
                 zoom:int=9, 
                 title:str="", 
@@ -230,33 +315,6 @@ def map_choropleth_age(source_gdf,
 
     return fig
 
-def plot_dot(this_map, point, color_map, color_col):
-    '''input: series that contains a numeric named latitude and a numeric named longitude
-    this function creates a CircleMarker and adds it to your this_map'''
-    
-    # Define a tooltip for the CircleMarker
-    point_tooltip = folium.Tooltip(
-        text=(
-            f"<b>{color_col}:</b> {point[color_col]}<br>"
-            f"<b>Point Name:</b> {point['point_name']}<br>"
-            f"<b>Point ID:</b> {point['point_id']}<br>"
-            f"<b>Location ID:</b> {point['location_id']}<br>"
-            f"<b>Orientation:</b> {point['loc_orientation']}<br>"
-            f"<b>Surface:</b> {point['loc_surface']}"
-        ),
-        sticky=False
-    )
-
-    # Get the color from the discrete color map
-    color = mcolors.to_hex(color_map(point[color_col]))
-        
-    folium.CircleMarker(location=[point.lat, point.lng],
-                        radius=5,
-                        fill_color=color,
-                        fill_opacity=1,
-                        tooltip=point_tooltip,
-                        weight=1).add_to(this_map)
-
 def plot_dots_on_districts(districts_gdf, points_gdf=None, color_col=None):
     # Create a map
     this_map = folium.Map(prefer_canvas=True)
@@ -285,8 +343,22 @@ def plot_dots_on_districts(districts_gdf, points_gdf=None, color_col=None):
         # Normalize the data for the color map
         norm = plt.Normalize(vmin=points_gdf[color_col].min(), vmax=points_gdf[color_col].max())
         cmap = plt.get_cmap('viridis')  # You can choose another colormap if you prefer
-        color_map = plt.cm.ScalarMappable(norm=norm, cmap=cmap).to_rgba
-        points_gdf.apply(lambda point: plot_dot(this_map, point, color_map, color_col), axis=1)
+        colors = [mcolors.to_hex(c) for c in cmap(norm(points_gdf[color_col].to_numpy(dtype=float)))]
+        style = pd.DataFrame({"radius": 5, "fillColor": colors, "fillOpacity": 1, "weight": 1}, index=points_gdf.index)
+        # Shown on hover like the former per point tooltips
+        add_points_layer(this_map, points_gdf,
+                         popup_fields={},
+                         tooltip_fields={color_col: color_col,
+                                         "point_name": "Point Name",
+                                         "point_id": "Point ID",
+                                         "location_id": "Location ID",
+                                         "loc_orientation": "Orientation",
+                                         "loc_surface": "Surface"},
+                         style=style,
+                         lat_col="lat",
+                         lon_col="lng",
+                         marker=folium.CircleMarker(),
+                         name="points")
 
     # Set the zoom to the maximum possible
     this_map.fit_bounds(this_map.get_bounds())
@@ -0,0 +1,168 @@
+import os
+import shutil
+import tempfile
+import time
+import warnings
+from datetime import datetime, timedelta
+
+import pandas as pd
+from meteostat import Daily, Hourly
+from config import CACHE_DIR
+from rate_limit import get_limiter
+
+METEOSTAT_CACHE_DIR = os.path.join(CACHE_DIR, "meteostat")
+
+# Completed years are refreshed after METEOSTAT_TTL, the running year after CURRENT_YEAR_TTL
+METEOSTAT_TTL = timedelta(days=int(os.environ.get("METEOSTAT_CACHE_TTL_DAYS", 30)))
+CURRENT_YEAR_TTL = timedelta(days=1)
+# An empty response can be a transient failure, so closed years without data are only trusted for a day
+EMPTY_YEAR_TTL = timedelta(days=1)
+# Oldest chunks are evicted once the cache grows beyond this size
+MAX_CACHE_BYTES = int(os.environ.get("METEOSTAT_CACHE_MAX_MB", 2048)) * 1024 * 1024
+
+FETCHERS = {"daily": Daily, "hourly": Hourly}
+
+
+def _chunk_path(freq:str, station_id:str, year:int) -> str:
+    return os.path.join(METEOSTAT_CACHE_DIR, freq, str(station_id), f"{year}.parquet")
+
+def _empty_marker_path(freq:str, station_id:str, year:int) -> str:
+    """Marker of a closed year for which the station returned no data"""
+    return os.path.join(METEOSTAT_CACHE_DIR, freq, str(station_id), f"{year}.empty")
+
+def _is_fresh(path:str, year:int, ttl:timedelta) -> bool:
+    """A chunk is fresh if it exists and was written within the ttl. Chunks of the running year expire daily."""
+    if not os.path.exists(path):
+        return False
+    if year >= datetime.now().year:
+        ttl = min(ttl, CURRENT_YEAR_TTL)
+    age = time.time() - os.path.getmtime(path)
+    return age < ttl.total_seconds()
+
+def _write_chunk(df:pd.DataFrame, path:str):
+    """Write atomically so that concurrent readers never see a half written file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        df.to_parquet(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _missing_spans(years:list[int]) -> list[tuple[int, int]]:
+    """Group a sorted list of years into (first, last) spans of consecutive years"""
+    spans = []
+    for year in years:
+        if spans and year == spans[-1][1] + 1:
+            spans[-1] = (spans[-1][0], year)
+        else:
+            spans.append((year, year))
+    return spans
+
+def fetch_cached(freq:str, station_id:str, start:datetime, end:datetime, ttl:timedelta=None) -> pd.DataFrame:
+    """Fetch Meteostat data through the local cache. Data is stored as one parquet file per station and year,
+    so overlapping requests only download the years which are not cached yet (or have expired). Consecutive
+    missing years are downloaded with a single request. Empty responses are not cached as data: a closed year
+    without data is requested again after EMPTY_YEAR_TTL, the running year on the next call.
+
+    Args:
+        freq (str): "daily" or "hourly"
+        station_id (str): the meteostat station id
+        start (datetime): start of the period
+        end (datetime): end of the period (inclusive)
+        ttl (timedelta, optional): maximum age of a cached year. Defaults to METEOSTAT_TTL.
+
+    Returns:
+        pd.DataFrame: the same dataframe Daily(...).fetch() or Hourly(...).fetch() returns for the period
+    """
+    if ttl is None:
+        ttl = METEOSTAT_TTL
+
+    chunks = {}
+    missing = []
+    for year in range(start.year, end.year + 1):
+        path = _chunk_path(freq, station_id, year)
+        if _is_fresh(path, year, ttl):
+            try:
+                chunks[year] = pd.read_parquet(path)
+                continue
+            except Exception:
+                warnings.warn(f"Ignoring unreadable cache file {path}")
+        if _is_fresh(_empty_marker_path(freq, station_id, year), year, min(ttl, EMPTY_YEAR_TTL)):
+            continue
+        missing.append(year)
+
+    for first, last in _missing_spans(missing):
+        with get_limiter("meteostat"):
+            data = FETCHERS[freq](station_id, datetime(first, 1, 1), datetime(last, 12, 31, 23, 59)).fetch()
+        if not isinstance(data.index, pd.DatetimeIndex):
+            data = data.set_index(pd.DatetimeIndex([], name="time"))
+        for year in range(first, last + 1):
+            chunks[year] = data.loc[data.index.year == year]
+            marker = _empty_marker_path(freq, station_id, year)
+            if len(chunks[year]) > 0:
+                _write_chunk(chunks[year], _chunk_path(freq, station_id, year))
+                if os.path.exists(marker):
+                    os.remove(marker)
+            elif year < datetime.now().year:
+                # Closed years without data are remembered for EMPTY_YEAR_TTL only, the running year not at all
+                os.makedirs(os.path.dirname(marker), exist_ok=True)
+                open(marker, "w").close()
+
+    if missing:
+        evict_cache()
+
+    non_empty = [chunks[year] for year in sorted(chunks) if len(chunks[year]) > 0]
+    if len(non_empty) == 0:
+        return pd.DataFrame()
+    data = pd.concat(non_empty)
+    return data.loc[(data.index >= start) & (data.index <= end)]
+
+def fetch_daily(station_id:str, start:datetime, end:datetime, ttl:timedelta=None) -> pd.DataFrame:
+    """Cached replacement for Daily(station_id, start, end).fetch()"""
+    return fetch_cached("daily", station_id, start, end, ttl=ttl)
+
+def fetch_hourly(station_id:str, start:datetime, end:datetime, ttl:timedelta=None) -> pd.DataFrame:
+    """Cached replacement for Hourly(station_id, start, end).fetch()"""
+    return fetch_cached("hourly", station_id, start, end, ttl=ttl)
+
+def evict_cache(max_bytes:int=None):
+    """Delete the oldest cached chunks until the cache is smaller than max_bytes
+
+    Args:
+        max_bytes (int, optional): size limit of the cache. Defaults to MAX_CACHE_BYTES.
+    """
+    if max_bytes is None:
+        max_bytes = MAX_CACHE_BYTES
+
+    files = []
+    for root, _, names in os.walk(METEOSTAT_CACHE_DIR):
+        for name in names:
+            if name.endswith(".parquet"):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(f[1] for f in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def clear_cache(station_id:str=None):
+    """Remove cached data for a single station, or the whole meteostat cache if no station is given"""
+    if station_id is None:
+        shutil.rmtree(METEOSTAT_CACHE_DIR, ignore_errors=True)
+    else:
+        for freq in FETCHERS:
+            shutil.rmtree(os.path.join(METEOSTAT_CACHE_DIR, freq, str(station_id)), ignore_errors=True)
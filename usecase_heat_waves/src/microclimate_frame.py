@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+
+# Columns which describe a sensor rather than a single measurement
+METADATA_COLUMNS = ["point_id", "measure", "sensor_id", "location_id", "unit"]
+
+
+class MicroclimateFrame:
+    """Tidy alternative to the wide per-sensor frames of get_measure: one long frame indexed by measured_at
+    with a categorical point_id and measure and float32 values, plus a separate metadata table with one row
+    per sensor. The rows are sorted by point, measure and time, so the measurements of one point and measure
+    are a contiguous block and series() returns a view of it without copying. Wide frames are only built for
+    the measure or point that is actually plotted.
+
+        frame = MicroclimateFrame.from_measurements(get_measurements(queries), queries)
+        plot_lib.plot_hourly_carpet(frame.wide(point_id=2), frame.metadata, col="air_temp")
+    """
+
+    def __init__(self, data:pd.DataFrame, metadata:pd.DataFrame):
+        """
+        Args:
+            data (pd.DataFrame): columns point_id, measure and value, indexed by measured_at
+            metadata (pd.DataFrame): one row per sensor, with at least point_id, measure and unit
+        """
+        data = data.astype({"point_id": "category", "measure": "category", "value": np.float32})
+        self.data = data.sort_values(["point_id", "measure", "measured_at"], kind="stable")
+        self.metadata = metadata.reset_index(drop=True)
+
+        # Position of the block of every (point, measure) pair
+        point_codes = self.data["point_id"].cat.codes.to_numpy(dtype=np.int64)
+        measure_codes = self.data["measure"].cat.codes.to_numpy(dtype=np.int64)
+        keys = point_codes * len(self.data["measure"].cat.categories) + measure_codes
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) > 0 else np.array([], dtype=np.int64)
+        stops = np.r_[starts[1:], len(keys)]
+        points = self.data["point_id"].cat.categories[point_codes[starts]]
+        measures = self.data["measure"].cat.categories[measure_codes[starts]]
+        self._blocks = {(p, m): (start, stop) for p, m, start, stop in zip(points, measures, starts, stops)}
+
+    @classmethod
+    def from_measurements(cls, measurements:list[pd.DataFrame], queries:list[tuple[int, str]]) -> "MicroclimateFrame":
+        """Build the frame from the outputs of get_measurements
+
+        Args:
+            measurements (list[pd.DataFrame]): raw measurements indexed by measured_at
+            queries (list[tuple[int, str]]): the (point or location id, measure) pair of every frame. The point_id
+                of the records is used where it is known, so location queries are split into their points.
+
+        Returns:
+            MicroclimateFrame: the tidy frame
+        """
+        parts = []
+        metadata = []
+        for (id, measure), df in zip(queries, measurements):
+            if ("value" not in df.columns) or (len(df) == 0):
+                continue
+            if "point_id" in df.columns:
+                points = df["point_id"].fillna(id).to_numpy(dtype=np.int64)
+            else:
+                points = np.full(len(df), id, dtype=np.int64)
+            parts.append(pd.DataFrame({"point_id": points,
+                                       "measure": measure,
+                                       "value": df["value"].to_numpy(dtype=np.float32)}, index=df.index))
+            meta = df.loc[:, [c for c in METADATA_COLUMNS if c in df.columns]].assign(point_id=points, measure=measure)
+            metadata.append(meta.drop_duplicates())
+
+        if len(parts) == 0:
+            empty = pd.DataFrame({"point_id": pd.Series(dtype=np.int64), "measure": pd.Series(dtype=str),
+                                  "value": pd.Series(dtype=np.float32)},
+                                 index=pd.DatetimeIndex([], name="measured_at"))
+            return cls(empty, pd.DataFrame(columns=METADATA_COLUMNS))
+
+        data = pd.concat(parts)
+        data.index.name = "measured_at"
+        metadata = pd.concat(metadata, ignore_index=True).drop_duplicates()
+        return cls(data, metadata.astype({"measure": "category"}))
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @property
+    def points(self) -> list:
+        return list(self.data["point_id"].cat.categories)
+
+    @property
+    def measures(self) -> list:
+        return list(self.data["measure"].cat.categories)
+
+    def series(self, point_id:int, measure:str) -> pd.Series:
+        """Values of one point and measure indexed by measured_at, a view of the long frame"""
+        start, stop = self._blocks.get((point_id, measure), (0, 0))
+        return self.data["value"].iloc[start:stop].rename(measure)
+
+    def wide(self, measure:str=None, point_id:int=None, freq:str="1h") -> pd.DataFrame:
+        """Wide frame for plotting: the points of one measure, or the measures of one point, as columns.
+        The columns have the names get_measure (point ids) and get_id_hourly_daily (measures) use, so the
+        result can be passed to plot_hourly_carpet.
+
+        Args:
+            measure (str, optional): one column per point of this measure. Defaults to None.
+            point_id (int, optional): one column per measure of this point. Defaults to None.
+            freq (str, optional): resample each column to this frequency with the mean, None keeps the raw
+                timestamps. Defaults to "1h".
+
+        Returns:
+            pd.DataFrame: the wide frame
+        """
+        if (measure is None) == (point_id is None):
+            raise ValueError("Specify either measure or point_id")
+
+        if measure is not None:
+            columns = {p: self.series(p, measure) for p, m in self._blocks if m == measure}
+        else:
+            columns = {m: self.series(point_id, m) for p, m in self._blocks if p == point_id}
+        if freq is not None:
+            columns = {name: s.resample(freq).mean() for name, s in columns.items()}
+        if len(columns) == 0:
+            return pd.DataFrame()
+        return pd.concat(columns, axis=1)
+
+    def memory_usage(self) -> int:
+        """Bytes used by the long frame and the metadata"""
+        return int(self.data.memory_usage(deep=True).sum() + self.metadata.memory_usage(deep=True).sum())
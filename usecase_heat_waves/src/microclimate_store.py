@@ -0,0 +1,254 @@
+import os
+import json
+import glob
+import argparse
+import tempfile
+import warnings
+
+import pandas as pd
+from filelock import FileLock
+
+from config import MICROCLIMATE_STORE_DIR
+from golemio_client import measurement_params, fetch_measurements
+
+# Columns which identify a single measurement
+KEY_COLUMNS = ["measured_at", "point_id", "sensor_id"]
+
+
+def _write_atomic(write, path:str):
+    """Write through a temporary file so that readers never see a partially written file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _to_utc(timestamp) -> pd.Timestamp:
+    """Timestamp in UTC, naive timestamps are taken to be UTC already"""
+    timestamp = pd.Timestamp(timestamp)
+    return timestamp.tz_convert("UTC") if timestamp.tzinfo is not None else timestamp.tz_localize("UTC")
+
+
+class MicroclimateStore:
+    """Local copy of the Golemio microclimate measurements, stored as parquet files partitioned by measure,
+    point and month (root/measure=air_temp/point=2/2024-07.parquet). For every (point, measure) pair
+    root/sync_state.json keeps the synced periods, so that sync only downloads the parts of a requested
+    period which are not stored yet: what is new since the last run, or an earlier or missing period.
+
+    Points are the ids used in the Golemio query: point ids, or location ids (ending in 0) which cover all
+    points of a location.
+    """
+
+    def __init__(self, root:str=MICROCLIMATE_STORE_DIR):
+        self.root = root
+        self.state_path = os.path.join(root, "sync_state.json")
+        # Shared by all stores, threads and processes (dashboard sessions, the cli) writing to root
+        self.lock_path = os.path.join(root, "sync_state.json.lock")
+
+    def _month_path(self, point:int, measure:str, month:str) -> str:
+        return os.path.join(self.root, f"measure={measure}", f"point={point}", f"{month}.parquet")
+
+    def _load_state(self) -> dict:
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def _save_state(self, state:dict):
+        def write(path):
+            with open(path, "w") as f:
+                json.dump(state, f, indent=1, sort_keys=True)
+        _write_atomic(write, self.state_path)
+
+    @staticmethod
+    def _intervals(state:dict) -> list[tuple]:
+        """Synced periods of a pair as sorted (start, end) timestamps in UTC, an open start is None.
+        States of the former format ({"from", "last"}) are read as one period."""
+        if state is None:
+            return []
+        intervals = state["intervals"] if "intervals" in state else [[state["from"], state["last"]]]
+        return sorted(((_to_utc(a) if a != "" else None, _to_utc(b)) for a, b in intervals),
+                      key=lambda interval: (interval[0] is not None, interval[0] or 0))
+
+    @staticmethod
+    def _merge_intervals(intervals:list[tuple]) -> list[tuple]:
+        """Sorted periods with overlapping and touching periods joined"""
+        intervals = sorted(intervals, key=lambda interval: (interval[0] is not None, interval[0] or 0))
+        merged = []
+        for start, end in intervals:
+            if (len(merged) > 0) and ((start is None) or (start <= merged[-1][1])):
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    @staticmethod
+    def _gaps(intervals:list[tuple], start, end) -> list[tuple]:
+        """Parts of the period from start (None is open) to end which are not covered by the intervals"""
+        gaps = []
+        cursor = start
+        for a, b in intervals:
+            if (cursor is not None) and (cursor >= end):
+                break
+            if (a is not None) and ((cursor is None) or (a > cursor)):
+                gaps.append((cursor, min(a, end)))
+            if (cursor is None) or (b > cursor):
+                cursor = b
+        if (cursor is None) or (cursor < end):
+            gaps.append((cursor, end))
+        return gaps
+
+    def synced_intervals(self, point:int, measure:str) -> list[tuple]:
+        """Synced periods of a point and measure as (start, end) timestamps, an open start is None"""
+        return self._intervals(self._load_state().get(f"{point}|{measure}"))
+
+    def last_synced(self, point:int, measure:str) -> pd.Timestamp:
+        """End of the newest synced period of a point and measure, None if it was never synced"""
+        intervals = self.synced_intervals(point, measure)
+        return max(end for _, end in intervals) if len(intervals) > 0 else None
+
+    def _merge_month(self, path:str, new:pd.DataFrame):
+        """Merge new measurements into a month file, newer values win for duplicate measurements"""
+        df = pd.concat([pd.read_parquet(path), new], ignore_index=True) if os.path.exists(path) else new
+        keys = [c for c in KEY_COLUMNS if c in df.columns]
+        df = df.drop_duplicates(subset=keys, keep="last").sort_values("measured_at", kind="stable")
+        for col in ["measure", "unit"]:
+            if col in df.columns:
+                df[col] = df[col].astype("category")
+        _write_atomic(lambda tmp_path: df.to_parquet(tmp_path, index=False), path)
+
+    def write(self, point:int, measure:str, measurements:pd.DataFrame, start_date:str="", end_date:str="",
+              requested_at=None):
+        """Add measurements (typed records as returned by the Golemio client) to the store and record the
+        requested period as synced, even if it returned no measurements, so it is not requested again.
+
+        Args:
+            point (int): Golemio point or location id
+            measure (str): eg. "air_temp"
+            measurements (pd.DataFrame): the new measurements
+            start_date (str, optional): start of the requested period, "" from the beginning. Defaults to "".
+            end_date (str, optional): end of the requested period, "" up to the time of the request. Defaults to "".
+            requested_at (optional): time of the request. An open period ends at its newest measurement, so
+                it is requested again from there, or at requested_at without measurements. Defaults to now.
+        """
+        has_data = (len(measurements) > 0) and ("measured_at" in measurements.columns)
+        if end_date != "":
+            end = _to_utc(end_date)
+        elif has_data:
+            end = _to_utc(measurements["measured_at"].max())
+        else:
+            end = _to_utc(requested_at if requested_at is not None else pd.Timestamp.now(tz="UTC"))
+        start = _to_utc(start_date) if start_date != "" else None
+        os.makedirs(self.root, exist_ok=True)
+        with FileLock(self.lock_path):
+            if has_data:
+                months = measurements["measured_at"].dt.strftime("%Y-%m")
+                for month, rows in measurements.groupby(months.to_numpy()):
+                    self._merge_month(self._month_path(point, measure, month), rows)
+            if (start is not None) and (start > end):
+                return
+
+            all_states = self._load_state()
+            key = f"{point}|{measure}"
+            intervals = self._merge_intervals(self._intervals(all_states.get(key)) + [(start, end)])
+            all_states[key] = {"intervals": [[a.isoformat() if a is not None else "", b.isoformat()]
+                                             for a, b in intervals]}
+            self._save_state(all_states)
+
+    def sync(self, points:list[int], measures:list[str], start_date:str="", end_date:str="", **client_kwargs) -> dict:
+        """Download the measurements of the period which are not stored yet for every combination of points
+        and measures. See sync_pairs for the arguments.
+        """
+        return self.sync_pairs([(p, m) for p in points for m in measures], start_date=start_date,
+                               end_date=end_date, **client_kwargs)
+
+    def sync_pairs(self, pairs:list[tuple[int, str]], start_date:str="", end_date:str="", **client_kwargs) -> dict:
+        """Download the measurements between start_date and end_date which are not stored yet for each
+        (point, measure) pair, concurrently. Every gap between the synced periods of a pair is requested
+        on its own, eg. a new start before the synced periods or the time since the last run.
+
+        Args:
+            pairs (list[tuple[int, str]]): (Golemio point or location id, measure) pairs
+            start_date (str, optional): ISO timestamp, "" from the beginning. Defaults to "".
+            end_date (str, optional): ISO timestamp, "" up to now. Defaults to "".
+            **client_kwargs: passed on to fetch_measurements, eg. api_key
+
+        Returns:
+            dict: number of downloaded rows per (point, measure)
+        """
+        pairs = list(dict.fromkeys(pairs))
+        requested_at = pd.Timestamp.now(tz="UTC")
+        start = _to_utc(start_date) if start_date != "" else None
+        end = min(_to_utc(end_date), requested_at) if end_date != "" else requested_at
+        iso = lambda timestamp: timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ") if timestamp is not None else ""
+
+        queries = []
+        all_states = self._load_state()
+        for point, measure in pairs:
+            intervals = self._intervals(all_states.get(f"{point}|{measure}"))
+            for gap_start, gap_end in self._gaps(intervals, start, end):
+                # A gap up to now stays open, so it ends at the newest measurement
+                gap_end = "" if gap_end == requested_at else iso(gap_end)
+                queries.append(((point, measure), iso(gap_start), gap_end))
+
+        params_list = [measurement_params(id=point, measure=measure, start_date=gap_start, end_date=gap_end)
+                       for (point, measure), gap_start, gap_end in queries]
+        results = fetch_measurements(params_list, return_exceptions=True, **client_kwargs) if len(params_list) > 0 else []
+        new_rows = {pair: 0 for pair in pairs}
+        for ((point, measure), gap_start, gap_end), measurements in zip(queries, results):
+            if isinstance(measurements, Exception):
+                # Nothing is recorded, the gap is requested again on the next sync
+                warnings.warn(f"Failed to sync {measure} of {point}: {measurements}")
+                continue
+            self.write(point, measure, measurements, start_date=gap_start, end_date=gap_end, requested_at=requested_at)
+            new_rows[(point, measure)] += len(measurements)
+        return new_rows
+
+    def read(self, point:int, measure:str, start_date:str="", end_date:str="") -> pd.DataFrame:
+        """Stored measurements of a point and measure, only the month files overlapping the period are read
+
+        Args:
+            point (int): Golemio point or location id
+            measure (str): eg. "air_temp"
+            start_date (str, optional): ISO timestamp. Defaults to "".
+            end_date (str, optional): ISO timestamp. Defaults to "".
+
+        Returns:
+            pd.DataFrame: the measurements in the same format as the Golemio client returns them
+        """
+        files = sorted(glob.glob(self._month_path(point, measure, "*")))
+        start = pd.Timestamp(start_date) if start_date != "" else None
+        end = pd.Timestamp(end_date) if end_date != "" else None
+        first_month = start.strftime("%Y-%m") if start is not None else ""
+        last_month = end.strftime("%Y-%m") if end is not None else "9999-99"
+        files = [f for f in files if first_month <= os.path.basename(f)[:7] <= last_month]
+        if len(files) == 0:
+            return pd.DataFrame()
+
+        df = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+        mask = pd.Series(True, index=df.index)
+        if start is not None:
+            mask &= df["measured_at"] >= (start if start.tzinfo else start.tz_localize("UTC"))
+        if end is not None:
+            mask &= df["measured_at"] <= (end if end.tzinfo else end.tz_localize("UTC"))
+        return df.loc[mask].reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download new Golemio microclimate measurements into the local store")
+    parser.add_argument("--ids", type=int, nargs="+", required=True, help="point or location ids")
+    parser.add_argument("--measures", nargs="+", required=True, help="eg. air_temp air_hum")
+    parser.add_argument("--start", default="", help="ISO timestamp to start from, empty for the beginning")
+    parser.add_argument("--end", default="", help="ISO timestamp to end at, empty for now")
+    parser.add_argument("--root", default=MICROCLIMATE_STORE_DIR)
+    args = parser.parse_args()
+
+    new_rows = MicroclimateStore(args.root).sync(args.ids, args.measures, start_date=args.start, end_date=args.end)
+    for (point, measure), n in new_rows.items():
+        print(f"{point} {measure}: {n} rows")
@@ -11,11 +11,15 @@ import sys
 
 sys.path.append("../data")
 from dotenv import load_dotenv
+from carpet import carpet_frame
 load_dotenv()
 
 MAPBOX_TOKEN = os.getenv('MAPBOX')
 px.set_mapbox_access_token(MAPBOX_TOKEN)
 
+# First row of every month in the day of year plots, which use the 366 days of a leap year
+MONTH_ROWS = np.cumsum([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30])
+
 def plot_temperature_trends(daily_data, station_name=""):
     annual_hot_days = daily_data.loc[:, ["year", "tmax>30", "tmin>20", "dwd_heatwave_day"]].groupby("year").sum()
     if station_name != "":
@@ -78,7 +82,7 @@ def plot_daily(daily, title, plot_value:str="tavg", highlight_column:str="dwd_he
     # Update y-axis to show months
     fig.update_yaxes(title="Month", 
                      tickmode='array', 
-                     tickvals=[0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335], 
+                     tickvals=MONTH_ROWS, 
                      ticktext=[pd.to_datetime(f'2020-{i}-01').strftime('%B') for i in range(1, 13)], 
                      showgrid=True)
 
@@ -133,7 +137,7 @@ def plot_daily_go(daily, title, plot_value="tavg", highlight_column="dwd_heatwav
         yaxis=dict(
             title="Month",
             tickmode='array',
-            tickvals=[0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335],
+            tickvals=MONTH_ROWS,
             ticktext=[pd.to_datetime(f'2020-{i}-01').strftime('%B') for i in range(1, 13)],
             showgrid=True
         ),
@@ -147,6 +151,94 @@ def plot_daily_go(daily, title, plot_value="tavg", highlight_column="dwd_heatwav
 
     return fig
 
+def daily_matrix(daily:pd.DataFrame, columns:list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """Day of year x year matrices of daily columns, built with one scatter into a preallocated array.
+    Rows follow the calendar of a leap year (row 59 is Feb 29, row 60 Mar 1 in every year), so dates line
+    up across years and with MONTH_ROWS. Days without data are NaN.
+
+    Args:
+        daily (pd.DataFrame): daily data indexed by date
+        columns (list[str]): columns to arrange
+
+    Returns:
+        tuple (np.ndarray, np.ndarray): values of shape (len(columns), 366, n_years) and the years
+    """
+    dates = pd.DatetimeIndex(daily.index)
+    years = np.arange(dates.year.min(), dates.year.max() + 1)
+    matrix = np.full((len(columns), 366, len(years)), np.nan)
+    values = daily.loc[:, columns].to_numpy(dtype=float).T
+    rows = MONTH_ROWS[dates.month.to_numpy() - 1] + dates.day.to_numpy() - 1
+    matrix[:, rows, dates.year.to_numpy() - years[0]] = values
+    return matrix, years
+
+def plot_daily_heatmap(daily:pd.DataFrame, title:str, plot_value:str="tavg", highlight_column:str="dwd_heatwave_day",
+                       color_range:tuple=None, color_scale:str="Plasma"):
+    """Carpet of a daily value with one column per year and one row per day of year, highlighted days in red.
+    Same encoding as plot_daily, but as two heatmaps (values and highlights) instead of one bar per day,
+    so the figure stays small for many years. daily is not modified.
+
+    Args:
+        daily (pd.DataFrame): daily data indexed by date, eg. from get_daily_station
+        title (str): figure title
+        plot_value (str, optional): column to color by. Defaults to "tavg".
+        highlight_column (str, optional): days where this column is > 0 are drawn red. Defaults to "dwd_heatwave_day".
+        color_range (tuple, optional): (min, max) of the color scale. Defaults to the range of the data.
+        color_scale (str, optional): plotly color scale. Defaults to "Plasma".
+
+    Returns:
+        go.Figure: a figure to show in streamlit
+    """
+    if plot_value not in daily.columns:
+        return f"{plot_value} not found in DataFrame"
+    if highlight_column not in daily.columns:
+        return f"{highlight_column} not found in DataFrame"
+
+    matrix, years = daily_matrix(daily, [plot_value, highlight_column])
+    values, highlight = matrix
+    # Rows are centered in their day, so the month ticks at the start of each month line up like the bars
+    days = np.arange(366) + 0.5
+    day_names = np.broadcast_to(pd.date_range("2000-01-01", periods=366).strftime("%d %B").to_numpy()[:, None],
+                                values.shape)
+    cmin, cmax = color_range if color_range else (np.nanmin(values), np.nanmax(values))
+
+    fig = go.Figure()
+    fig.add_trace(go.Heatmap(
+        x=years, y=days, z=values, customdata=day_names,
+        zmin=cmin, zmax=cmax,
+        colorscale=color_scale,
+        colorbar=dict(title=plot_value),
+        xgap=2,
+        hovertemplate="%{customdata} %{x}<br>" + plot_value + ": %{z}<extra></extra>",
+    ))
+    fig.add_trace(go.Heatmap(
+        x=years, y=days, z=np.where(highlight > 0, 1.0, np.nan), customdata=day_names,
+        colorscale=[[0, "red"], [1, "red"]],
+        showscale=False,
+        xgap=2,
+        hovertemplate="%{customdata} %{x}<br>" + highlight_column + "<extra></extra>",
+    ))
+
+    fig.update_layout(
+        title=title,
+        template="plotly_dark",
+        yaxis=dict(
+            title="Month",
+            tickmode='array',
+            tickvals=MONTH_ROWS,
+            ticktext=[pd.to_datetime(f'2020-{i}-01').strftime('%B') for i in range(1, 13)],
+            showgrid=True,
+            range=[0, 366],
+        ),
+        xaxis=dict(
+            title="Year",
+            tickmode='array',
+            tickvals=years,
+            ticktext=years,
+        )
+    )
+
+    return fig
+
 def plot_compare_stations(df:pd.DataFrame, title:str=""):
     station_comparison_df = df.copy().drop("total", axis=1)
     fig = px.imshow(station_comparison_df,
@@ -256,19 +348,15 @@ def plot_hourly_carpet(df:pd.DataFrame,
                 unit:str="", 
                 title:str="",
                 col:str="",
-                diff:bool=False):
+                diff:bool=False,
+                start=None,
+                end=None):
     
     if col == "":
         return "Please specify a column"
     else:
-        long_df = pd.DataFrame(df.loc[:, col])
-        long_df.index = pd.to_datetime(long_df.index)
-        long_df.columns = ["value"]
-        long_df["date"] = long_df.index.normalize()
-        long_df["daytime"] = long_df.index - long_df["date"]
-
-        short_df = long_df.pivot_table(columns="date", index="daytime", values="value")
-        short_df.index = short_df.index / pd.Timedelta('1 hour')
+        # Memoized per column and range, see carpet.carpet_matrices
+        short_df = carpet_frame(df, col, start=start, end=end)
 
         if (unit == "") and len(metadata)>0:
             unit = metadata.loc[metadata['measure']==col, 'unit'].values[0]
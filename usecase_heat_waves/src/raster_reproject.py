@@ -0,0 +1,114 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio as rio
+import rasterio.shutil
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform, Resampling
+
+BLOCK_SIZE = 512
+
+
+def reproject_tif(src_file:str, dst_file:str, dst_crs:str="", resampling=Resampling.cubic,
+                  zero_is_nodata:bool=True, block_size:int=BLOCK_SIZE, compress:str="deflate") -> str:
+    """Reproject a .TIF file to a desired crs and write it as a Cloud Optimized GeoTIFF. The source is
+    warped through a WarpedVRT and processed one block at a time, so memory use is bounded by the block
+    size instead of the scene size. Zeros (edge artifacts of the resampling) are set to nodata in the same
+    pass.
+
+    Args:
+        src_file (str): source file path
+        dst_file (str): destination file path
+        dst_crs (str, optional): destination crs. Defaults to "EPSG:4326".
+        resampling (Resampling, optional): resampling method. Defaults to Resampling.cubic.
+        zero_is_nodata (bool, optional): replace zeros by nodata, might cause issues if visualizing cold
+            temperatures. Defaults to True.
+        block_size (int, optional): size of the processed and written tiles in pixels. Defaults to 512.
+        compress (str, optional): compression of the output. Defaults to "deflate".
+
+    Returns:
+        str: dst_file
+    """
+    if dst_crs == "":
+        dst_crs = "EPSG:4326"
+
+    # Temp files per call, other threads or processes may reproject the same scene at the same time
+    dst_dir = os.path.dirname(os.path.abspath(dst_file))
+    fd, tmp_file = tempfile.mkstemp(dir=dst_dir, suffix=".tmp.tif")
+    os.close(fd)
+    fd, tmp_cog = tempfile.mkstemp(dir=dst_dir, suffix=".cog.tif")
+    os.close(fd)
+    try:
+        with rio.open(src_file) as src:
+            transform, width, height = calculate_default_transform(
+                src.crs, dst_crs, src.width, src.height, *src.bounds)
+            print(f"reprojecting {os.path.basename(src_file)} from {src.crs} to {dst_crs}")
+
+            nodata = src.nodata
+            if nodata is None:
+                nodata = np.nan if np.issubdtype(np.dtype(src.dtypes[0]), np.floating) else 0
+
+            profile = src.profile.copy()
+            profile.update({
+                "driver": "GTiff",
+                "crs": dst_crs,
+                "transform": transform,
+                "width": width,
+                "height": height,
+                "nodata": nodata,
+                "tiled": True,
+                "blockxsize": block_size,
+                "blockysize": block_size,
+                "compress": compress,
+                "BIGTIFF": "IF_SAFER",
+            })
+
+            with WarpedVRT(src, crs=dst_crs, transform=transform, width=width, height=height,
+                           resampling=resampling, src_nodata=src.nodata, nodata=nodata) as vrt:
+                with rio.open(tmp_file, "w", **profile) as dst:
+                    # The output is tiled with block_size, so every window is exactly one tile
+                    for _, window in dst.block_windows(1):
+                        data = vrt.read(window=window)
+                        if zero_is_nodata:
+                            data[data == 0] = nodata
+                        dst.write(data, window=window)
+
+        # The COG driver adds the overviews and reorders the tiles, streaming from the tiled file
+        rio.shutil.copy(tmp_file, tmp_cog, driver="COG", compress=compress, blocksize=block_size,
+                        BIGTIFF="IF_SAFER")
+        os.replace(tmp_cog, dst_file)
+    finally:
+        for path in [tmp_file, tmp_cog]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    return dst_file
+
+def _reproject_job(args:tuple) -> str:
+    src_file, dst_file, kwargs = args
+    return reproject_tif(src_file, dst_file, **kwargs)
+
+def reproject_scenes(src_files:list[str], dst_files:list[str]=None, n_workers:int=None, **kwargs) -> list[str]:
+    """Reproject many files in parallel worker processes, see reproject_tif for the keyword arguments
+
+    Args:
+        src_files (list[str]): source file paths
+        dst_files (list[str], optional): destination file paths. Defaults to the source paths with
+            "LST" replaced by "LST_reprojected" (or "_reprojected" appended).
+        n_workers (int, optional): number of processes, 1 runs in this process. Defaults to the number of cpus.
+
+    Returns:
+        list[str]: the destination files, in the order of src_files
+    """
+    if dst_files is None:
+        dst_files = [os.path.join(os.path.dirname(f), os.path.basename(f).replace("LST", "LST_reprojected"))
+                     if "LST" in os.path.basename(f) else "{0}_reprojected{1}".format(*os.path.splitext(f))
+                     for f in src_files]
+    jobs = [(src, dst, kwargs) for src, dst in zip(src_files, dst_files)]
+
+    if n_workers == 1:
+        return [_reproject_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(_reproject_job, jobs))
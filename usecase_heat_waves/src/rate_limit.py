@@ -0,0 +1,54 @@
+import threading
+import time
+
+# Minimum number of seconds between two requests to the same host.
+# Nominatim's usage policy allows at most one request per second.
+RATE_LIMITS = {"nominatim": 1.0, "meteostat": 0.1}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class RateLimiter:
+    """Thread-safe limiter which spaces calls at least min_interval seconds apart.
+    Use it as a context manager around a request, eg.
+
+        with get_limiter("nominatim"):
+            ox.geocode_to_gdf(location)
+    """
+
+    def __init__(self, min_interval:float):
+        self.min_interval = min_interval
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next free slot. Slots are reserved under the lock, the sleep happens outside of it."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def __enter__(self):
+        self.wait()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def get_limiter(host:str) -> RateLimiter:
+    """Returns the shared limiter for a host, creating it from RATE_LIMITS on first use
+
+    Args:
+        host (str): a key of RATE_LIMITS, eg. "nominatim"
+
+    Returns:
+        RateLimiter: the limiter shared by all threads of this process
+    """
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = RateLimiter(RATE_LIMITS.get(host, 0.0))
+        return _limiters[host]
@@ -0,0 +1,79 @@
+import pandas as pd
+
+
+class ResultAccumulator:
+    """Collects results inside a loop and builds a single DataFrame at the end, instead of growing a
+    DataFrame with pd.concat on every iteration (which copies all previous rows each time). Rows can be
+    added as dictionaries (append, extend) or as blocks of rows (append_frame), eg.
+
+        acc = ResultAccumulator(dtypes={"n_years": "int64"})
+        for station in stations:
+            acc.append(compute_heat_stats(...))
+        stats = acc.to_frame()
+
+    Dtypes are inferred once on the complete columns, or taken from dtypes, so they don't depend on
+    whichever row happened to come first.
+    """
+
+    def __init__(self, dtypes:dict=None, columns:list=None):
+        """
+        Args:
+            dtypes (dict, optional): dtype per column, applied when the DataFrame is built. Defaults to None.
+            columns (list, optional): fixed column order. Columns missing from a row are NaN,
+            additional columns are dropped. Defaults to the order in which columns are first seen.
+        """
+        self.dtypes = dtypes if dtypes is not None else {}
+        self.columns = columns
+        self._blocks = []
+        self._records = []
+        self._n_rows = 0
+
+    def append(self, record:dict):
+        """Add a single row"""
+        self._records.append(record)
+        self._n_rows += 1
+
+    def extend(self, records:list[dict]):
+        """Add several rows"""
+        for record in records:
+            self.append(record)
+
+    def append_frame(self, df:pd.DataFrame):
+        """Add a block of rows, eg. the result for one city. The index of the block is not kept."""
+        if df is None or len(df) == 0:
+            return
+        self._flush_records()
+        self._blocks.append(df)
+        self._n_rows += len(df)
+
+    def _flush_records(self):
+        # Keep the order of rows and blocks by turning pending records into a block of their own
+        if self._records:
+            self._blocks.append(pd.DataFrame.from_records(self._records, coerce_float=True))
+            self._records = []
+
+    def __len__(self):
+        return self._n_rows
+
+    def to_frame(self) -> pd.DataFrame:
+        """Materialize everything collected so far as one DataFrame
+
+        Returns:
+            pd.DataFrame: all rows with a fresh RangeIndex, an empty DataFrame if nothing was added
+        """
+        self._flush_records()
+        if len(self._blocks) == 0:
+            return pd.DataFrame(columns=self.columns)
+        if len(self._blocks) == 1:
+            df = self._blocks[0].reset_index(drop=True)
+        else:
+            df = pd.concat(self._blocks, ignore_index=True).infer_objects()
+        # Keep a single block so that later calls don't concatenate again
+        self._blocks = [df]
+
+        if self.columns is not None:
+            df = df.reindex(columns=self.columns)
+        dtypes = {k:v for k, v in self.dtypes.items() if k in df.columns}
+        if dtypes:
+            df = df.astype(dtypes)
+        return df
@@ -0,0 +1,320 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import rasterio as rio
+
+from config import CACHE_DIR
+from raster_reproject import reproject_tif
+
+SCENE_CACHE_DIR = os.path.join(CACHE_DIR, "scenes")
+# Set to "stub" to search the offline StubSceneCatalogue instead of the Landsat archive
+SCENE_CATALOGUE = os.environ.get("HEATWAVE_SCENE_CATALOGUE", "landsat")
+SCENE_WORKERS = 2
+# Windows of past years are searched again after SCENE_CACHE_TTL, so reprocessed or newly derived scenes show
+# up, windows of the running year after CURRENT_WINDOW_TTL as new passes are added every 8 days
+SCENE_CACHE_TTL = timedelta(days=int(os.environ.get("HEATWAVE_SCENE_CACHE_TTL_DAYS", 30)))
+CURRENT_WINDOW_TTL = timedelta(days=1)
+# Directory of a scene below the data_path of LandsatLoader, eg. interim/Prague_LC08_L1TP_192025_20180817_20200831_02_T1
+SCENE_DIR = os.path.join("interim", "{location}_{display_id}")
+
+_jobs = None
+_jobs_lock = threading.Lock()
+# One lock per reprojected file, overlapping heatwave windows derive the same scenes
+_derive_locks = {}
+_derive_locks_lock = threading.Lock()
+
+
+class ContentCache:
+    """Local cache of dataframes addressed by the hash of the request that produced them, so identical
+    requests share one entry whatever process or session computed it:
+    root/ab/abcdef....parquet, with the request stored next to it in abcdef....json.
+    """
+
+    def __init__(self, root:str=SCENE_CACHE_DIR):
+        self.root = root
+
+    @staticmethod
+    def key(request:dict) -> str:
+        """sha256 of the canonical json of the request"""
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _path(self, key:str, ext:str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.{ext}")
+
+    def get(self, key:str) -> pd.DataFrame:
+        """The stored dataframe, None if the key is not cached"""
+        path = self._path(key, "parquet")
+        return pd.read_parquet(path) if os.path.exists(path) else None
+
+    def is_fresh(self, key:str, ttl:timedelta=None) -> bool:
+        """Whether the key is cached and, if a ttl is given, was stored within the ttl"""
+        path = self._path(key, "parquet")
+        if not os.path.exists(path):
+            return False
+        return (ttl is None) or (time.time() - os.path.getmtime(path) < ttl.total_seconds())
+
+    def put(self, key:str, df:pd.DataFrame, request:dict=None):
+        """Store a dataframe atomically, the request is kept for inspection"""
+        path = self._path(key, "parquet")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        os.close(fd)
+        try:
+            df.to_parquet(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if request is not None:
+            with open(self._path(key, "json"), "w") as f:
+                json.dump(request, f, indent=1, sort_keys=True, default=str)
+
+
+class StubSceneCatalogue:
+    """Offline stand-in for LandsatLoader. get_scenes_l1 returns a deterministic scene list in the format
+    of the Landsat search (display_id, start_time, stop_time, cloud_cover): one Landsat 8 and one Landsat 9
+    pass every 16 days, offset by 8 days. A parquet/csv file with those columns can be given instead.
+    """
+
+    def __init__(self, catalogue_path:str="", data_path:str=""):
+        self.data_path = data_path
+        self.catalogue = None
+        if catalogue_path != "":
+            if catalogue_path.endswith(".parquet"):
+                self.catalogue = pd.read_parquet(catalogue_path)
+            else:
+                self.catalogue = pd.read_csv(catalogue_path, parse_dates=["start_time", "stop_time"])
+
+    def get_scenes_l1(self, location:str, start_month:int, end_month:int, year:int) -> pd.DataFrame:
+        start = datetime(year, start_month, 1)
+        end = (datetime(year, end_month, 28) + timedelta(days=4)).replace(day=1)
+        if self.catalogue is not None:
+            scenes = self.catalogue
+            return scenes.loc[(scenes["stop_time"] >= start) & (scenes["stop_time"] < end)].reset_index(drop=True)
+
+        seed = int(hashlib.sha256(location.encode()).hexdigest()[:8], 16)
+        first = datetime(2013, 4, 11, 9, 50) + timedelta(days=seed % 16)
+        rows = []
+        n_passes = (start - first).days // 8
+        time = first + timedelta(days=8 * max(n_passes, 0))
+        while time < end:
+            if time >= start:
+                satellite = "LC08" if ((time - first).days // 8) % 2 == 0 else "LC09"
+                rows.append({
+                    "display_id": f"{satellite}_L1TP_190025_{time:%Y%m%d}_{time:%Y%m%d}_02_T1",
+                    "start_time": time,
+                    "stop_time": time + timedelta(seconds=25),
+                    "cloud_cover": float((seed + time.toordinal() * 37) % 100),
+                })
+            time += timedelta(days=8)
+        return pd.DataFrame(rows, columns=["display_id", "start_time", "stop_time", "cloud_cover"])
+
+
+def _lst_files(data_path:str, location:str, display_id:str) -> list[str]:
+    """LST rasters of a scene in its SCENE_DIR below data_path, without earlier outputs of derive_lst"""
+    scene_dir = os.path.join(data_path, SCENE_DIR.format(location=location, display_id=display_id))
+    if not os.path.isdir(scene_dir):
+        return []
+    return sorted(os.path.join(scene_dir, f) for f in os.listdir(scene_dir)
+                  if ("LST" in f) and f.lower().endswith((".tif", ".tiff")) and ("reprojected" not in f))
+
+def derive_lst(loader, scenes:pd.DataFrame, request:dict) -> pd.DataFrame:
+    """Default derive hook of SceneJobs: the LST rasters of every scene in its SCENE_DIR below loader.data_path are
+    reprojected to a Cloud Optimized GeoTIFF next to the source (skipped if it already exists) and summarised.
+    Scenes without an LST raster on disk keep empty product columns.
+
+    Returns:
+        pd.DataFrame: the scenes with lst_file (the reprojected file), lst_min, lst_mean and lst_max
+    """
+    data_path = getattr(loader, "data_path", "")
+    products = []
+    for display_id in scenes.get("display_id", pd.Series(dtype=str)):
+        product = {"lst_file": None, "lst_min": np.nan, "lst_mean": np.nan, "lst_max": np.nan}
+        sources = _lst_files(data_path, request["location"], display_id) if data_path != "" else []
+        if len(sources) > 0:
+            source = sources[0]
+            dst_file = os.path.join(os.path.dirname(source), os.path.basename(source).replace("LST", "LST_reprojected"))
+            with _derive_locks_lock:
+                dst_lock = _derive_locks.setdefault(dst_file, threading.Lock())
+            with dst_lock:
+                if not os.path.exists(dst_file):
+                    reproject_tif(source, dst_file)
+            with rio.open(dst_file) as src:
+                # The coarsest overview is enough for a summary
+                factor = src.overviews(1)[-1] if src.overviews(1) else 1
+                values = src.read(1, masked=True, out_shape=(max(src.height // factor, 1), max(src.width // factor, 1)))
+            valid = values.compressed()
+            valid = valid[~np.isnan(valid)]
+            product = {"lst_file": dst_file,
+                       "lst_min": float(valid.min()) if len(valid) else np.nan,
+                       "lst_mean": float(valid.mean()) if len(valid) else np.nan,
+                       "lst_max": float(valid.max()) if len(valid) else np.nan}
+        products.append(product)
+    return pd.concat([scenes.reset_index(drop=True),
+                      pd.DataFrame(products, columns=["lst_file", "lst_min", "lst_mean", "lst_max"])], axis=1)
+
+
+class SceneJobs:
+    """Background scene search and derived LST products (see derive_lst) for locations and heatwave windows.
+    Jobs run in a small thread pool, results are stored in a ContentCache, so a window is only searched
+    once. The dashboard submits the windows it will need and polls them on every rerun instead of blocking:
+
+        jobs = get_scene_jobs(lambda: LandsatLoader(data_path=DATA_DIR))
+        key = jobs.submit("Prague", year=2015, start_month=8, end_month=8)
+        job = jobs.poll(key)  # {"status": "done", "result": scenes, "error": None}
+
+    Any object with a get_scenes_l1(location, start_month, end_month, year) method can be the loader.
+    """
+
+    def __init__(self, loader_factory, cache:ContentCache=None, n_workers:int=SCENE_WORKERS, derive=derive_lst,
+                 catalogue_name:str=SCENE_CATALOGUE, ttl:timedelta=SCENE_CACHE_TTL):
+        """
+        Args:
+            loader_factory (callable): creates the loader, called once in the background on first use
+            cache (ContentCache, optional): result cache. Defaults to ContentCache().
+            n_workers (int, optional): number of background threads. Defaults to SCENE_WORKERS.
+            derive (callable, optional): derive(loader, scenes, request) -> pd.DataFrame of derived products,
+                stored instead of the plain scene list, None stores the scene list. Defaults to derive_lst.
+            catalogue_name (str, optional): part of the cache key, so catalogues don't share results.
+                Defaults to SCENE_CATALOGUE.
+            ttl (timedelta, optional): age after which a cached window is searched again, capped at
+                CURRENT_WINDOW_TTL for the running year. Defaults to SCENE_CACHE_TTL.
+        """
+        self.loader_factory = loader_factory
+        self.cache = cache if cache is not None else ContentCache()
+        self.derive = derive
+        self.catalogue_name = catalogue_name
+        self.ttl = ttl
+        self._loader = None
+        self._loader_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="scene_jobs")
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def _get_loader(self):
+        with self._loader_lock:
+            if self._loader is None:
+                self._loader = self.loader_factory()
+            return self._loader
+
+    def _request(self, location:str, year:int, start_month:int, end_month:int) -> dict:
+        return {"catalogue": self.catalogue_name, "location": location, "year": int(year),
+                "start_month": int(start_month), "end_month": int(end_month),
+                "products": getattr(self.derive, "__name__", None)}
+
+    def _ttl(self, request:dict) -> timedelta:
+        if request["year"] >= datetime.now().year:
+            return min(self.ttl, CURRENT_WINDOW_TTL)
+        return self.ttl
+
+    def _run(self, key:str, request:dict) -> pd.DataFrame:
+        loader = self._get_loader()
+        scenes = loader.get_scenes_l1(location=request["location"], start_month=request["start_month"],
+                                      end_month=request["end_month"], year=request["year"])
+        result = pd.DataFrame(scenes)
+        if self.derive is not None:
+            result = self.derive(loader, result, request)
+        self.cache.put(key, result, request)
+        return result
+
+    def submit(self, location:str, year:int, start_month:int, end_month:int) -> str:
+        """Start the search for a location and window unless it is cached (and not older than the ttl) or
+        already running
+
+        Returns:
+            str: the job key to poll
+        """
+        request = self._request(location, year, start_month, end_month)
+        key = ContentCache.key(request)
+        with self._lock:
+            future = self._futures.get(key)
+            # Failed jobs are retried on the next submit, finished ones once their result expired
+            if (future is None) or future.done():
+                if self.cache.is_fresh(key, self._ttl(request)):
+                    return key
+                self._futures[key] = self._pool.submit(self._run, key, request)
+        return key
+
+    def poll(self, key:str) -> dict:
+        """Status of a job without blocking
+
+        Returns:
+            dict: "status" (pending, running, done or failed), "result" (the dataframe once done, or the
+            expired cached result while it is refreshed) and "error". A failed refresh of a cached result
+            is done with the cached result and the error of the refresh.
+        """
+        with self._lock:
+            future = self._futures.get(key)
+        if (future is not None) and not future.done():
+            return {"status": "running" if future.running() else "pending", "result": self.cache.get(key), "error": None}
+        error = str(future.exception()) if (future is not None) and (future.exception() is not None) else None
+        result = self.cache.get(key)
+        if result is not None:
+            return {"status": "done", "result": result, "error": error}
+        return {"status": "failed", "result": None, "error": error if future is not None else "unknown job"}
+
+    def wait(self, key:str, timeout:float=None) -> dict:
+        """Block until a job is finished, for scripts and notebooks"""
+        with self._lock:
+            future = self._futures.get(key)
+        if future is not None:
+            try:
+                future.result(timeout=timeout)
+            except Exception:
+                pass
+        return self.poll(key)
+
+    def submit_heatwaves(self, location:str, long_heatwaves:pd.DataFrame) -> list[str]:
+        """Submit every heatwave window of compute_longer_heatwaves (index of year, start_month, end_month)"""
+        return [self.submit(location, year, start_month, end_month)
+                for year, start_month, end_month in long_heatwaves.index]
+
+
+def get_scene_jobs(loader_factory=None) -> SceneJobs:
+    """The job pipeline shared by all sessions of the process, created on first use. With
+    HEATWAVE_SCENE_CATALOGUE=stub the offline StubSceneCatalogue is searched instead of loader_factory.
+    """
+    global _jobs
+    with _jobs_lock:
+        if _jobs is None:
+            if (SCENE_CATALOGUE == "stub") or (loader_factory is None):
+                _jobs = SceneJobs(StubSceneCatalogue, derive=derive_lst, catalogue_name="stub")
+            else:
+                _jobs = SceneJobs(loader_factory, derive=derive_lst)
+        return _jobs
+
+
+if __name__ == "__main__":
+    import argparse
+    import analyse_heatwaves as hw_functions
+
+    parser = argparse.ArgumentParser(description="Precompute the Landsat scenes of the long heatwaves around a location")
+    parser.add_argument("location")
+    parser.add_argument("--station", required=True, help="Meteostat station id to detect the heatwaves with")
+    parser.add_argument("--start", type=int, default=2013)
+    parser.add_argument("--end", type=int, default=2024)
+    parser.add_argument("--min-length", type=int, default=5)
+    parser.add_argument("--stub", action="store_true", help="use the offline stub catalogue")
+    args = parser.parse_args()
+
+    if args.stub:
+        loader_factory = StubSceneCatalogue
+    else:
+        from landsat_pipeline import LandsatLoader
+        loader_factory = lambda: LandsatLoader(data_path="./data")
+
+    daily = hw_functions.get_daily_station(args.station, start_year=args.start, end_year=args.end)
+    long_heatwaves = hw_functions.compute_longer_heatwaves(hw_functions.group_heatwaves_station(daily), args.min_length)
+    jobs = SceneJobs(loader_factory, derive=derive_lst, catalogue_name="stub" if args.stub else "landsat")
+    for key in jobs.submit_heatwaves(args.location, long_heatwaves):
+        job = jobs.wait(key)
+        print(key[:12], job["status"], len(job["result"]) if job["result"] is not None else job["error"])
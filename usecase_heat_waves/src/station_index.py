@@ -0,0 +1,180 @@
+import os
+import time
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from meteostat import Stations
+
+from config import CACHE_DIR
+
+STATION_INDEX_PATH = os.path.join(CACHE_DIR, "stations", "catalogue.parquet")
+# The station catalogue changes slowly, refresh it once a month
+STATION_INDEX_TTL = timedelta(days=30)
+EARTH_RADIUS = 6371000  # m
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _to_unit_vectors(lat, lon) -> np.ndarray:
+    """Latitude/longitude in degrees to points on the unit sphere, so that euclidean distances in the tree
+    are chord lengths, which grow monotonically with the great circle distance"""
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+def _chord_to_meters(chord:np.ndarray) -> np.ndarray:
+    return 2 * EARTH_RADIUS * np.arcsin(np.clip(chord / 2, 0, 1))
+
+def _meters_to_chord(distance:float) -> float:
+    return 2 * np.sin(min(distance / EARTH_RADIUS, np.pi) / 2)
+
+
+class StationIndex:
+    """Spatial index over the full Meteostat station catalogue. Replaces Stations().nearby(...).fetch(n),
+    which downloads the catalogue for every query and returns at most n stations.
+
+    Supports radius queries, k-nearest queries and batch queries for many locations. All queries can skip
+    stations whose data inventory doesn't overlap the requested years, so that they are never fetched.
+    Results have the columns of the Meteostat catalogue with "id" and "name" renamed to "station_id" and
+    "station_name", plus the distance to the query point in meters.
+    """
+
+    def __init__(self, catalogue:pd.DataFrame):
+        """
+        Args:
+            catalogue (pd.DataFrame): the output of Stations().fetch(), indexed by station id
+        """
+        catalogue = catalogue.dropna(subset=["latitude", "longitude"])
+        self.catalogue = catalogue.reset_index().rename(columns={"id":"station_id", "name":"station_name"})
+        self._tree = cKDTree(_to_unit_vectors(self.catalogue["latitude"], self.catalogue["longitude"]))
+
+    @classmethod
+    def load(cls, max_age:timedelta=STATION_INDEX_TTL, refresh:bool=False) -> "StationIndex":
+        """Build the index from the catalogue stored on disk, downloading the catalogue if it is missing or
+        older than max_age.
+
+        Args:
+            max_age (timedelta, optional): maximum age of the stored catalogue. Defaults to STATION_INDEX_TTL.
+            refresh (bool, optional): download the catalogue even if it is recent. Defaults to False.
+
+        Returns:
+            StationIndex: the index
+        """
+        is_recent = os.path.exists(STATION_INDEX_PATH) and (
+            time.time() - os.path.getmtime(STATION_INDEX_PATH) < max_age.total_seconds())
+        if is_recent and not refresh:
+            catalogue = pd.read_parquet(STATION_INDEX_PATH)
+        else:
+            catalogue = Stations().fetch()
+            os.makedirs(os.path.dirname(STATION_INDEX_PATH), exist_ok=True)
+            tmp_path = f"{STATION_INDEX_PATH}.{os.getpid()}.tmp"
+            catalogue.to_parquet(tmp_path)
+            os.replace(tmp_path, STATION_INDEX_PATH)
+        return cls(catalogue)
+
+    def _coverage_mask(self, start_year:int=None, end_year:int=None, freq:str="daily") -> np.ndarray:
+        """True for stations whose {freq}_start/{freq}_end inventory overlaps start_year to end_year"""
+        mask = np.ones(len(self.catalogue), dtype=bool)
+        if start_year is not None:
+            mask &= (self.catalogue[f"{freq}_end"] >= datetime(start_year, 1, 1)).to_numpy(dtype=bool, na_value=False)
+        if end_year is not None:
+            mask &= (self.catalogue[f"{freq}_start"] <= datetime(end_year, 12, 31)).to_numpy(dtype=bool, na_value=False)
+        return mask
+
+    def _result(self, positions:np.ndarray, chords:np.ndarray) -> pd.DataFrame:
+        order = np.argsort(chords, kind="stable")
+        result = self.catalogue.iloc[positions[order]].copy()
+        result["distance"] = np.round(_chord_to_meters(chords[order]), 1)
+        return result.reset_index(drop=True)
+
+    def radius(self, lat:float, lon:float, max_distance:float,
+               start_year:int=None, end_year:int=None, freq:str="daily") -> pd.DataFrame:
+        """All stations within max_distance meters of a point, sorted by distance
+
+        Args:
+            lat (float): latitude
+            lon (float): longitude
+            max_distance (float): search radius in meters
+            start_year (int, optional): skip stations without data after the start of this year. Defaults to None.
+            end_year (int, optional): skip stations without data before the end of this year. Defaults to None.
+            freq (str, optional): "daily" or "hourly" inventory to check. Defaults to "daily".
+
+        Returns:
+            pd.DataFrame: the matching stations with their distance in meters
+        """
+        return self.query_many([(lat, lon)], max_distance=max_distance, start_year=start_year,
+                               end_year=end_year, freq=freq).drop("query", axis=1)
+
+    def nearest(self, lat:float, lon:float, k:int=10,
+                start_year:int=None, end_year:int=None, freq:str="daily") -> pd.DataFrame:
+        """The k stations closest to a point, sorted by distance. See radius for the arguments."""
+        return self.query_many([(lat, lon)], k=k, start_year=start_year,
+                               end_year=end_year, freq=freq).drop("query", axis=1)
+
+    def query_many(self, points, max_distance:float=None, k:int=None,
+                   start_year:int=None, end_year:int=None, freq:str="daily") -> pd.DataFrame:
+        """Batch radius or k-nearest query for many locations at once. If both max_distance and k are given,
+        at most k stations within max_distance are returned per location.
+
+        Args:
+            points (list[tuple] | np.ndarray): (lat, lon) per location
+            max_distance (float, optional): search radius in meters. Defaults to None.
+            k (int, optional): number of closest stations per location. Defaults to None.
+            start_year, end_year, freq: coverage filter, see radius
+
+        Returns:
+            pd.DataFrame: the matching stations, with a "query" column holding the position of the location in points
+        """
+        if (max_distance is None) and (k is None):
+            raise ValueError("Specify max_distance, k or both")
+
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        xyz = _to_unit_vectors(points[:, 0], points[:, 1])
+        covered = self._coverage_mask(start_year, end_year, freq)
+        max_chord = _meters_to_chord(max_distance) if max_distance is not None else np.inf
+
+        if k is None:
+            neighbours = self._tree.query_ball_point(xyz, max_chord)
+
+        results = []
+        for i, point in enumerate(xyz):
+            if k is None:
+                positions = np.asarray(neighbours[i], dtype=np.int64)
+                positions = positions[covered[positions]]
+                chords = np.linalg.norm(self._tree.data[positions] - point, axis=1)
+            else:
+                # Ask for more candidates until k of them pass the coverage filter
+                n_candidates = min(k, len(self.catalogue))
+                while True:
+                    chords, positions = self._tree.query(point, k=n_candidates, distance_upper_bound=max_chord)
+                    chords, positions = np.atleast_1d(chords), np.atleast_1d(positions)
+                    found = positions < len(self.catalogue)
+                    chords, positions = chords[found], positions[found]
+                    keep = covered[positions]
+                    if (keep.sum() >= k) or (len(positions) < n_candidates) or (n_candidates == len(self.catalogue)):
+                        break
+                    n_candidates = min(n_candidates * 4, len(self.catalogue))
+                chords, positions = chords[keep][:k], positions[keep][:k]
+            results.append(self._result(positions, chords).assign(query=i))
+
+        return pd.concat(results, ignore_index=True)
+
+
+def get_station_index(refresh:bool=False) -> StationIndex:
+    """The station index shared by the whole process, loaded on first use
+
+    Args:
+        refresh (bool, optional): download the catalogue again. Defaults to False.
+
+    Returns:
+        StationIndex: the index
+    """
+    global _index
+    with _index_lock:
+        if (_index is None) or refresh:
+            _index = StationIndex.load(refresh=refresh)
+        return _index
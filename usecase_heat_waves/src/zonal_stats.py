@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio as rio
+from rasterio import features
+
+# Temperature ranges of the district LST layer of the dashboard
+LST_RANGES = {"1": (-20, 27), "2": (27, 32), "3": (32, 40), "4": (40, 100)}
+
+
+def rasterize_zones(zones:gpd.GeoDataFrame, transform, shape:tuple, crs=None, all_touched:bool=False) -> np.ndarray:
+    """Burn all zone polygons into one label raster: 0 outside of all zones, i + 1 inside the i-th zone.
+    Like rio.clip, a pixel belongs to a zone if its center is inside (unless all_touched). Where zones
+    overlap, the later zone gets the pixel.
+
+    Args:
+        zones (gpd.GeoDataFrame): the polygons
+        transform (affine.Affine): transform of the raster
+        shape (tuple): (height, width) of the raster
+        crs (optional): crs of the raster, the zones are reprojected to it. Defaults to None.
+        all_touched (bool, optional): also count pixels touched by the border. Defaults to False.
+
+    Returns:
+        np.ndarray: int32 label raster
+    """
+    if (crs is not None) and (zones.crs is not None):
+        zones = zones.to_crs(crs)
+    shapes = [(geometry, i + 1) for i, geometry in enumerate(zones.geometry) if geometry is not None]
+    return features.rasterize(shapes, out_shape=shape, transform=transform, fill=0,
+                              all_touched=all_touched, dtype=np.int32)
+
+def zone_statistics(labels:np.ndarray, values:np.ndarray, n_zones:int, ranges_dict:dict=LST_RANGES,
+                    pixel_area:float=1.0) -> pd.DataFrame:
+    """min/mean/max/count/area and the fraction of pixels in each range for all zones of one band, with
+    one bincount per statistic instead of one mask per zone
+
+    Args:
+        labels (np.ndarray): label raster of rasterize_zones
+        values (np.ndarray): band of the same shape, NaN where there is no data
+        n_zones (int): number of zones
+        ranges_dict (dict, optional): {name: (min, max)}, min <= value < max. Defaults to LST_RANGES.
+        pixel_area (float, optional): area of one pixel. Defaults to 1.0.
+
+    Returns:
+        pd.DataFrame: one row per zone with at least one valid pixel, with the zone position in "zone"
+    """
+    labels = labels.ravel()
+    values = values.ravel()
+    valid = (labels > 0) & ~np.isnan(values)
+    zone = labels[valid] - 1
+    values = values[valid].astype(np.float64)
+
+    count = np.bincount(zone, minlength=n_zones)
+    total = np.bincount(zone, weights=values, minlength=n_zones)
+
+    # Sorted by zone and value, the first and last value of each zone are its min and max
+    order = np.lexsort((values, zone))
+    sorted_values = values[order]
+    ends = np.cumsum(count)
+    starts = ends - count
+    has_data = count > 0
+
+    stats = pd.DataFrame({
+        "zone": np.flatnonzero(has_data),
+        "lst_min": sorted_values[starts[has_data]],
+        "lst_mean": total[has_data] / count[has_data],
+        "lst_max": sorted_values[ends[has_data] - 1],
+        "pixel_count": count[has_data],
+        "total_area": count[has_data] * pixel_area,
+    })
+    for min_val, max_val in ranges_dict.values():
+        in_range = (values >= min_val) & (values < max_val)
+        stats[f"{min_val} <= lst < {max_val}"] = np.bincount(zone[in_range], minlength=n_zones)[has_data] / count[has_data]
+    return stats
+
+def _read_scene(scene):
+    """Values (bands, height, width) with NaN for nodata, transform, crs and pixel size of a file path or
+    of a rioxarray DataArray"""
+    if isinstance(scene, str):
+        with rio.open(scene) as src:
+            values = src.read(masked=True).astype(np.float64).filled(np.nan)
+            return values, src.transform, src.crs, src.res
+    values = np.asarray(scene.values, dtype=np.float64)
+    if scene.rio.nodata is not None:
+        values = np.where(values == scene.rio.nodata, np.nan, values)
+    values = values.reshape((-1,) + values.shape[-2:])
+    return values, scene.rio.transform(), scene.rio.crs, scene.rio.resolution()
+
+def compute_zonal_stats(zones:gpd.GeoDataFrame, scenes:list, ranges_dict:dict=LST_RANGES, id_column:str="id",
+                        scene_names:list=None, all_touched:bool=False) -> pd.DataFrame:
+    """Per zone and band statistics of one or many rasters, replaces clipping every zone separately.
+    The zones are rasterized once per raster grid, scenes on the same grid share the label raster.
+
+    Args:
+        zones (gpd.GeoDataFrame): eg. the districts
+        scenes (list): file paths or rioxarray DataArrays (a single one is accepted too)
+        ranges_dict (dict, optional): {name: (min, max)} ranges to compute the pixel fractions of. Defaults to LST_RANGES.
+        id_column (str, optional): column of zones written to "district_id". Defaults to "id".
+        scene_names (list, optional): value of the "scene" column per scene. Defaults to the file names or positions.
+        all_touched (bool, optional): see rasterize_zones. Defaults to False.
+
+    Returns:
+        pd.DataFrame: the columns band, lst_min, lst_mean, lst_max, pixel_count, total_area, district_id,
+        one fraction column per range and scene if there is more than one scene
+    """
+    single_scene = not isinstance(scenes, (list, tuple))
+    if single_scene:
+        scenes = [scenes]
+    if scene_names is None:
+        scene_names = [s if isinstance(s, str) else i for i, s in enumerate(scenes)]
+
+    labels_per_grid = {}
+    results = []
+    for name, scene in zip(scene_names, scenes):
+        values, transform, crs, resolution = _read_scene(scene)
+        grid = (tuple(transform), values.shape[-2:], str(crs))
+        if grid not in labels_per_grid:
+            labels_per_grid[grid] = rasterize_zones(zones, transform, values.shape[-2:], crs, all_touched)
+        labels = labels_per_grid[grid]
+        # Area in the units of the raster crs, like the notebook
+        pixel_area = abs(resolution[0]) * abs(resolution[1])
+
+        for band, band_values in enumerate(values, start=1):
+            stats = zone_statistics(labels, band_values, len(zones), ranges_dict, pixel_area)
+            stats.insert(0, "band", band)
+            stats.insert(7, "district_id", zones[id_column].to_numpy()[stats["zone"].to_numpy()])
+            stats = stats.drop("zone", axis=1)
+            if not single_scene:
+                stats.insert(0, "scene", name)
+            results.append(stats)
+
+    return pd.concat(results, ignore_index=True)
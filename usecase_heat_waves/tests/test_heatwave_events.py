@@ -0,0 +1,92 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.append(SRC_PATH)
+import analyse_heatwaves as hw_functions
+
+
+def daily(tmax: list, start: str = "2023-07-01") -> pd.DatetimeIndex:
+    return pd.date_range(start, periods=len(tmax), freq="D")
+
+
+def test_find_runs_at_the_start_and_end():
+    starts, ends = hw_functions._find_runs(np.array([True, True, False, False, True]))
+
+    np.testing.assert_array_equal(starts, [0, 4])
+    np.testing.assert_array_equal(ends, [2, 5])
+
+
+def test_find_runs_without_runs():
+    starts, ends = hw_functions._find_runs(np.zeros(4, dtype=bool))
+
+    assert len(starts) == 0 and len(ends) == 0
+
+
+def test_heatwave_at_the_start_of_the_series():
+    tmax = [30, 31, 32, 33, 20, 20]
+
+    flags, events = hw_functions.compute_heatwave_events(daily(tmax), tmax)
+
+    np.testing.assert_array_equal(flags["dwd_heatwave_day"], [False, False, True, True, False, False])
+    assert len(events) == 1
+    assert events.loc[0, "start_date"] == pd.Timestamp("2023-07-03")
+    assert events.loc[0, "duration"] == 2
+    assert events.loc[0, "tmax"] == 33
+
+
+def test_heatwave_at_the_end_of_the_series():
+    tmax = [20, 29, 29, 29, 35]
+
+    flags, events = hw_functions.compute_heatwave_events(daily(tmax), tmax)
+
+    np.testing.assert_array_equal(flags["dwd_heatwave_day"], [False, False, False, True, True])
+    assert events.loc[0, "end_date"] == pd.Timestamp("2023-07-05")
+    assert events.loc[0, "annual_index"] == "2023_1"
+
+
+def test_missing_day_splits_a_run():
+    tmax = [29, 29, np.nan, 29, 29, 29]
+
+    flags, events = hw_functions.compute_heatwave_events(daily(tmax), tmax)
+
+    np.testing.assert_array_equal(flags["dwd_heatwave_day"], [False, False, False, False, False, True])
+    assert len(events) == 1
+    assert events.loc[0, "start_date"] == pd.Timestamp("2023-07-06")
+
+
+def test_single_hot_day_is_no_heatwave():
+    tmax = [20, 35, 20, 29, 29]
+
+    flags, events = hw_functions.compute_heatwave_events(daily(tmax), tmax)
+
+    assert not flags["dwd_heatwave_day"].any()
+    assert (flags["event_id"] == -1).all()
+    assert len(events) == 0
+    assert list(events.columns) == ["year", "annual_index", "duration", "tmax", "start_date", "end_date"]
+
+
+def test_events_are_numbered_per_year():
+    tmax = [30] * 4 + [20] + [30] * 3
+    dates = pd.DatetimeIndex(list(pd.date_range("2022-12-28", periods=4)) + list(pd.date_range("2023-01-01", periods=4)))
+
+    _, events = hw_functions.compute_heatwave_events(dates, tmax)
+
+    assert events["annual_index"].tolist() == ["2022_1", "2023_1"]
+
+
+def test_matches_the_rolling_definition():
+    rng = np.random.default_rng(0)
+    tmax = rng.normal(27, 3, 2000)
+    tmax[rng.integers(0, 2000, 50)] = np.nan
+    data = pd.DataFrame({"tmax": tmax}, index=daily(tmax, start="2000-01-01"))
+
+    result = hw_functions.compute_dwd_heatwave(data.copy())
+
+    # The definition of the DWD as it was computed before the run-length engine
+    rolling = (data["tmax"] > 28).astype(int).rolling(3).sum().fillna(0)
+    np.testing.assert_array_equal(result["dwd_heatwave_day"].to_numpy(), (rolling >= 3).to_numpy())
+    np.testing.assert_array_equal(result["rolling_28_3"].to_numpy(), rolling.to_numpy())